@@ -7,17 +7,25 @@ import logging
 import struct
 import signal
 import subprocess
-from datetime import datetime, timedelta
+from datetime import datetime
+from time import monotonic
 from pylibpcap.pcap import sniff
 from pylibpcap import send_packet
 import socket
 import os
 import random
 
+from mnat.lazylog import RateLimited
+
 pkts = 0
 sent = 0
 drops = 0
-last_msg = datetime.now()
+
+# the packet counts go to stdout every 3s while packets are flowing,
+# checked per packet (so against a monotonic() rather than building
+# datetimes and timedeltas for every packet)
+logger = logging.getLogger('mnat-translate')
+status_log = RateLimited(logging.INFO, 3, logger=logger)
 
 def carry_around_add(a, b):
     c = a + b
@@ -369,9 +377,8 @@ def get_callback(args):
                 return out_pkt
 
     def sg_monitor_callback(pkt):
-        global pkts, last_msg, sent, drops
+        global pkts, sent, drops
         pkts += 1
-        now = datetime.now()
 
         out_p = change_pkt(pkt)
         if out_p:
@@ -380,9 +387,9 @@ def get_callback(args):
         else:
             drops += 1
 
-        if now - last_msg >= timedelta(seconds=3):
-            print(f'{now} ({in_src}->{in_grp})=>({out_src}->{out_grp}): {pkts} pkts, {drops} dropped {sent} sent')
-            last_msg = now
+        if status_log.due():
+            logger.info('(%s->%s)=>(%s->%s): %d pkts, %d dropped %d sent',
+                    in_src, in_grp, out_src, out_grp, pkts, drops, sent)
 
         #send_packet(iface, pkt)
         #u = pkt[UDP]
@@ -392,7 +399,7 @@ def get_callback(args):
     return sg_monitor_callback
 
 stopping=False
-last_refreshed = datetime.now()
+last_refreshed = monotonic()
 def stop_handler(signum, frame):
     global stopping
     print(f'{datetime.now()}: stopping mnat-translate ({os.getpid()})')
@@ -400,11 +407,10 @@ def stop_handler(signum, frame):
 
 def refresh_handler(signum, frame):
     global last_refreshed
-    last_refreshed = datetime.now()
+    last_refreshed = monotonic()
 
 def main(args_in):
     global stopping, last_refreshed
-    global last_msg
     parser = argparse.ArgumentParser(
             description='''
 UDP packet IPs are converted for from_src->from_dst seen on from_interface to to_src->to_dst written out on to_interface''', prog=args_in[0])
@@ -427,6 +433,10 @@ UDP packet IPs are converted for from_src->from_dst seen on from_interface to to
     filter_str = f'udp and src {args.src_in} and dst {args.grp_in}'
 
     os.environ["PYTHONUNBUFFERED"] = "1"
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
     print(f'starting mnat-translate ({os.getpid()})')
 
     signal.signal(signal.SIGTERM, stop_handler)
@@ -436,7 +446,7 @@ UDP packet IPs are converted for from_src->from_dst seen on from_interface to to
 
     dead_delay = None
     if args.timeout > 0:
-        dead_delay = timedelta(seconds=args.timeout)
+        dead_delay = args.timeout
 
     prn = get_callback(args)
 
@@ -462,8 +472,8 @@ UDP packet IPs are converted for from_src->from_dst seen on from_interface to to
         #print("[+]: Payload len=", plen)
         #print("[+]: Time", t)
         #print("[+]: Payload", buf)
-        if dead_delay and datetime.now() - last_refreshed > dead_delay:
-            print('shutting down by timeout (no SIGUSR1 received in {dead_delay}')
+        if dead_delay and monotonic() - last_refreshed > dead_delay:
+            print(f'shutting down by timeout (no SIGUSR1 received in {dead_delay}s)')
             break
 
 
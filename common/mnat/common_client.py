@@ -34,6 +34,8 @@ from h2.events import (
     SettingsAcknowledged,
 )
 
+from .lazylog import enabled, Lazy, RateLimited, Sampled
+
 def get_logger(name, verbosity=0):
     log_level = logging.WARNING
     if verbosity > 1:
@@ -53,7 +55,7 @@ def get_logger(name, verbosity=0):
     return _logger
 
 class RequestBuf(object):
-    def __init__(self, path, method='GET', data=None, content_type=None, content_encoding=None, callback=None):
+    def __init__(self, path, method='GET', data=None, content_type=None, content_encoding=None, callback=None, data_callback=None):
         self.path = path
         self.method = method
         self.data = data
@@ -63,6 +65,9 @@ class RequestBuf(object):
             self.content_type='application/yang-data+json'
         self.content_encoding = content_encoding
         self.callback = callback
+        # data_callback(req, data) gets the response data as it arrives
+        # instead of it being buffered up (for event streams)
+        self.data_callback = data_callback
         self.built_headers = []
         self.response_headers = []
         self.response_data = None
@@ -190,7 +195,7 @@ class TranslateManager(object):
             return
 
         if self.mapping.local == mapping.local:
-            self.logger.debug(f'mapping stayed stable: {mapping}, refreshing')
+            self.logger.debug('mapping stayed stable: %s, refreshing', mapping)
             self.p.send_signal(signal.SIGUSR1)
             return
 
@@ -251,8 +256,30 @@ class H2Protocol(Protocol):
         self.in_interface = None
         self.out_interface = None
         self.current_mappings = dict()
+        # get-assigned-changes state: the last generation and the
+        # mappings as of it, or use_assigned_changes=False to poll the
+        # full assigned-channels (a server without that rpc)
+        self.use_assigned_changes = True
+        self.assigned_generation = None
+        self.polled_mappings = dict()
+        # when the server advertises refresh-and-get-changes, each poll
+        # refreshes the watcher id too and there's no refresh loop
+        self.use_refresh_and_get_changes = False
+        # ietf-mnat:assignment-updates subscription: push_req is its
+        # event stream request while it's up, and while push_up (an
+        # update came through on it) polling slows to push_poll_period.
+        # use_push=False for a server without it.
+        self.use_push = True
+        self.push_req = None
+        self.push_up = False
+        self.push_buf = b''
+        self.poll_period = 10
+        self.push_poll_period = 60
         self.no_join = False
         self.verbose = 0 # for passing to subprocesses, self-verbosity is in the logger.
+        # the polls and refreshes keep firing while the connection is
+        # down, so their "skipping" messages are once a minute at most
+        self.skip_log = RateLimited(logging.INFO, 60, logger=self.logger)
 
     def start(self):
         now = datetime.now()
@@ -321,11 +348,11 @@ class H2Protocol(Protocol):
         if stream_id not in self.request_table:
             self.logger.info(f'endStream for {stream_id} called again?')
         else:
-            self.logger.info(f'cleanly ending stream {stream_id}')
+            self.logger.info('cleanly ending stream %d', stream_id)
             req = self.request_table[stream_id]
             del(self.request_table[stream_id])
             if req.callback:
-                self.logger.debug(f'fired callback {req.callback}')
+                self.logger.debug('fired callback %s', req.callback)
                 req.callback(req)
 
         if self.shutting_down:
@@ -342,6 +369,7 @@ class H2Protocol(Protocol):
         self.conn = None
         self.connected = 0
         self.transport = None
+        self.pushDown()
         if not self.shutting_down:
             self.restarting_deferred = True
             reactor.callLater(5, self.check_start)
@@ -426,15 +454,18 @@ class H2Protocol(Protocol):
 
         if not self.watcher_id:
             self.getNewWatcherId()
+        else:
+            self.establishSubscription()
 
     def handleResponse(self, stream_id, response_headers):
         """
         Handle the response by printing the response headers.
         """
         status = next((val.decode('utf-8') for name,val in response_headers if name == b':status'), None)
-        self.logger.info(f'got response id={stream_id} ({status}: {len(response_headers)} hdrs):')
-        for name, value in response_headers:
-            self.logger.debug("   %s: %s" % (name.decode('utf-8'), value.decode('utf-8')))
+        self.logger.info('got response id=%d (%s: %d hdrs):', stream_id, status, len(response_headers))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for name, value in response_headers:
+                self.logger.debug("   %s: %s", name.decode('utf-8'), value.decode('utf-8'))
         if stream_id not in self.request_table:
             self.logger.warning(f'response for {stream_id} has no request in request table')
         else:
@@ -445,13 +476,19 @@ class H2Protocol(Protocol):
         """
         We handle data that's received by just printing it.
         """
-        dat = data.decode('utf-8')
-        self.logger.debug(f'handleData(id={stream_id}, len={len(data)}) got:\n{dat}')
+        self.logger.debug('handleData(id=%d, len=%d) got:\n%s', stream_id, len(data), Lazy(data.decode, 'utf-8'))
 
         if stream_id not in self.request_table:
             self.logger.warning(f'data for {stream_id} has no request in request table')
+        elif self.request_table[stream_id].data_callback:
+            req = self.request_table[stream_id]
+            if not stream_ended:
+                # a long-lived stream: the window for the connection is
+                # widened in dataReceived, this one needs it too
+                self.conn.increment_flow_control_window(len(data), stream_id=stream_id)
+            req.data_callback(req, data)
         else:
-            self.logger.info(f'data for {stream_id}: buffered {len(data)} bytes')
+            self.logger.info('data for %d: buffered %d bytes', stream_id, len(data))
             req = self.request_table[stream_id]
             if req.response_data:
                 req.response_data += data
@@ -518,7 +555,7 @@ class H2Protocol(Protocol):
                 request_headers.append(('content-encoding', req.content_encoding))
 
         stream_id = self.nextStreamId()
-        self.logger.info(f'req id={stream_id}: {req.method} {path}')
+        self.logger.info('req id=%d: %s %s', stream_id, req.method, path)
         req.built_headers = request_headers
         self.request_table[stream_id] = req
         self.conn.send_headers(stream_id, request_headers)
@@ -526,7 +563,7 @@ class H2Protocol(Protocol):
         if req.data:
             self.sendData(stream_id, req.data)
         else:
-            self.logger.info(f'end stream {stream_id} (req without data)')
+            self.logger.info('end stream %d (req without data)', stream_id)
             self.conn.end_stream(stream_id=stream_id)
             self.transport.write(self.conn.data_to_send())
 
@@ -543,10 +580,8 @@ class H2Protocol(Protocol):
         # We will send no more than the window size or the remaining file size
         # of data in this call, whichever is smaller.
         bytes_to_send = min(window_size, len(data))
-        self.logger.info(f'{bytes_to_send}/{len(data)} bytes for {window_size} window')
-
-        strdat = data[:bytes_to_send].decode('utf-8')
-        self.logger.info(f'sending data id={stream_id} ({bytes_to_send} of {len(data)} bytes):\n{strdat}')
+        self.logger.info('sending data id=%d (%d of %d bytes for %d window)', stream_id, bytes_to_send, len(data), window_size)
+        self.logger.debug('data id=%d:\n%s', stream_id, Lazy(lambda: data[:bytes_to_send].decode('utf-8')))
 
         # We now need to send a number of data frames.
         offset = 0
@@ -561,7 +596,7 @@ class H2Protocol(Protocol):
         # We've prepared a whole chunk of data to send. If the data is fully
         # sent, we also want to end the stream: we're done here.
         if offset >= len(data):
-            self.logger.info(f'end stream {stream_id} (req finished data)')
+            self.logger.info('end stream %d (req finished data)', stream_id)
             self.conn.end_stream(stream_id=stream_id)
         else:
             # We've still got data left to send but the window is closed. Save
@@ -593,38 +628,155 @@ class H2Protocol(Protocol):
         if self.refresh_period < 1:
             self.refresh_period = 1
 
+        self.use_refresh_and_get_changes = 'refresh-and-get-changes' in resp_j
+        if self.use_refresh_and_get_changes:
+            if self.refreshing_task:
+                self.refreshing_task.stop()
+                self.refreshing_task = None
+        else:
+            self.startRefreshing()
+        self.last_refresh_time = datetime.now()
+
+        self.setupWatcher()
+
+        self.use_assigned_changes = True
+        self.assigned_generation = None
+        self.polled_mappings = dict()
+        self.use_push = True
+        self.pushDown()
+        self.startPolling(self.poll_period)
+        self.establishSubscription()
+
+    def startRefreshing(self):
         if self.refreshing_task:
             self.refreshing_task.stop()
-
         self.refreshing_task = task.LoopingCall(self.sendRefreshWatcherId)
         self.refreshing_task.start(self.refresh_period, now=False)
-        self.last_refresh_time = datetime.now()
-
-        self.setupWatcher()
 
+    def startPolling(self, period, now=True):
+        if self.use_refresh_and_get_changes:
+            # the polls are the refreshes
+            period = min(period, self.refresh_period)
         if self.polling_task:
             self.polling_task.stop()
         self.polling_task = task.LoopingCall(self.sendCheckAssigned)
-        self.polling_task.start(10, now=True)
+        self.polling_task.start(period, now=now)
 
-        '''
-        TBD: it would be wonderful to be getting push notifications from the server with subscribed-notifications --jake 2020-11
+    def establishSubscription(self):
+        if not self.use_push or self.push_req or not self.watcher_id:
+            return
+        if self.restarting_deferred or self.shutting_down:
+            return
         establish_input = {
             'ietf-subscribed-notifications:input': {
-                'stream-filter-name': 'ietf-mnat:assignment-updates'
+                'stream-filter-name': 'ietf-mnat:assignment-updates',
+                'ietf-mnat:watcher-id': self.watcher_id
             }
         }
         data=json.dumps(establish_input).encode('utf-8')
+        watcher_id = self.watcher_id
         req = RequestBuf(
             path='/operations/ietf-subscribed-notifications:establish-subscription',
             method='POST',
-            data=data)
-        protocol.sendRequest(req)
-        '''
+            data=data,
+            callback=lambda req: self.gotSubscription(req, watcher_id))
+        self.sendRequest(req)
+
+    def gotSubscription(self, req, watcher_id):
+        if self.push_req or watcher_id != self.watcher_id:
+            # a duplicate, or for a watcher id since replaced
+            return
+        status = self.responseStatus(req)
+        try:
+            if not status or not status.startswith('2'):
+                raise ValueError(f'status {status}')
+            resp_j = json.loads(req.response_data.decode('utf-8').strip())
+            resp_j = resp_j.get('ietf-subscribed-notifications:output', resp_j)
+            uri = resp_j['ietf-mnat:uri']
+        except Exception as e:
+            self.logger.warning(f'no assignment-updates subscription for watcher id {self.watcher_id}: {e}, polling every {self.poll_period}s')
+            self.use_push = False
+            return
+
+        self.logger.info(f'subscribed to assignment-updates for watcher id {self.watcher_id}: {uri}')
+        path = uri[len(self.root):] if uri.startswith(self.root) else uri
+        self.push_buf = b''
+        self.push_req = RequestBuf(
+            path=path,
+            method='GET',
+            content_type='text/event-stream',
+            callback=self.pushEnded,
+            data_callback=self.gotPushData)
+        self.sendRequest(self.push_req)
+
+    def gotPushData(self, req, data):
+        if req is not self.push_req:
+            return
+        # keepalive comments count too
+        self.last_assign_check_time = datetime.now()
+        self.push_buf += data
+        while b'\n\n' in self.push_buf:
+            event, self.push_buf = self.push_buf.split(b'\n\n', 1)
+            lines = [line[len('data:'):].lstrip() for line in event.decode('utf-8').split('\n')
+                    if line.startswith('data:')]
+            if lines:
+                self.gotPushEvent('\n'.join(lines))
+
+    def gotPushEvent(self, event_text):
+        try:
+            notification = json.loads(event_text)['ietf-restconf:notification']
+            update = notification['ietf-mnat:assignment-update']
+            if update['watcher-id'] != self.watcher_id:
+                raise ValueError(f'update for watcher id {update["watcher-id"]}')
+            changes = self.parseAssignedChanges(update)
+        except Exception as e:
+            self.logger.warning(f'bad assignment-update for watcher id {self.watcher_id}: {e}, next poll gets the full list')
+            self.assigned_generation = None
+            return
+
+        if not self.push_up:
+            self.push_up = True
+            self.logger.info(f'assignment-updates streaming, polling every {self.push_poll_period}s')
+            self.startPolling(self.push_poll_period, now=False)
+        self.applyAssignedChanges(*changes)
+
+    def pushEnded(self, req):
+        if req is not self.push_req:
+            return
+        self.logger.warning(f'assignment-updates stream for watcher id {self.watcher_id} ended, polling every {self.poll_period}s')
+        self.pushDown()
+        reactor.callLater(self.poll_period, self.establishSubscription)
+
+    def pushDown(self):
+        was_up = self.push_up
+        self.push_req = None
+        self.push_up = False
+        self.push_buf = b''
+        if was_up and self.polling_task:
+            self.startPolling(self.poll_period)
 
     def sendCheckAssigned(self):
         if self.restarting_deferred or self.shutting_down:
-            self.logger.info(f'(skipping assigned-channels pull while down)')
+            self.skip_log('(skipping assigned-channels pull while down)')
+            return
+        if self.use_assigned_changes:
+            changes_input = {
+                'ietf-mnat:input': {
+                    'ietf-mnat:watcher-id': self.watcher_id
+                }
+            }
+            if self.assigned_generation:
+                changes_input['ietf-mnat:input']['ietf-mnat:generation'] = self.assigned_generation
+            data=json.dumps(changes_input).encode('utf-8')
+            since = self.assigned_generation
+            refreshing = self.use_refresh_and_get_changes
+            rpc = 'refresh-and-get-changes' if refreshing else 'get-assigned-changes'
+            req = RequestBuf(
+                path=f'/operations/ietf-mnat:{rpc}',
+                method='POST',
+                data=data,
+                callback=lambda req: self.gotAssignedChanges(req, since, refreshing))
+            self.sendRequest(req)
             return
         req = RequestBuf(
             path=f'/data/ietf-mnat:assigned-channels/watcher={self.watcher_id}',
@@ -645,18 +797,79 @@ class H2Protocol(Protocol):
             return
 
         # check changes since last time, launch and kill translators
-        mappings = []
-        for mapped_sg in mapped_sgs:
-            assignment_id = mapped_sg['id']
-            state = mapped_sg['state']
-            global_sub = mapped_sg['global-subscription']
-            source = global_sub['source']
-            group = global_sub['group']
-            local_map = mapped_sg.get('local-mapping')
-            mappings.append(Mapping(source, group, LocalAssignment(state, local_map)))
-        self.logger.debug(f'gotAssigned: {mapped_sgs}')
+        mappings = [self.mappingFromJson(mapped_sg) for mapped_sg in mapped_sgs]
+        self.logger.debug('gotAssigned: %s', mapped_sgs)
         self.polledLatestMappings(mappings)
 
+    def mappingFromJson(self, mapped_sg):
+        state = mapped_sg['state']
+        global_sub = mapped_sg['global-subscription']
+        source = global_sub['source']
+        group = global_sub['group']
+        local_map = mapped_sg.get('local-mapping')
+        return Mapping(source, group, LocalAssignment(state, local_map))
+
+    def responseStatus(self, req):
+        return next((val.decode('utf-8') for name,val in req.response_headers if name == b':status'), None)
+
+    def parseAssignedChanges(self, resp_j):
+        '''(generation, changes, updated mappings, removed sgs) from an assigned-changes'''
+        generation = resp_j['generation']
+        changes = resp_j['changes']
+        updated = [self.mappingFromJson(mapped_sg) for mapped_sg in resp_j.get('mapped-sg', [])]
+        removed = []
+        for removed_sg in resp_j.get('removed-sg', []):
+            global_sub = removed_sg['global-subscription']
+            removed.append((ip_address(global_sub['source']), ip_address(global_sub['group'])))
+        return generation, changes, updated, removed
+
+    def gotAssignedChanges(self, req, since, refreshing=False):
+        status = self.responseStatus(req)
+        try:
+            if not status or not status.startswith('2'):
+                raise ValueError(f'status {status}')
+            resp_j = json.loads(req.response_data.decode('utf-8').strip())
+            resp_j = resp_j.get('ietf-mnat:output', resp_j)
+            changes = self.parseAssignedChanges(resp_j)
+        except Exception as e:
+            if refreshing:
+                if self.use_refresh_and_get_changes:
+                    self.logger.warning(f'failed refresh-and-get-changes for watcher id {self.watcher_id}: {e}, refreshing and polling separately')
+                    self.use_refresh_and_get_changes = False
+                    self.startRefreshing()
+                    self.sendRefreshWatcherId()
+                    self.sendCheckAssigned()
+                return
+            # an unknown watcher id also lands here: the full poll
+            # sorts that out by getting a new one
+            self.logger.warning(f'failed get-assigned-changes for watcher id {self.watcher_id}: {e}, polling full assigned-channels')
+            self.use_assigned_changes = False
+            self.assigned_generation = None
+            self.sendCheckAssigned()
+            return
+
+        self.last_assign_check_time = datetime.now()
+        if refreshing:
+            self.last_refresh_time = self.last_assign_check_time
+        if since != self.assigned_generation:
+            # an assignment-update came in while this was on its way,
+            # and it may be newer than this
+            self.logger.debug('gotAssignedChanges: dropping poll from %s, now at %s', since, self.assigned_generation)
+            return
+        self.applyAssignedChanges(*changes)
+
+    def applyAssignedChanges(self, generation, changes, updated, removed):
+        self.logger.debug('applyAssignedChanges: %s to %s: %s, removed %s', changes, generation, updated, removed)
+        if changes == 'full':
+            self.polled_mappings = dict()
+        for m in updated:
+            self.polled_mappings[(m.source, m.group)] = m
+        for sg in removed:
+            self.polled_mappings.pop(sg, None)
+        self.assigned_generation = generation
+        # subclasses see the whole list every poll, same as before
+        self.polledLatestMappings(list(self.polled_mappings.values()))
+
     def polledLatestMappings(self, mappings):
         cur_translates = set(self.current_mappings.keys())
         mapping_dict = dict([((m.source, m.group), m) for m in mappings])
@@ -702,7 +915,7 @@ class H2Protocol(Protocol):
 
     def sendRefreshWatcherId(self):
         if self.restarting_deferred or self.shutting_down:
-            self.logger.info(f'(skipping refresh-watcher-id while down)')
+            self.skip_log('(skipping refresh-watcher-id while down)')
             return
         refresh_input = {
             'ietf-mnat:input': {
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# logging helpers for hot paths.  logging only formats the %-style
+# arguments of a message it's going to emit, so
+#     logger.debug('got %s', Lazy(data.decode, 'utf-8'))
+# costs a level check when debug is off, where the f-string version
+# decodes the whole buffer on every call.
+#
+# No twisted or h2 in here, so mnat-translate and the server module
+# (jetconf_mnat) can use it without loading them.  mnat.common_client
+# re-exports these.  The server's colorlog functions log through the
+# root logger, so that's what these check by default.
+
+import logging
+from time import monotonic
+
+root = logging.getLogger()
+
+def enabled(level, logger=root):
+    '''whether a message at level goes anywhere, for guarding work done only to log it'''
+    return logger.isEnabledFor(level)
+
+class Lazy(object):
+    '''A log argument computed only if it's formatted: str() gives str(fn(*args)).'''
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+class RateLimited(object):
+    '''
+    A message at level at most once every period seconds, for messages
+    that can come with every request or poll.  The ones in between are
+    dropped, and the next one that goes out says how many.  due() is
+    the check alone (without the count), for callers that would rather
+    not even build the arguments.
+    '''
+    def __init__(self, level, period, logger=root):
+        self.logger = logger
+        self.level = level
+        self.period = period
+        self.next_time = 0
+        self.dropped = 0
+
+    def due(self):
+        if not self.logger.isEnabledFor(self.level):
+            return False
+        now = monotonic()
+        if now < self.next_time:
+            return False
+        self.next_time = now + self.period
+        return True
+
+    def __call__(self, msg, *args):
+        if not self.due():
+            if self.logger.isEnabledFor(self.level):
+                self.dropped += 1
+            return
+        if self.dropped:
+            msg += ' (%d more dropped)'
+            args += (self.dropped,)
+            self.dropped = 0
+        self.logger.log(self.level, msg, *args)
+
+class Sampled(object):
+    '''A message at level for the first call and every'th one after it.'''
+    def __init__(self, level, every, logger=root):
+        self.logger = logger
+        self.level = level
+        self.every = every
+        self.count = 0
+
+    def due(self):
+        if not self.logger.isEnabledFor(self.level):
+            return False
+        self.count += 1
+        return (self.count - 1) % self.every == 0
+
+    def __call__(self, msg, *args):
+        if not self.due():
+            return
+        if self.every > 1:
+            msg += ' (1 in %d logged)'
+            args += (self.every,)
+        self.logger.log(self.level, msg, *args)
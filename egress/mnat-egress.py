@@ -14,7 +14,8 @@ import sys
 import json
 import argparse
 from ipaddress import ip_address
-from mnat.common_client import get_logger, RequestBuf, H2Protocol, TRANSLATE_TO_GLOBAL
+from urllib.parse import quote
+from mnat.common_client import get_logger, RequestBuf, H2Protocol, TRANSLATE_TO_GLOBAL, Lazy
 from os.path import abspath, dirname
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
@@ -22,7 +23,18 @@ from watchdog.events import PatternMatchingEventHandler
 logger = None
 
 class EgressProtocol(H2Protocol):
+    # joined-sg changes go out as a yang-patch of the changed entries
+    # when they're under this fraction of the list, else as a PUT of the
+    # whole list
+    patch_fraction = 0.5
+    use_patch = True
+    # { (S,G): joined-sg id } as last sent, None when the server's copy
+    # isn't known (the next update sends the whole list)
+    joined = None
+    patch_count = 0
+
     def setupWatcher(self):
+        self.joined = {}
         data = json.dumps({
             'ietf-mnat:watcher': {
               'id': self.watcher_id,
@@ -39,21 +51,100 @@ class EgressProtocol(H2Protocol):
         if os.path.isfile(control_file):
             self.refresh_joins_from_file(control_file)
 
+    def connectionLost(self, reason=None):
+        # updates in flight are lost with it
+        self.joined = None
+        super().connectionLost(reason)
+
     def join_update(self, sgs):
-        logger.info('join update:\n  ' + '\n  '.join([f'{s}->{g}' for s,g in sgs]))
-        send_sgs = [{'source':str(s), 'group':str(g), 'id':str(idx)} for (s,g),idx in zip(sgs, range(len(sgs)))]
+        logger.info('join update:\n  %s', Lazy(lambda: '\n  '.join(f'{s}->{g}' for s,g in sgs)))
+        # the (S,G) is the id, so an entry keeps its id across updates
+        joined = {(s,g): f'{s},{g}' for s,g in sgs}
+        if not self.settings_acked:
+            # this one's dropped
+            self.joined = None
+        if self.use_patch and self.joined is not None:
+            removes = [sg for sg in self.joined if sg not in joined]
+            adds = [sg for sg in joined if sg not in self.joined]
+            if not removes and not adds:
+                logger.info('joined (S,G)s unchanged')
+                return
+            if len(removes) + len(adds) < self.patch_fraction * max(len(joined), len(self.joined)):
+                self.join_patch(joined, removes, adds)
+                return
+        self.join_put(joined)
+
+    def joined_sg_json(self, sg, sg_id):
+        return {'id':sg_id, 'source':str(sg[0]), 'group':str(sg[1])}
+
+    def join_put(self, joined):
         data = json.dumps({
             'ietf-mnat:watcher': {
               'id': self.watcher_id,
-              'joined-sg': send_sgs
+              'joined-sg': [self.joined_sg_json(sg, sg_id) for sg, sg_id in joined.items()]
             }
           }).encode('utf-8')
         req = RequestBuf(
             path=f'/data/ietf-mnat:egress-global-joined/watcher={self.watcher_id}',
             method='PUT',
-            data=data)
+            data=data,
+            callback=self.join_put_done)
+        self.joined = joined
         self.sendRequest(req)
 
+    def join_put_done(self, req):
+        status = self.responseStatus(req)
+        if status not in ('200', '201', '204'):
+            logger.warning(f'joined-sg PUT failed (status {status}), sending the whole list next time')
+            self.joined = None
+
+    def join_patch(self, joined, removes, adds):
+        edits = []
+        for sg in removes:
+            sg_id = self.joined[sg]
+            edits.append({
+                'edit-id': f'remove {sg_id}',
+                'operation': 'remove',
+                'target': f'/joined-sg={quote(sg_id, safe="")}'
+            })
+        for sg in adds:
+            sg_id = joined[sg]
+            edits.append({
+                'edit-id': f'add {sg_id}',
+                'operation': 'replace',
+                'target': f'/joined-sg={quote(sg_id, safe="")}',
+                'value': {'ietf-mnat:joined-sg': [self.joined_sg_json(sg, sg_id)]}
+            })
+        self.patch_count += 1
+        data = json.dumps({
+            'ietf-yang-patch:yang-patch': {
+              'patch-id': f'joins-{self.patch_count}',
+              'edit': edits
+            }
+          }).encode('utf-8')
+        req = RequestBuf(
+            path=f'/data/ietf-mnat:egress-global-joined/watcher={self.watcher_id}',
+            method='PATCH',
+            data=data,
+            content_type='application/yang-patch+json',
+            callback=self.join_patch_done)
+        self.joined = joined
+        self.sendRequest(req)
+
+    def join_patch_done(self, req):
+        status = self.responseStatus(req)
+        if status == '200':
+            return
+        if status in ('405', '415'):
+            logger.warning(f'server does not take yang-patch (status {status}), sending whole joined-sg lists')
+            self.use_patch = False
+        else:
+            logger.warning(f'joined-sg patch failed (status {status}): {req.response_data}')
+        # the later patches were made against a list the server may not
+        # have, so send the latest list in full
+        if self.joined is not None:
+            self.join_put(self.joined)
+
     def refresh_joins_from_file(self, in_file):
         global logger
         logger.info(f'refreshing joins from {in_file}')
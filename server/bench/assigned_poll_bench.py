@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+'''
+Server cost of a client's periodic assigned-channels poll: the full
+per-watcher list (GET assigned-channels/watcher=<id>) against the
+get-assigned-changes rpc, when nothing changed and when one (S,G)
+changed since the client's last generation.
+
+Times the handler functions plus the json encoding of their answer,
+and reports the response size.  Needs jetconf installed (the handlers
+import it).
+
+Run from the server directory:
+    python3 bench/assigned_poll_bench.py
+'''
+
+import sys
+import argparse
+import json
+from os import environ
+from os.path import abspath, dirname, join
+from time import perf_counter
+from ipaddress import ip_address
+
+environ.pop('MNAT_JOURNAL', None)
+environ['MNAT_INVARIANTS'] = 'off'
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', 'module'))
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', '..', 'common'))
+
+def time_poll(poll, reps):
+    start = perf_counter()
+    for i in range(reps):
+        body = json.dumps(poll())
+    return (perf_counter() - start) / reps, len(body)
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='full vs. delta assigned-channels polls')
+    parser.add_argument('-n', '--counts', type=int, nargs='+', default=[100, 1000, 10000],
+            help='subscribed (S,G)s of the polling watcher')
+    parser.add_argument('-r', '--reps', type=int, default=20,
+            help='polls timed per case')
+    args = parser.parse_args(args_in[1:])
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    from jetconf_mnat.assignments import Assignments, LocalPool
+    from jetconf_mnat import usr_state_data_handlers, usr_op_handlers
+
+    print(f'{"sgs":>6} {"poll":>10} {"us":>9} {"bytes":>8}')
+    for count in args.counts:
+        top = Assignments()
+        top.local_pool = LocalPool('(bench)', {'group-pool':{'ranges':[
+            {'group-range': '239.0.0.0/12', 'source-range': '10.9.1.2/32'}]}})
+        # the handlers use the module's assigned
+        usr_state_data_handlers.assigned = top
+        usr_op_handlers.assigned = top
+        ops = usr_op_handlers.OpHandlersContainer(None)
+
+        sgs = [(ip_address(0x0a000001), ip_address(0xe8000000 + i)) for i in range(count)]
+        top.set_subscribed_sgs('watcher', sgs)
+        generation = ops.get_assigned_changes_op({'watcher-id':'watcher'}, None)['generation']
+
+        def full():
+            return usr_state_data_handlers.generate_watcher_assignments('watcher')
+        def unchanged():
+            return ops.get_assigned_changes_op({'watcher-id':'watcher', 'generation':generation}, None)
+
+        for name, poll in (('full', full), ('unchanged', unchanged)):
+            us, size = time_poll(poll, args.reps)
+            print(f'{count:>6} {name:>10} {1e6*us:>9.1f} {size:>8}')
+
+        # one (S,G) swapped out since the client's generation
+        top.set_subscribed_sgs('watcher', sgs[1:] + [(ip_address(0x0a000001), ip_address(0xe8000000 + count))])
+        us, size = time_poll(unchanged, args.reps)
+        print(f'{count:>6} {"delta":>10} {1e6*us:>9.1f} {size:>8}')
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
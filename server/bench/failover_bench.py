@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+'''
+Active/standby failover: runs an active and a standby Assignments in
+two processes replicating over a unix socket, churns subscriptions on
+the active, kills it (SIGKILL), and reports how long the standby took
+to take over and whether it came up with the same global-to-local
+mapping for every (S,G).
+
+The takeover time is mostly the silence the standby waits for before
+deciding the active is gone (--takeover); the rest is the promotion.
+
+Run from the server directory:
+    python3 bench/failover_bench.py
+'''
+
+import sys
+import argparse
+import asyncio
+import json
+import multiprocessing
+import tempfile
+from os import environ, kill
+from os.path import abspath, dirname, join
+from signal import SIGKILL
+from time import time, perf_counter
+from ipaddress import ip_address
+
+environ.pop('MNAT_JOURNAL', None)
+environ['MNAT_INVARIANTS'] = 'off'
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', 'module'))
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', '..', 'common'))
+
+POOL = {'group-pool':{'ranges':[
+    {'group-range': '239.0.0.0/16', 'source-range': '10.9.1.2/32'}]}}
+
+def quiet():
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+def watcher_sgs(wnum, gen, sg_count):
+    return [(ip_address(0x0a000000 + wnum), ip_address(0xe8000000 + ((gen + i) % 0x10000)))
+            for i in range(sg_count)]
+
+def mapping(top):
+    '''{ global sg: local sg or None } as strings, for comparing across processes'''
+    mapped = {}
+    for gsg in top.subscribed_sgs.values():
+        local_sg = top.local_sg_of(gsg)
+        mapped[f'{gsg.sg[0]}->{gsg.sg[1]}'] = f'{local_sg[0]}->{local_sg[1]}' if local_sg else None
+    return mapped
+
+def run_active(address, watchers, sg_count, churn, events):
+    quiet()
+    from jetconf_mnat.assignments import Assignments
+    from jetconf_mnat.replication import ReplicationSource
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    top = Assignments()
+    for wnum in range(watchers):
+        top.set_subscribed_sgs(f'watcher-{wnum}', watcher_sgs(wnum, 0, sg_count))
+    top.replicas = ReplicationSource(top, address)
+    top.replicas.start(loop)
+    events.put(('listening', time()))
+
+    async def drive():
+        while not top.replicas.replicas:
+            await asyncio.sleep(0.01)
+        start = perf_counter()
+        for op in range(churn):
+            wnum = op % watchers
+            top.set_subscribed_sgs(f'watcher-{wnum}', watcher_sgs(wnum, 1 + op // watchers, sg_count))
+            top.refresh_watcher(f'watcher-{wnum}')
+            if op % 100 == 0:
+                await asyncio.sleep(0)
+        for writer in top.replicas.replicas:
+            await writer.drain()
+        events.put(('churned', perf_counter() - start, mapping(top)))
+
+    loop.create_task(drive())
+    loop.run_forever()
+
+def run_standby(address, takeover, events):
+    quiet()
+    from jetconf_mnat.assignments import Assignments
+    from jetconf_mnat.replication import ReplicationStandby
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    top = Assignments()
+    standby = None
+
+    def promoted():
+        promoted_at = time()
+        # and it takes changes now
+        top.set_subscribed_sgs('after-takeover', watcher_sgs(0xffff, 0, 1))
+        events.put(('promoted', promoted_at, standby.records_applied, mapping(top)))
+        loop.stop()
+
+    standby = ReplicationStandby(top, address, takeover, on_promote=promoted)
+    standby.start(loop)
+    loop.run_forever()
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='active/standby failover time and mapping continuity')
+    parser.add_argument('-w', '--watchers', type=int, default=200,
+            help='watchers on the active')
+    parser.add_argument('-s', '--sgs', type=int, default=50,
+            help='subscribed (S,G)s per watcher')
+    parser.add_argument('-c', '--churn', type=int, default=5000,
+            help='subscription changes on the active while the standby follows')
+    parser.add_argument('-t', '--takeover', type=float, default=1.0,
+            help='seconds of silence before the standby takes over')
+    args = parser.parse_args(args_in[1:])
+
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pool_fname = join(tmpdir, 'pool.json')
+        with open(pool_fname, 'w') as f:
+            json.dump(POOL, f)
+        environ['MNAT_POOL'] = pool_fname
+        address = f'unix:{join(tmpdir, "replication.sock")}'
+
+        # one queue each: killing the active could leave a shared one locked
+        active_events = ctx.Queue()
+        standby_events = ctx.Queue()
+        active = ctx.Process(target=run_active, args=(address, args.watchers, args.sgs, args.churn, active_events))
+        active.start()
+        assert active_events.get(timeout=60)[0] == 'listening'
+        standby = ctx.Process(target=run_standby, args=(address, args.takeover, standby_events))
+        standby.start()
+
+        ev, churn_seconds, active_mapping = active_events.get(timeout=600)
+        assert ev == 'churned'
+        killed_at = time()
+        kill(active.pid, SIGKILL)
+        active.join()
+
+        ev, promoted_at, records, standby_mapping = standby_events.get(timeout=60)
+        assert ev == 'promoted'
+        standby.join()
+
+    del(standby_mapping[f'{watcher_sgs(0xffff, 0, 1)[0][0]}->{watcher_sgs(0xffff, 0, 1)[0][1]}'])
+    same = sum(1 for sg, local in active_mapping.items() if standby_mapping.get(sg, False) == local)
+    print(f'active: {args.watchers} watchers, {len(active_mapping)} sgs, {args.churn} changes replicated in {churn_seconds:.2f}s ({records} records)')
+    print(f'takeover: {promoted_at - killed_at:.2f}s after kill (waiting {args.takeover}s of silence)')
+    print(f'mappings kept: {same}/{len(active_mapping)}, extra on standby: {len(set(standby_mapping) - set(active_mapping))}')
+    return 0 if same == len(active_mapping) == len(standby_mapping) else 1
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
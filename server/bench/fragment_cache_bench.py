@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+'''
+Server cost of the assigned-channels/watcher=<id> poll when many
+watchers map the same (S,G)s, the way every ingress watcher's monitor
+covers the same set: rendering each watcher's list from scratch, as
+before the fragment cache, against the cached per-GlobalSG fragments
+and per-watcher responses.
+
+Times generate_watcher_assignments for a sample of the watchers:
+  uncached: mapped_sg_json for every (S,G), every poll
+  first: a watcher's first poll, with the fragments already rendered
+    for other watchers
+  unchanged: a poll with nothing changed since the last one
+  changed: a poll after one new (S,G) showed up under every monitor
+Needs jetconf installed (the handlers import it).
+
+Run from the server directory:
+    python3 bench/fragment_cache_bench.py
+'''
+
+import sys
+import argparse
+from os import environ
+from os.path import abspath, dirname, join
+from time import perf_counter
+from ipaddress import ip_address
+
+environ.pop('MNAT_JOURNAL', None)
+environ['MNAT_INVARIANTS'] = 'off'
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', 'module'))
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', '..', 'common'))
+
+def time_polls(poll, watcher_ids):
+    start = perf_counter()
+    for wid in watcher_ids:
+        poll(wid)
+    return (perf_counter() - start) / len(watcher_ids)
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='assigned-channels poll with and without the fragment cache')
+    parser.add_argument('-w', '--watchers', type=int, default=1000,
+            help='watchers whose monitors cover every (S,G)')
+    parser.add_argument('-s', '--sgs', type=int, default=10000,
+            help='subscribed (S,G)s')
+    parser.add_argument('-p', '--polls', type=int, default=20,
+            help='watchers polled per case')
+    args = parser.parse_args(args_in[1:])
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    from jetconf_mnat.assignments import Assignments, LocalPool
+    from jetconf_mnat import usr_state_data_handlers
+    from jetconf_mnat.assigned_json import mapped_sg_json
+    from jetconf_mnat.usr_state_data_handlers import generate_watcher_assignments
+
+    top = Assignments()
+    top.local_pool = LocalPool('(bench)', {'group-pool':{'ranges':[
+        {'group-range': '239.0.0.0/12', 'source-range': '10.9.1.2/32'}]}})
+    # the handlers use the module's assigned
+    usr_state_data_handlers.assigned = top
+
+    start = perf_counter()
+    # monitors first, so each (S,G) gets indexed once as it's added
+    watcher_ids = [f'ingress-{wnum}' for wnum in range(args.watchers)]
+    for wid in watcher_ids:
+        top.set_monitors(wid, [{'id':'all', 'global-source-prefix':'10.0.0.0/8'}])
+    sgs = [(ip_address(0x0a000001), ip_address(0xe8000000 + i)) for i in range(args.sgs)]
+    top.set_subscribed_sgs('egress', sgs)
+    print(f'{args.watchers} watchers x {args.sgs} sgs set up in {perf_counter() - start:.1f}s')
+
+    polled = watcher_ids[:args.polls]
+    def uncached(wid):
+        return {'id': wid, 'mapped-sg': [mapped_sg_json(*m) for m in top.mapped_sgs(wid)]}
+    assert uncached(polled[0]) == generate_watcher_assignments(polled[0])
+    # a first poll of its own for each, with the fragments warm
+    for wid in polled:
+        top.watchers[wid].response_cache = None
+
+    print(f'{"poll":>10} {"us/poll":>10}')
+    for name, poll in (('uncached', uncached), ('first', generate_watcher_assignments),
+            ('unchanged', generate_watcher_assignments)):
+        print(f'{name:>10} {1e6*time_polls(poll, polled):>10.1f}')
+
+    top.set_subscribed_sgs('egress', sgs + [(ip_address(0x0a000001), ip_address(0xe8000000 + args.sgs))])
+    print(f'{"changed":>10} {1e6*time_polls(generate_watcher_assignments, polled):>10.1f}')
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+'''
+Throughput and latency of jetconf against jetconf_mnat.h2_server for
+the requests mnat clients keep making: each client connection loops
+over a PUT of its egress-global-joined watcher entry (one (S,G) of
+its joined list swapped for a new one) and a refresh-and-get-changes
+poll, one request at a time.
+
+Both servers run as subprocesses on localhost without TLS (jetconf's
+DISABLE_SSL, h2_server's --no-tls), logging at warning, with
+MNAT_INVARIANTS=off and no journal, so what's compared is the request
+handling.  The load comes from this process, which shares the
+machine with the server, so the server's own cpu time per request
+(from /proc, so linux only) is reported too: compare the two engines,
+not the absolute numbers.
+Needs jetconf installed for the jetconf runs.
+
+Run from the server directory:
+    python3 bench/h2_server_bench.py
+'''
+
+import sys
+import argparse
+import asyncio
+import json
+import socket
+import subprocess
+from os import environ, sysconf
+from os.path import abspath, dirname, join
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import ResponseReceived, DataReceived, StreamEnded, StreamReset, WindowUpdated
+
+server_dir = join(dirname(abspath(__file__)), '..')
+module_dir = join(server_dir, 'module')
+
+JETCONF_CONFIG = '''GLOBAL:
+    LOGFILE: "-"
+    PIDFILE: "{tmp}/jetconf.pid"
+    PERSISTENT_CHANGES: false
+    LOG_LEVEL: "warning"
+    YANG_LIB_DIR: "{server_dir}/files/yang-modules"
+    DATA_JSON_FILE: "{server_dir}/files/data-mnat.json"
+    BACKEND_PACKAGE: "jetconf_mnat"
+
+HTTP_SERVER:
+    DOC_ROOT: "{tmp}"
+    API_ROOT: "/mnat-ds"
+    PORT: {port}
+    DISABLE_SSL: true
+    DBG_DISABLE_CERT: true
+    LISTEN_LOCALHOST_ONLY: true
+
+NACM:
+    ENABLED: false
+'''
+
+class BenchConnection(asyncio.Protocol):
+    '''A minimal h2c client: request() returns the (status, body) of one request.'''
+    def __init__(self):
+        self.conn = H2Connection(config=H2Configuration(client_side=True, header_encoding='utf-8'))
+        self.transport = None
+        self.responses = {}  # { stream id: [future, status, body chunks] }
+        self.window_open = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, ResponseReceived):
+                self.responses[event.stream_id][1] = dict(event.headers)[':status']
+            elif isinstance(event, DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                self.responses[event.stream_id][2].append(event.data)
+            elif isinstance(event, StreamEnded):
+                fut, status, chunks = self.responses.pop(event.stream_id)
+                fut.set_result((status, b''.join(chunks)))
+            elif isinstance(event, StreamReset):
+                fut, status, chunks = self.responses.pop(event.stream_id)
+                fut.set_exception(RuntimeError(f'stream reset: {event.error_code}'))
+            elif isinstance(event, WindowUpdated):
+                if self.window_open:
+                    self.window_open.set()
+        self.transport.write(self.conn.data_to_send())
+
+    async def request(self, method, path, body=None):
+        stream_id = self.conn.get_next_available_stream_id()
+        headers = [(':method', method), (':authority', 'localhost'),
+                (':scheme', 'http'), (':path', path)]
+        if body:
+            headers += [('content-type', 'application/yang-data+json'),
+                    ('content-length', str(len(body)))]
+        fut = asyncio.get_running_loop().create_future()
+        self.responses[stream_id] = [fut, None, []]
+        self.conn.send_headers(stream_id, headers, end_stream=not body)
+        while body:
+            size = min(len(body), self.conn.local_flow_control_window(stream_id),
+                    self.conn.max_outbound_frame_size)
+            if not size:
+                self.transport.write(self.conn.data_to_send())
+                self.window_open = asyncio.Event()
+                await self.window_open.wait()
+                continue
+            self.conn.send_data(stream_id, body[:size], end_stream=size == len(body))
+            body = body[size:]
+        self.transport.write(self.conn.data_to_send())
+        return await fut
+
+def sg_json(client, i):
+    return {'id': str(i), 'source': f'10.1.{client >> 8}.{client & 255}',
+            'group': f'232.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}'}
+
+async def run_client(port, client, args, deadline, latencies):
+    loop = asyncio.get_running_loop()
+    transport, conn = await loop.create_connection(BenchConnection, 'localhost', port)
+    root = '/mnat-ds'
+
+    async def call(kind, method, path, value=None):
+        body = json.dumps(value).encode() if value is not None else None
+        start = perf_counter()
+        status, resp = await conn.request(method, root + path, body)
+        if not status.startswith('2'):
+            raise RuntimeError(f'{method} {path}: {status} {resp[:200]}')
+        latencies.setdefault(kind, []).append(perf_counter() - start)
+        return json.loads(resp) if resp else None
+
+    out = await call('get-new-watcher-id', 'POST', '/operations/ietf-mnat:get-new-watcher-id')
+    watcher_id = out['watcher-id']
+    sgs = [sg_json(client, i) for i in range(args.sgs)]
+    await call('post', 'POST', '/data/ietf-mnat:egress-global-joined',
+            {'ietf-mnat:watcher': {'id': watcher_id, 'joined-sg': sgs}})
+    generation = None
+    step = args.sgs
+    while perf_counter() < deadline:
+        sgs = sgs[1:] + [sg_json(client, step)]
+        step += 1
+        await call('put', 'PUT', f'/data/ietf-mnat:egress-global-joined/watcher={watcher_id}',
+                {'ietf-mnat:watcher': {'id': watcher_id, 'joined-sg': sgs}})
+        poll_input = {'watcher-id': watcher_id}
+        if generation:
+            poll_input['generation'] = generation
+        out = await call('poll', 'POST', '/operations/ietf-mnat:refresh-and-get-changes',
+                {'ietf-mnat:input': poll_input})
+        generation = out.get('generation')
+    transport.close()
+
+async def run_load(port, args):
+    latencies = {}
+    start = perf_counter()
+    deadline = start + args.seconds
+    await asyncio.gather(*[run_client(port, client, args, deadline, latencies)
+            for client in range(args.clients)])
+    return perf_counter() - start, latencies
+
+def wait_for_port(port, proc, timeout=60):
+    end = perf_counter() + timeout
+    while perf_counter() < end:
+        if proc.poll() is not None:
+            raise RuntimeError(f'server exited with {proc.returncode}')
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.2)
+    raise RuntimeError(f'server not listening on port {port} after {timeout}s')
+
+def start_server(engine, port, tmp):
+    env = dict(environ)
+    env.pop('MNAT_JOURNAL', None)
+    env['MNAT_INVARIANTS'] = 'off'
+    env['MNAT_POOL'] = join(tmp, 'pool.json')
+    env['PYTHONPATH'] = ':'.join([module_dir, join(server_dir, '..', 'common'), env.get('PYTHONPATH', '')])
+    if engine == 'jetconf':
+        config = join(tmp, 'jetconf.yaml')
+        with open(config, 'w') as f:
+            f.write(JETCONF_CONFIG.format(tmp=tmp, server_dir=server_dir, port=port))
+        cmd = [sys.executable, '-m', 'jetconf', '-c', config]
+    else:
+        cmd = [sys.executable, '-m', 'jetconf_mnat.h2_server', '--no-tls',
+                '--listen', 'localhost', '--port', str(port)]
+    return subprocess.Popen(cmd, env=env, cwd=tmp, stdout=subprocess.DEVNULL)
+
+def cpu_seconds(pid):
+    '''user + system cpu time of the process so far'''
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rpartition(')')[2].split()
+    # utime and stime, the 14th and 15th fields of stat
+    return (int(fields[11]) + int(fields[12])) / sysconf('SC_CLK_TCK')
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='jetconf vs. h2_server request throughput and latency')
+    parser.add_argument('-e', '--engines', nargs='+', default=['jetconf', 'h2'],
+            choices=['jetconf', 'h2'])
+    parser.add_argument('-c', '--clients', type=int, default=20,
+            help='client connections, each with one request in flight')
+    parser.add_argument('-n', '--sgs', type=int, default=10,
+            help='joined (S,G)s per client')
+    parser.add_argument('-s', '--seconds', type=float, default=10)
+    parser.add_argument('-p', '--port', type=int, default=18443)
+    args = parser.parse_args(args_in[1:])
+
+    print(f'{"engine":>8} {"request":>8} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"cpu us/req":>10}')
+    for engine in args.engines:
+        with TemporaryDirectory() as tmp:
+            with open(join(tmp, 'pool.json'), 'w') as f:
+                json.dump({'group-pool': {'ranges': [
+                    {'group-range': '239.0.0.0/12', 'source-range': '10.9.1.2/32'}]}}, f)
+            proc = start_server(engine, args.port, tmp)
+            try:
+                wait_for_port(args.port, proc)
+                cpu_start = cpu_seconds(proc.pid)
+                elapsed, latencies = asyncio.run(run_load(args.port, args))
+                cpu = cpu_seconds(proc.pid) - cpu_start
+            finally:
+                proc.terminate()
+                proc.wait()
+        requests = sum(len(times) for times in latencies.values())
+        for kind in ('put', 'poll'):
+            times = sorted(latencies.get(kind, []))
+            if not times:
+                continue
+            print(f'{engine:>8} {kind:>8} {len(times)/elapsed:>8.1f} '
+                    f'{1e3*percentile(times, 0.5):>8.2f} {1e3*percentile(times, 0.99):>8.2f}'
+                    f' {1e6*cpu/requests:>10.0f}')
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+'''
+Cpu time the logging on the hot paths costs at verbosity 0 (warning
+and up only, the default for the clients and h2_server), where every
+info and debug message is dropped and anything spent formatting them
+is waste.
+
+Server cases run against an in-memory Assignments with invariant
+checks off:
+ * put: an egress replacing its joined list (one (S,G) of --sgs
+   swapped for a new one, so a return and a borrow)
+ * refresh: the refresh-watcher-id rpc
+ * poll: refresh-and-get-changes with nothing changed
+Client cases run an H2Protocol from mnat.common_client over a real
+H2Connection with the bytes thrown away:
+ * request: sending a request with a 1k json body
+ * response: receiving a 4k data frame of a response
+ * apply: applying a full get-assigned-changes of --sgs mappings
+   (with the translators left out)
+
+Each reports cpu microseconds per op (process time, so not wall
+clock).  Run it on two trees to compare before and after a change.
+Needs the mnat.common_client dependencies (twisted, h2, psutil).
+
+Run from the server directory:
+    python3 bench/log_overhead_bench.py
+'''
+
+import sys
+import argparse
+import json
+import logging
+import tempfile
+from os import environ
+from os.path import abspath, dirname, join
+from time import process_time
+from ipaddress import ip_address
+
+environ.pop('MNAT_JOURNAL', None)
+environ['MNAT_INVARIANTS'] = 'off'
+
+server_dir = join(dirname(abspath(__file__)), '..')
+sys.path.insert(0, join(server_dir, 'module'))
+sys.path.insert(0, join(server_dir, '..', 'common'))
+
+POOL = {'group-pool':{'ranges':[
+    {'group-range': '239.0.0.0/12', 'source-range': '10.9.1.2/32'}]}}
+
+def joined_sgs(gen, sg_count):
+    return [(ip_address('10.1.1.1'), ip_address(0xe8000000 + gen + i)) for i in range(sg_count)]
+
+def cpu_us(fn, ops):
+    '''cpu microseconds per call of fn(op) for op in range(ops)'''
+    start = process_time()
+    for op in range(ops):
+        fn(op)
+    return 1e6 * (process_time() - start) / ops
+
+def server_cases(args):
+    from jetconf_mnat.assignments import Assignments
+    from jetconf_mnat import rpcs
+    top = Assignments()
+    wid = 'bench-watcher'
+    top.set_subscribed_sgs(wid, joined_sgs(0, args.sgs))
+    generation = [None]
+
+    def put(op):
+        top.set_subscribed_sgs(wid, joined_sgs(op + 1, args.sgs))
+    def refresh(op):
+        rpcs.refresh_watcher_id(top, {'watcher-id': wid})
+    def poll(op):
+        if op == 0:
+            # caught up after the puts, so the rest are unchanged
+            generation[0] = rpcs.refresh_and_get_changes(top, {'watcher-id': wid})['generation']
+        rpcs.refresh_and_get_changes(top, {'watcher-id': wid, 'generation': generation[0]})
+    return [('put', put, args.ops // 10), ('refresh', refresh, args.ops), ('poll', poll, args.ops)]
+
+class SinkTransport(object):
+    def write(self, data):
+        pass
+
+def client_cases(args):
+    from h2.connection import H2Connection
+    from mnat.common_client import get_logger, RequestBuf, H2Protocol, Mapping, LocalAssignment
+
+    class BenchProtocol(H2Protocol):
+        def polledLatestMappings(self, mappings):
+            pass
+
+    proto = BenchProtocol('localhost', 8443, get_logger('mnat-bench', 0), None, None)
+    proto.restart_check.stop()
+    proto.transport = SinkTransport()
+    proto.settings_acked = True
+
+    def fresh_connection():
+        proto.conn = H2Connection()
+        proto.conn.initiate_connection()
+        proto.conn.data_to_send()
+        proto.request_table = {}
+
+    body = json.dumps({'ietf-mnat:input': {'ietf-mnat:watcher-id': 'X' * 16,
+        'padding': 'x' * 960}}).encode()
+    def request(op):
+        if op % 500 == 0:
+            # so h2's table of open streams doesn't keep growing
+            fresh_connection()
+        proto.sendRequest(RequestBuf(path='/operations/ietf-mnat:refresh-and-get-changes',
+            method='POST', data=body, content_type='application/yang-data+json'))
+
+    chunk = json.dumps({'x': 'y' * 4090}).encode()
+    def response(op):
+        req = RequestBuf(path='/data/ietf-mnat:assigned-channels')
+        proto.request_table[1] = req
+        proto.handleData(1, chunk, False)
+
+    mappings = [Mapping(str(src), str(grp), LocalAssignment('assigned-local-multicast',
+            {'source': '10.9.1.2', 'group': str(ip_address(0xef000000 + i))}))
+            for i, (src, grp) in enumerate(joined_sgs(0, args.sgs))]
+    def apply(op):
+        proto.applyAssignedChanges(f'gen.{op}', 'full', mappings, [])
+
+    fresh_connection()
+    return [('request', request, args.ops), ('response', response, args.ops),
+            ('apply', apply, args.ops // 10)]
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='cpu cost of hot-path logging at verbosity 0')
+    parser.add_argument('-n', '--ops', type=int, default=5000,
+            help='ops per case (a tenth of that for put and apply)')
+    parser.add_argument('--sgs', type=int, default=1000,
+            help='joined (S,G)s for put and mappings for apply')
+    args = parser.parse_args(args_in[1:])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pool_fname = join(tmp, 'pool.json')
+        with open(pool_fname, 'w') as f:
+            json.dump(POOL, f)
+        environ['MNAT_POOL'] = pool_fname
+        logging.basicConfig(level=logging.WARNING)
+
+        print(f'{"side":>6} {"case":>9} {"ops":>7} {"cpu us/op":>10}')
+        for side, cases in (('server', server_cases), ('client', client_cases)):
+            for name, fn, ops in cases(args):
+                print(f'{side:>6} {name:>9} {ops:>7} {cpu_us(fn, ops):>10.2f}')
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
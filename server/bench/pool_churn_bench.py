@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+'''
+Churn benchmark for the LocalPool free-slot allocator.
+
+Fills a pool to a target utilization through borrow_local_sg, then
+alternates returning a random assigned (S,G) and borrowing a new one,
+reporting the per-operation latency.  With the Fenwick free-slot index
+both stay O(log n), so a 90%-full pool of a million entries still
+assigns in microseconds.
+
+Run from the server directory:
+    python3 bench/pool_churn_bench.py
+'''
+
+import sys
+import argparse
+import logging
+from os.path import abspath, dirname, join
+from time import perf_counter
+from random import randrange
+from ipaddress import ip_address
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', 'module'))
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', '..', 'common'))
+from jetconf_mnat.assignments import LocalPool, GlobalSG, sg_key
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='LocalPool borrow/return churn at high utilization')
+    parser.add_argument('-g', '--group-range', default='239.0.0.0/12',
+            help='group range of the pool (default is 2^20 entries)')
+    parser.add_argument('-u', '--utilization', type=float, default=0.9,
+            help='fraction of the pool to fill before churning')
+    parser.add_argument('-n', '--churn', type=int, default=100000,
+            help='return+borrow pairs to time once filled')
+    args = parser.parse_args(args_in[1:])
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    pool = LocalPool('(bench)', {'group-pool':{'ranges':[
+        {'group-range': args.group_range, 'source-range': '10.9.1.2/32'}]}})
+    fill = int(pool.sg_count * args.utilization)
+    print(f'pool of {pool.sg_count}, filling to {fill}')
+
+    src = ip_address('203.0.113.1')
+    gsg_id = 0
+    def next_gsg():
+        nonlocal gsg_id
+        gsg_id += 1
+        return GlobalSG(sg_key((src, ip_address(0xe8000000 + gsg_id))), gsg_id)
+
+    local_sgs = []
+    start = perf_counter()
+    for i in range(fill):
+        local_sgs.append(pool.borrow_local_sg(next_gsg()))
+    fill_time = perf_counter() - start
+    print(f'fill: {fill} borrows in {fill_time:.2f}s ({1e6*fill_time/fill:.1f} us/borrow)')
+
+    return_time = 0
+    borrow_time = 0
+    for i in range(args.churn):
+        pos = randrange(len(local_sgs))
+        sg = local_sgs[pos]
+        start = perf_counter()
+        pool.return_local_sg(sg)
+        mid = perf_counter()
+        local_sgs[pos] = pool.borrow_local_sg(next_gsg())
+        end = perf_counter()
+        return_time += mid - start
+        borrow_time += end - mid
+
+    print(f'churn at {100*len(pool.assigned_idxs)/pool.sg_count:.1f}% full: {args.churn} pairs, {1e6*return_time/args.churn:.1f} us/return, {1e6*borrow_time/args.churn:.1f} us/borrow')
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
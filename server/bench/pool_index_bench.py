@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+'''
+Microbenchmark for LocalPool.borrow_local_sg across pool sizes.
+
+Borrow latency should stay flat from a /29 up to a /8 (and for ipv6
+pools), since picking an index and turning it into a local (S,G) is
+integer math rather than a walk of ip_network.hosts().
+
+Run from the server directory:
+    python3 bench/pool_index_bench.py
+'''
+
+import sys
+import argparse
+from os.path import abspath, dirname, join
+from time import perf_counter
+from ipaddress import ip_address
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', 'module'))
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', '..', 'common'))
+from jetconf_mnat.assignments import LocalPool, GlobalSG, sg_key
+
+POOLS = [
+    ('239.1.1.0/29', '10.9.1.2/32'),
+    ('239.1.0.0/24', '10.9.1.2/32'),
+    ('239.1.0.0/16', '10.9.1.2/32'),
+    ('239.0.0.0/12', '10.9.1.2/32'),
+    ('232.0.0.0/8', '10.9.1.2/32'),
+    ('232.0.0.0/8', '10.9.0.0/16'),
+    ('ff3e::/96', '2001:db8::/64'),
+]
+
+def bench_pool(group_range, source_range, count):
+    pool = LocalPool('(bench)', {'group-pool':{'ranges':[
+        {'group-range': group_range, 'source-range': source_range}]}})
+    # stay well clear of exhaustion, that's not what this measures
+    count = max(1, min(count, pool.sg_count // 4))
+    gsgs = [GlobalSG(sg_key((ip_address('203.0.113.1'), ip_address(0xe8010000 + i))), i)
+            for i in range(count)]
+    start = perf_counter()
+    for gsg in gsgs:
+        pool.borrow_local_sg(gsg)
+    borrow_time = perf_counter() - start
+    return pool.sg_count, count, borrow_time
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='LocalPool borrow latency by pool size')
+    parser.add_argument('-n', '--count', type=int, default=200,
+            help='borrows per pool (capped at a quarter of the pool size)')
+    args = parser.parse_args(args_in[1:])
+
+    # keep the per-borrow info logging out of the measurement
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f'{"group-range":>16} {"source-range":>16} {"pool size":>22} {"borrows":>8} {"us/borrow":>10}')
+    for group_range, source_range in POOLS:
+        sg_count, count, borrow_time = bench_pool(group_range, source_range, args.count)
+        print(f'{group_range:>16} {source_range:>16} {sg_count:>22} {count:>8} {1e6*borrow_time/count:>10.1f}')
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+'''
+Compares the fenwick and sparse free-slot tracking in LocalPool on
+ipv6 group pools from a /120 up to a /32 of groups.
+
+For each pool and tracking mode it borrows a batch of local (S,G)s
+(random and hashed allocation), then reports the time per borrow and
+the memory the free-slot index holds per assignment (its container
+plus the ints in it, by sys.getsizeof).  Fenwick memory grows with log of the pool size per
+assignment, sparse memory doesn't.
+
+Run from the server directory:
+    python3 bench/sparse_pool_bench.py
+'''
+
+import sys
+import argparse
+from os.path import abspath, dirname, join
+from time import perf_counter
+from ipaddress import ip_address
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', 'module'))
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', '..', 'common'))
+from jetconf_mnat.assignments import LocalPool, GlobalSG, sg_key
+
+GROUP_RANGES = [
+    'ff3e::/120',
+    'ff3e::/96',
+    'ff3e::/64',
+    'ff3e::/32',
+]
+
+def bench_pool(group_range, tracking, allocation, count):
+    pool = LocalPool('(bench)', {'group-pool':{
+        'allocation': allocation,
+        'slot-tracking': tracking,
+        'ranges':[{'group-range': group_range, 'source-range': 'keep'}]}})
+    count = max(1, min(count, pool.sg_count // 4))
+    gsgs = [GlobalSG(sg_key((ip_address('2001:db8::1'), ip_address(f'ff3e::8000:0:{i>>16:x}:{i&0xffff:x}'))), i)
+            for i in range(count)]
+
+    start = perf_counter()
+    for gsg in gsgs:
+        pool.borrow_local_sg(gsg)
+    borrow_time = perf_counter() - start
+    return count, borrow_time, index_bytes(pool.free_slots)
+
+def index_bytes(free_slots):
+    '''
+    memory held by the free-slot index, not counting what's shared with
+    the rest of LocalPool (assigned_sgs/assigned_idxs are the same for
+    both tracking modes)
+    '''
+    if isinstance(free_slots.used, set):
+        return sys.getsizeof(free_slots.used) + sum(sys.getsizeof(idx) for idx in free_slots.used)
+    tree = free_slots.tree
+    return sys.getsizeof(tree) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in tree.items())
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='LocalPool fenwick vs. sparse slot tracking on ipv6 pools')
+    parser.add_argument('-n', '--count', type=int, default=20000,
+            help='borrows per pool (capped at a quarter of the pool size)')
+    args = parser.parse_args(args_in[1:])
+
+    # keep the per-borrow info logging out of the measurement
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f'{"group-range":>12} {"tracking":>8} {"allocation":>10} {"borrows":>8} {"us/borrow":>10} {"bytes/assigned":>15}')
+    for group_range in GROUP_RANGES:
+        for tracking in ['fenwick', 'sparse']:
+            for allocation in ['random', 'hashed']:
+                count, borrow_time, nbytes = bench_pool(
+                        group_range, tracking, allocation, args.count)
+                print(f'{group_range:>12} {tracking:>8} {allocation:>10} {count:>8} {1e6*borrow_time/count:>10.1f} {nbytes/count:>15.0f}')
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+'''
+Memory held by the server state per subscribed (S,G).
+
+Subscribes count global (S,G)s spread over a set of watchers, each
+getting a local (S,G) from a pool big enough to hold them all, and
+reports how much the process grew per subscribed (S,G): in total, and
+without the pool's free-slot index (which depends on the pool size and
+slot-tracking more than on the state model; see sparse_pool_bench.py).
+
+Growth is measured as the change in peak RSS, each count in a fresh
+process (tracemalloc's own bookkeeping doesn't fit at 1M).
+
+Run from the server directory:
+    python3 bench/state_memory_bench.py
+'''
+
+import sys
+import argparse
+import gc
+import resource
+import multiprocessing
+from os import environ
+from os.path import abspath, dirname, join
+from time import perf_counter
+from ipaddress import ip_address
+
+# no journal or invariant checking, just the state itself
+environ.pop('MNAT_JOURNAL', None)
+environ['MNAT_INVARIANTS'] = 'off'
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', 'module'))
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', '..', 'common'))
+
+def peak_rss():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def index_bytes(free_slots):
+    if isinstance(free_slots.used, set):
+        return sys.getsizeof(free_slots.used) + sum(sys.getsizeof(idx) for idx in free_slots.used)
+    tree = free_slots.tree
+    return sys.getsizeof(tree) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in tree.items())
+
+def bench_state(count, watcher_count):
+    # keep the per-subscription info logging out of the measurement
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    from jetconf_mnat.assignments import Assignments, LocalPool
+
+    top = Assignments()
+    top.local_pool = LocalPool('(bench)', {'group-pool':{'ranges':[
+        {'group-range': '232.0.0.0/8', 'source-range': '10.9.0.0/28'}]}})
+
+    gc.collect()
+    before = peak_rss()
+    start = perf_counter()
+    for wnum in range(watcher_count):
+        sgs = [(ip_address(0xcb007100 + (i & 0xff)), ip_address(0xe8000000 + (i >> 8)))
+                for i in range(wnum, count, watcher_count)]
+        top.set_subscribed_sgs(f'watcher-{wnum}', sgs)
+        del(sgs)
+    elapsed = perf_counter() - start
+    gc.collect()
+    used = peak_rss() - before
+    assert len(top.subscribed_sgs) == count
+    return used, index_bytes(top.local_pool.free_slots), elapsed
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='server state memory per subscribed (S,G)')
+    parser.add_argument('-n', '--counts', type=int, nargs='+', default=[100000, 1000000],
+            help='subscribed (S,G) counts to measure')
+    parser.add_argument('-w', '--watchers', type=int, default=100,
+            help='watchers the (S,G)s are spread across')
+    args = parser.parse_args(args_in[1:])
+
+    ctx = multiprocessing.get_context('spawn')
+    print(f'{"sgs":>9} {"watchers":>8} {"MB":>8} {"bytes/sg":>9} {"w/o index":>10} {"us/sg":>7}')
+    for count in args.counts:
+        with ctx.Pool(1) as pool:
+            used, index_used, elapsed = pool.apply(bench_state, (count, args.watchers))
+        print(f'{count:>9} {args.watchers:>8} {used/1e6:>8.1f} {used/count:>9.0f} {(used-index_used)/count:>10.0f} {1e6*elapsed/count:>7.1f}')
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+'''
+How many watchers and (S,G)s one mnat-server handles before its
+answers slow down: simulated egress and ingress watchers, each an
+H2Protocol client from mnat.common_client on its own HTTP/2
+connection, against a local server.
+
+Each simulated watcher gets a watcher-id and then polls on the
+client's own timers (shortened with --poll-period, --refresh-period),
+refreshing with refresh-and-get-changes when the server has it or
+separate refresh-watcher-id calls (--separate-refresh).  An egress
+POSTs its egress-global-joined entry with its share of joined (S,G)s
+and every --churn-period seconds swaps --churn of them for others and
+PUTs the whole list; an ingress POSTs an ingress-watching entry that
+monitors all the egresses' sources, so it maps every joined (S,G).
+Nothing is translated: the mappings are only counted.
+
+The load runs in stages of <watchers>x<sgs per egress>, adding
+watchers as it goes, and reports per stage the p50/p99 latency of each
+request type from send to response, the server's cpu use and memory
+(rss), and the cpu use of this process, which shares the machine with
+the server: when it's near 100% the numbers say more about the load
+generator than the server.
+
+By default it starts jetconf_mnat.h2_server (--engine h2) or jetconf
+(--engine jetconf, needs jetconf installed) with a fresh pool and a
+throwaway self-signed cert (needs openssl), passing the MNAT_*
+environment through; --server/--server-pid point it at a running one
+instead.  Needs the mnat.common_client dependencies (twisted, h2,
+psutil).
+
+Run from the server directory:
+    python3 bench/watcher_load_bench.py --stages 10x10 100x10 100x100
+'''
+
+import sys
+import argparse
+import json
+import random
+import socket
+import subprocess
+from os import environ
+from os.path import abspath, dirname, join
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+server_dir = join(dirname(abspath(__file__)), '..')
+module_dir = join(server_dir, 'module')
+sys.path.insert(0, join(server_dir, '..', 'common'))
+
+JETCONF_CONFIG = '''GLOBAL:
+    LOGFILE: "-"
+    PIDFILE: "{tmp}/jetconf.pid"
+    PERSISTENT_CHANGES: false
+    LOG_LEVEL: "warning"
+    YANG_LIB_DIR: "{server_dir}/files/yang-modules"
+    DATA_JSON_FILE: "{server_dir}/files/data-mnat.json"
+    BACKEND_PACKAGE: "jetconf_mnat"
+
+HTTP_SERVER:
+    DOC_ROOT: "{tmp}"
+    API_ROOT: "/mnat-ds"
+    PORT: {port}
+    SERVER_SSL_CERT: "{cert}"
+    SERVER_SSL_PRIVKEY: "{key}"
+    CA_CERT: "{cert}"
+    DBG_DISABLE_CERT: true
+
+NACM:
+    ENABLED: false
+'''
+
+def parse_stage(text):
+    watchers, sep, sgs = text.partition('x')
+    if not sep or not watchers.isdigit() or not sgs.isdigit():
+        raise argparse.ArgumentTypeError(f'bad stage "{text}" (expected <watchers>x<sgs>)')
+    return int(watchers), int(sgs)
+
+def request_name(req):
+    '''the rpc, or the method and data resource, of a request'''
+    path = req.path.split('?', 1)[0]
+    if path.startswith('/operations/'):
+        return path[len('/operations/'):].partition(':')[2]
+    resource = path[len('/data/'):].partition(':')[2].partition('/')[0]
+    return f'{req.method} {resource}'
+
+def channel(i):
+    return ('10.0.0.1', f'232.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}')
+
+class LoadStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.latencies = {}  # { request name: [seconds] }
+        self.errors = {}     # { request name: count }
+        self.reconnects = 0
+
+    def record(self, name, seconds, status):
+        if status and status.startswith('2'):
+            self.latencies.setdefault(name, []).append(seconds)
+        else:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def make_cert(tmp):
+    cert, key = join(tmp, 'cert.pem'), join(tmp, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost',
+            '-addext', 'subjectAltName=DNS:localhost'],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+def start_server(engine, port, tmp, cert, key):
+    env = dict(environ)
+    env['MNAT_POOL'] = join(tmp, 'pool.json')
+    env['PYTHONPATH'] = ':'.join([module_dir, join(server_dir, '..', 'common'), env.get('PYTHONPATH', '')])
+    with open(env['MNAT_POOL'], 'w') as f:
+        json.dump({'group-pool': {'ranges': [
+            {'group-range': '239.0.0.0/12', 'source-range': '10.9.1.2/32'}]}}, f)
+    if engine == 'jetconf':
+        config = join(tmp, 'jetconf.yaml')
+        with open(config, 'w') as f:
+            f.write(JETCONF_CONFIG.format(tmp=tmp, server_dir=server_dir, port=port, cert=cert, key=key))
+        cmd = [sys.executable, '-m', 'jetconf', '-c', config]
+    else:
+        cmd = [sys.executable, '-m', 'jetconf_mnat.h2_server', '--port', str(port),
+                '--cert', cert, '--key', key]
+    proc = subprocess.Popen(cmd, env=env, cwd=tmp, stdout=subprocess.DEVNULL)
+    end = perf_counter() + 60
+    while perf_counter() < end:
+        if proc.poll() is not None:
+            raise RuntimeError(f'server exited with {proc.returncode}')
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return proc
+        except OSError:
+            sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f'server not listening on port {port} after 60s')
+
+def run_load(args, server_pid, cacert):
+    import psutil
+    from twisted.internet import reactor, task
+    from mnat.common_client import get_logger, RequestBuf, H2Protocol
+
+    logger = get_logger('mnat-load', args.verbose)
+    stats = LoadStats()
+    rng = random.Random(args.seed)
+    universe = max(args.channels, max(sgs for watchers, sgs in args.stages))
+    host, sep, port = args.server.rpartition(':')
+
+    class SimWatcher(H2Protocol):
+        '''an H2Protocol client that times its requests and translates nothing'''
+        connections = 0
+        mapped = 0
+
+        def sendRequest(self, req):
+            sent_at = perf_counter()
+            callback = req.callback
+            def timed(req):
+                stats.record(request_name(req), perf_counter() - sent_at, self.responseStatus(req))
+                if callback:
+                    callback(req)
+            req.callback = timed
+            super().sendRequest(req)
+
+        def connectionMade(self):
+            self.connections += 1
+            if self.connections > 1:
+                stats.reconnects += 1
+            super().connectionMade()
+
+        def connectionLost(self, reason=None):
+            # the base class stops the reactor when a shut down
+            # connection goes away, here that's the end of the run
+            if self.shutting_down:
+                self.conn = None
+                self.transport = None
+                return
+            super().connectionLost(reason)
+
+        def setupWatcher(self):
+            if args.separate_refresh:
+                self.use_refresh_and_get_changes = False
+            # a refresh only every dead_threshold (the server's 20s)
+            # now and then gets its answer just after restartIfDead
+            # looks for it, under load
+            self.refresh_period = args.refresh_period or \
+                    min(self.refresh_period, self.dead_threshold.total_seconds() / 2)
+            if not self.use_refresh_and_get_changes:
+                self.startRefreshing()
+
+        def startPolling(self, period, now=True):
+            if args.full_polls:
+                self.use_assigned_changes = False
+            super().startPolling(period, now)
+
+        def establishSubscription(self):
+            # polls are the load here
+            self.use_push = False
+
+        def polledLatestMappings(self, mappings):
+            self.mapped = len(mappings)
+
+    class SimEgress(SimWatcher):
+        def __init__(self, *a, **kw):
+            super().__init__(*a, **kw)
+            self.sgs = []
+            self.churn_task = None
+
+        def joined_json(self):
+            return {'ietf-mnat:watcher': {'id': self.watcher_id, 'joined-sg': [
+                {'id': f'{s},{g}', 'source': s, 'group': g}
+                for s, g in (channel(i) for i in self.sgs)]}}
+
+        def set_sg_count(self, count):
+            if count > len(self.sgs):
+                have = set(self.sgs)
+                self.sgs += [i for i in rng.sample(range(universe), count) if i not in have][:count - len(self.sgs)]
+            else:
+                del(self.sgs[count:])
+
+        def setupWatcher(self):
+            super().setupWatcher()
+            self.sendRequest(RequestBuf(path='/data/ietf-mnat:egress-global-joined', method='POST',
+                    data=json.dumps(self.joined_json()).encode('utf-8')))
+            if not self.churn_task and args.churn:
+                self.churn_task = task.LoopingCall(self.churn)
+                self.churn_task.start(args.churn_period, now=False)
+
+        def churn(self):
+            if not self.watcher_id or self.restarting_deferred or self.shutting_down:
+                return
+            have = set(self.sgs)
+            for n in range(min(args.churn, len(self.sgs))):
+                new = rng.randrange(universe)
+                if new not in have:
+                    have.add(new)
+                    self.sgs[rng.randrange(len(self.sgs))] = new
+            self.sendRequest(RequestBuf(path=f'/data/ietf-mnat:egress-global-joined/watcher={self.watcher_id}',
+                    method='PUT', data=json.dumps(self.joined_json()).encode('utf-8')))
+
+    class SimIngress(SimWatcher):
+        def setupWatcher(self):
+            super().setupWatcher()
+            data = {'ietf-mnat:watcher': {'id': self.watcher_id, 'monitor': [
+                {'id': '0', 'global-source-prefix': '10.0.0.0/8'}]}}
+            self.sendRequest(RequestBuf(path='/data/ietf-mnat:ingress-watching', method='POST',
+                    data=json.dumps(data).encode('utf-8')))
+
+    def new_watcher(cls):
+        w = cls(host, int(port), logger, None, cacert)
+        w.poll_period = args.poll_period
+        return w
+
+    watchers = []
+    server = psutil.Process(server_pid) if server_pid else None
+    me = psutil.Process()
+
+    def cpu(proc):
+        times = proc.cpu_times()
+        return times.user + times.system
+
+    print(f'{"stage":>9} {"request":>28} {"count":>7} {"req/s":>7} {"p50 ms":>8} {"p99 ms":>8} {"errors":>6}')
+
+    def start_stage(idx):
+        count, sgs = args.stages[idx]
+        ingresses = [w for w in watchers if isinstance(w, SimIngress)]
+        while len(watchers) < count:
+            is_ingress = len(ingresses) < args.ingresses
+            w = new_watcher(SimIngress if is_ingress else SimEgress)
+            if is_ingress:
+                ingresses.append(w)
+            watchers.append(w)
+            # spread out the connection setup
+            reactor.callLater(args.ramp * rng.random(), w.start)
+        for w in watchers:
+            if isinstance(w, SimEgress):
+                w.set_sg_count(sgs)
+                if w.watcher_id and w.settings_acked:
+                    w.sendRequest(RequestBuf(path=f'/data/ietf-mnat:egress-global-joined/watcher={w.watcher_id}',
+                            method='PUT', data=json.dumps(w.joined_json()).encode('utf-8')))
+        reactor.callLater(args.ramp + args.warmup, measure_stage, idx)
+
+    def measure_stage(idx):
+        stats.reset()
+        start = (perf_counter(), cpu(server) if server else 0, cpu(me))
+        reactor.callLater(args.seconds, end_stage, idx, start)
+
+    def end_stage(idx, start):
+        elapsed = perf_counter() - start[0]
+        count, sgs = args.stages[idx]
+        label = f'{count}x{sgs}'
+        for name in sorted(set(stats.latencies) | set(stats.errors)):
+            times = sorted(stats.latencies.get(name, []))
+            p50 = f'{1e3*percentile(times, 0.5):>8.2f}' if times else f'{"-":>8}'
+            p99 = f'{1e3*percentile(times, 0.99):>8.2f}' if times else f'{"-":>8}'
+            print(f'{label:>9} {name:>28} {len(times):>7} {len(times)/elapsed:>7.1f} {p50} {p99} {stats.errors.get(name, 0):>6}')
+        mapped = sum(w.mapped for w in watchers if isinstance(w, SimEgress))
+        summary = f'{label:>9} {mapped} egress mappings, {stats.reconnects} reconnects, client cpu {100*(cpu(me)-start[2])/elapsed:.0f}%'
+        if server:
+            summary += f', server cpu {100*(cpu(server)-start[1])/elapsed:.0f}% rss {server.memory_info().rss/(1<<20):.1f}MB'
+        print(summary)
+        sys.stdout.flush()
+        if idx + 1 < len(args.stages):
+            start_stage(idx + 1)
+        else:
+            for w in watchers:
+                w.shutting_down = True
+            reactor.stop()
+
+    reactor.callWhenRunning(start_stage, 0)
+    reactor.run()
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='simulated mnat watchers against a local server')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('--stages', type=parse_stage, nargs='+', default=[(10, 10), (100, 10), (100, 100)],
+            help='<watchers>x<joined sgs per egress> for each stage, in order of watcher count')
+    parser.add_argument('--ingresses', type=int, default=1,
+            help='how many of the watchers are ingresses')
+    parser.add_argument('--channels', type=int, default=10000,
+            help='distinct (S,G)s the egresses pick their joins from')
+    parser.add_argument('--churn', type=int, default=1,
+            help='joined (S,G)s each egress swaps per churn period (0: no PUTs after the first)')
+    parser.add_argument('--churn-period', type=float, default=5)
+    parser.add_argument('--poll-period', type=float, default=1,
+            help='seconds between each watcher\'s polls (the clients use 10)')
+    parser.add_argument('--refresh-period', type=float,
+            help='seconds between separate refreshes (default: what the server says, at most 10)')
+    parser.add_argument('--separate-refresh', action='store_true',
+            help='refresh-watcher-id and get-assigned-changes instead of refresh-and-get-changes')
+    parser.add_argument('--full-polls', action='store_true',
+            help='GET assigned-channels/watcher=<id> instead of get-assigned-changes')
+    parser.add_argument('--ramp', type=float, default=2,
+            help='seconds over which a stage\'s new watchers connect')
+    parser.add_argument('--warmup', type=float, default=5,
+            help='seconds after the ramp before measuring')
+    parser.add_argument('-s', '--seconds', type=float, default=10,
+            help='seconds measured per stage')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-e', '--engine', choices=['h2', 'jetconf'], default='h2',
+            help='server to start')
+    parser.add_argument('-p', '--port', type=int, default=18443)
+    parser.add_argument('--server',
+            help='<host>:<port> of a running server to use instead of starting one')
+    parser.add_argument('--server-pid', type=int,
+            help='pid of the running server, for its cpu and memory')
+    parser.add_argument('--cacert',
+            help='cert to verify the running server with')
+    args = parser.parse_args(args_in[1:])
+    counts = [watchers for watchers, sgs in args.stages]
+    if counts != sorted(counts):
+        parser.error('stages must not drop watchers')
+
+    if args.server:
+        run_load(args, args.server_pid, args.cacert)
+        return 0
+
+    with TemporaryDirectory() as tmp:
+        cert, key = make_cert(tmp)
+        proc = start_server(args.engine, args.port, tmp, cert, key)
+        args.server = f'localhost:{args.port}'
+        try:
+            run_load(args, proc.pid, cert)
+        finally:
+            proc.terminate()
+            proc.wait()
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
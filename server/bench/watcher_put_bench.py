@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+'''
+Server cost of an egress's PUT of its egress-global-joined watcher
+entry, with the entries kept in jetconf's yangson tree
+(MNAT_WATCHER_CONFIG=yangson) against the direct WatcherConfig
+(MNAT_WATCHER_CONFIG=direct), for a joined list of 10 to 10000 (S,G)s.
+
+Each PUT swaps one (S,G) of the list for a new one, and is timed the
+way jetconf's PUT handler runs it: the json parse of the body, then
+update_node_rpc against the user's staging root and the journal entry.
+Needs jetconf installed (the datastore is a jetconf JsonDatastore).
+
+Run from the server directory:
+    python3 bench/watcher_put_bench.py
+'''
+
+import sys
+import argparse
+import json
+from os import environ
+from os.path import abspath, dirname, join
+from time import perf_counter
+
+environ.pop('MNAT_JOURNAL', None)
+environ['MNAT_INVARIANTS'] = 'off'
+
+server_dir = join(dirname(abspath(__file__)), '..')
+sys.path.insert(0, join(server_dir, 'module'))
+sys.path.insert(0, join(server_dir, '..', 'common'))
+
+def joined_body(watcher_id, first, count):
+    return json.dumps({'ietf-mnat:watcher': {'id': watcher_id, 'joined-sg': [
+        {'id': str(i), 'source': '10.0.0.1', 'group': f'232.{(i>>16)&255}.{(i>>8)&255}.{i&255}'}
+        for i in range(first, first + count)]}})
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='egress-global-joined PUT through yangson vs. direct')
+    parser.add_argument('-n', '--counts', type=int, nargs='+', default=[10, 1000, 10000],
+            help='joined (S,G)s in the PUT')
+    parser.add_argument('-r', '--reps', type=int, default=20,
+            help='PUTs timed per case')
+    args = parser.parse_args(args_in[1:])
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    from yangson import DataModel
+    from jetconf.journal import RpcInfo, ChangeType
+    from jetconf_mnat.assignments import Assignments, LocalPool
+    from jetconf_mnat import usr_datastore
+
+    with open(join(server_dir, 'module', 'jetconf_mnat', 'yang-library-data.json')) as f:
+        dm = DataModel(f.read(), [join(server_dir, 'files', 'yang-modules')])
+
+    print(f'{"sgs":>6} {"config":>8} {"ms":>9}')
+    for count in args.counts:
+        for mode in ('yangson', 'direct'):
+            environ['MNAT_WATCHER_CONFIG'] = mode
+            top = Assignments()
+            top.local_pool = LocalPool('(bench)', {'group-pool':{'ranges':[
+                {'group-range': '239.0.0.0/12', 'source-range': '10.9.1.2/32'}]}})
+            # the datastore uses the module's assigned
+            usr_datastore.assigned = top
+            ds = usr_datastore.UserDatastore(dm, join(server_dir, 'files', 'data-mnat.json'))
+            ds.load()
+
+            def send(method, path, body):
+                rpc = RpcInfo()
+                rpc.username = 'bench'
+                rpc.path = path
+                rpc.qs = {}
+                value = json.loads(body)
+                staging_root = ds.get_data_root_staging(rpc.username)
+                if method == 'POST':
+                    new_root = ds.create_node_rpc(staging_root, rpc, value)
+                    ds.add_to_journal_rpc(ChangeType.CREATE, rpc, value, *new_root)
+                else:
+                    new_root = ds.update_node_rpc(staging_root, rpc, value)
+                    ds.add_to_journal_rpc(ChangeType.REPLACE, rpc, value, *new_root)
+
+            top.create_watcher('watcher')
+            send('POST', '/ietf-mnat:egress-global-joined', joined_body('watcher', 0, 0))
+            bodies = [joined_body('watcher', i, count) for i in range(args.reps)]
+            start = perf_counter()
+            for body in bodies:
+                send('PUT', '/ietf-mnat:egress-global-joined/watcher=watcher', body)
+            ms = 1e3 * (perf_counter() - start) / args.reps
+            print(f'{count:>6} {mode:>8} {ms:>9.3f}')
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
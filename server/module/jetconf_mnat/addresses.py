@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+# listen/connect addresses in the MNAT_* settings (replication,
+# metrics), shared so neither has to import the other
+
+def parse_address(address):
+    '''
+    "unix:<path>" or "tcp:<host>:<port>" (or just "<host>:<port>") as
+    ('unix', path) or ('tcp', (host, port)).
+    '''
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    if address.startswith('tcp:'):
+        address = address[len('tcp:'):]
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError(f'bad address "{address}" (expected unix:<path> or tcp:<host>:<port>)')
+    return 'tcp', (host.strip('[]') or None, int(port))
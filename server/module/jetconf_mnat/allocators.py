@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+from random import randrange
+
+class FenwickSlots(object):
+    '''
+    Tracks how many of size slots are in use with a Fenwick (binary
+    indexed) tree over the used counts, so that "pick the k'th free slot",
+    "take slot" and "release slot" are all O(log size).
+
+    The tree lives in a dict that only holds non-zero nodes, so memory
+    goes with the number of used slots (times log size) rather than with
+    the size of the pool, and a pool with an ipv6-sized index space
+    still works.  Node i (1-based) holds the used count for slots
+    [i - lowbit(i), i).
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.tree = {}
+        if size > 0:
+            self.top = 1 << (size.bit_length() - 1)
+        else:
+            self.top = 0
+
+    def free_count(self):
+        return self.size - self.used
+
+    def _add(self, idx, delta):
+        tree = self.tree
+        size = self.size
+        node = idx + 1
+        while node <= size:
+            val = tree.get(node, 0) + delta
+            if val:
+                tree[node] = val
+            else:
+                del(tree[node])
+            node += node & -node
+
+    def take(self, idx):
+        self._add(idx, 1)
+        self.used += 1
+
+    def release(self, idx):
+        self._add(idx, -1)
+        self.used -= 1
+
+    def used_before(self, idx):
+        '''count of used slots in [0, idx)'''
+        tree = self.tree
+        total = 0
+        node = idx
+        while node > 0:
+            total += tree.get(node, 0)
+            node -= node & -node
+        return total
+
+    def free_before(self, idx):
+        '''count of free slots in [0, idx)'''
+        return idx - self.used_before(idx)
+
+    def nth_free(self, k):
+        '''
+        Returns the slot index of the k'th free slot (0-based), by
+        descending the tree from the top power of 2.
+        '''
+        if k < 0 or k >= self.free_count():
+            raise IndexError(f'free slot rank {k} outside {self.free_count()} free slots')
+        tree = self.tree
+        size = self.size
+        pos = 0
+        step = self.top
+        while step:
+            nxt = pos + step
+            if nxt <= size:
+                free = step - tree.get(nxt, 0)
+                if k >= free:
+                    k -= free
+                    pos = nxt
+            step >>= 1
+        return pos
+
+    def random_free(self):
+        if self.free_count() <= 0:
+            raise IndexError(f'no free slots in {self.size}')
+        return self.nth_free(randrange(self.free_count()))
+
+    def free_at_or_after(self, idx):
+        '''The first free slot at or after idx, wrapping around.'''
+        if self.free_count() <= 0:
+            raise IndexError(f'no free slots in {self.size}')
+        return self.nth_free(self.free_before(idx) % self.free_count())
+
+class SparseSlots(object):
+    '''
+    Tracks used slots in a plain set, for index spaces far too big for
+    anything proportional to their size (or even to log of their size
+    per used slot, like FenwickSlots), such as an ipv6 /96 of groups
+    with a /64 of sources.
+
+    Picks are random (or hashed, by the caller) and tested against the
+    set, so memory goes with the number of used slots only.  This
+    relies on the space being mostly empty: with utilization u a random
+    pick needs about 1/(1-u) tries, and after random_tries misses it
+    falls back to a linear probe from a random start.
+    '''
+    def __init__(self, size, random_tries=32):
+        self.size = size
+        self.used = set()
+        self.random_tries = random_tries
+
+    def free_count(self):
+        return self.size - len(self.used)
+
+    def take(self, idx):
+        self.used.add(idx)
+
+    def release(self, idx):
+        self.used.discard(idx)
+
+    def random_free(self):
+        if self.free_count() <= 0:
+            raise IndexError(f'no free slots in {self.size}')
+        for i in range(self.random_tries):
+            idx = randrange(self.size)
+            if idx not in self.used:
+                return idx
+        return self.free_at_or_after(randrange(self.size))
+
+    def free_at_or_after(self, idx):
+        '''
+        The first free slot at or after idx, wrapping around.  Linear in
+        the run of used slots it has to step over.
+        '''
+        if self.free_count() <= 0:
+            raise IndexError(f'no free slots in {self.size}')
+        used = self.used
+        size = self.size
+        while True:
+            if idx not in used:
+                return idx
+            idx += 1
+            if idx == size:
+                idx = 0
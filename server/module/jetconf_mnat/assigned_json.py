@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# json renderings of assignments for the ietf-mnat assigned-channels
+# data and rpcs, shared by the jetconf handlers and h2_server (so no
+# jetconf imports here)
+
+from .metrics import timed
+
+def mapped_sg_json(sg, sg_id, local_sg):
+    source, group = sg
+    sg_dat = {
+        'id': sg_id,
+        'global-subscription': {
+            'source': str(source),
+            'group': str(group)
+        }
+      }
+    if local_sg:
+        sg_dat['state'] = 'assigned-local-multicast'
+        # tbd: support asm-group:
+        sg_dat['local-mapping'] = {
+                'source': str(local_sg[0]),
+                'group': str(local_sg[1]),
+            }
+    else:
+        sg_dat['state'] = 'unassigned'
+    return sg_dat
+
+def assigned_changes_json(changes):
+    '''the (generation, kind, mapped, removed) from mapped_sgs_since, as in the assigned-changes grouping'''
+    generation, kind, mapped, removed = changes
+    ret = {'generation': generation, 'changes': kind}
+    if mapped:
+        ret['mapped-sg'] = [mapped_sg_json(*m) for m in mapped]
+    if removed:
+        ret['removed-sg'] = [{'global-subscription': {'source': str(sg[0]), 'group': str(sg[1])}}
+                for sg in removed]
+    return ret
+
+@timed('mnat_watcher_assignments_seconds')
+def watcher_assignments_json(top, watcher_id):
+    '''
+    The watcher's assigned-channels entry from the Assignments top, or
+    None if there's no such watcher.  Rebuilt only when something the
+    watcher maps changed, so an unchanged poll is a lookup.  (Shared:
+    don't modify the answer.)
+    '''
+    def render(watcher_id):
+        # each GlobalSG's mapped_sg_json is rendered once and shared by
+        # every watcher it's mapped for
+        fragments = top.mapped_fragments(watcher_id, mapped_sg_json)
+        if fragments is None:
+            return None
+        return {
+            'id': watcher_id,
+            'mapped-sg': fragments
+        }
+    return top.cached_response(watcher_id, render)
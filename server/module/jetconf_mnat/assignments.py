@@ -1,92 +1,75 @@
 #!/usr/bin/env python3
 
-from ipaddress import ip_address, ip_network
+from ipaddress import ip_address, ip_network, IPv4Address, IPv6Address
 from colorlog import debug, info, warning, error
 from datetime import datetime, timedelta
 from os.path import isfile
-from os import getenv
-from random import randrange
+from os import getenv, urandom
+from random import random
+from time import perf_counter
+from heapq import heappush, heappop, heapify
 import json
-from collections import OrderedDict
-from itertools import islice
+from collections import deque
+from hashlib import blake2b
+from bisect import bisect_right
 import traceback
+from .allocators import FenwickSlots, SparseSlots
+from .expiry import ExpiryScheduler
+from .journal import AssignmentJournal, snapshot_records
+from .monitor_index import MonitorIndex
+from .intervals import net_interval, find_overlaps, merge_intervals, subtract_intervals
+from .metrics import metrics, timed
+from mnat.lazylog import enabled
+from logging import INFO
 
 strict = True
 
-def get_nth_address(ip_net, idx):
+def sg_to_json(sg):
+    return [str(sg[0]) if sg[0] is not None else None, str(sg[1])]
+
+def sg_hash(sg, probe=0):
     '''
-The hosts() iter construction seems to be instantiating each
-address or something, because it's taking a terribly long time:
-
-    $ time python -c "from ipaddress import ip_network; from itertools import islice; print(next(islice(ip_network('232.0.0.0/8'), 8, None)))"
-    232.0.0.8
-
-    real	0m0.038s
-    user	0m0.024s
-    sys	0m0.011s
-
-    $ time python -c "from ipaddress import ip_network; from itertools import islice; print(next(islice(ip_network('232.0.0.0/8'), 8388600, None)))"
-    232.127.255.248
-
-    real	0m4.732s
-    user	0m4.416s
-    sys	0m0.042s
-
-    $ time python -c "from ipaddress import ip_network; from itertools import islice; print(next(islice(ip_network('232.0.0.0/8'), 8388600, None, 8388600)))"
-    232.127.255.248
-
-    real	0m4.205s
-    user	0m4.116s
-    sys	0m0.036s
-
-    $ time python -c "from ipaddress import ip_network; from itertools import islice; print(next(islice(ip_network('232.0.0.0/8'), 16777208, None, 16777208)))"
-    232.255.255.248
-
-    real	0m8.219s
-    user	0m8.129s
-    sys	0m0.036s
-
-TBD: check the idx is inside ip_net.num_addresses, pull out an
-integer representation from ip_net.network_address.packed (including
-with ipv6), add idx, conver back into an address and return it, instead
-of this very sad slice-based function that iterates on the existing
-hosts() function for ip_network.
-Better still, upstream this functionality to the hosts() iterator and
-make it so the islice's step param makes it a properly constant-time op.
-
-NB: bug in python's ip_network, I think.  It says hosts() returns an
-iterator, but for a /32 it returns a list with 1 entry:
-$ python3 -c "from ipaddress import ip_network; print(next(ip_network('10.1.1.0/31').hosts()))"
-10.1.1.0
-$ python3 -c "from ipaddress import ip_network; print(next(ip_network('10.1.1.0/32').hosts()))"
-Traceback (most recent call last):
-  File "<string>", line 1, in <module>
-TypeError: 'list' object is not an iterator
-
-NB: and another bug? cannot iterate to all the addresses:
-$ python3 -c "from ipaddress import ip_network; from itertools import islice; print(ip_network('10.1.1.0/29').num_addresses)"
-8
-$ python3 -c "from ipaddress import ip_network; from itertools import islice; print(next(islice(iter(ip_network('10.1.1.0/29').hosts()), 6, None,6)))"
-Traceback (most recent call last):
-  File "<string>", line 1, in <module>
-StopIteration
-$ python3 -c "from ipaddress import ip_network; from itertools import islice; print(list(ip_network('10.1.1.0/29').hosts()))"
-[IPv4Address('10.1.1.1'), IPv4Address('10.1.1.2'), IPv4Address('10.1.1.3'), IPv4Address('10.1.1.4'), IPv4Address('10.1.1.5'), IPv4Address('10.1.1.6')]
-    
---jake 2021-02-20
+    A hash of a global (S,G) that's stable across processes and restarts
+    (unlike hash()), with probe picking among independent hashes.
     '''
-    # from the "consume" recipe in https://docs.python.org/3.7/library/itertools.html#itertools-recipes
-    info(f'pulling addr {idx}/{ip_net.num_addresses} from {ip_net}')
-    if idx == 0:
-        return ip_net.network_address
-    elif idx == (ip_net.num_addresses - 1):
-        return ip_net.broadcast_address
-    else:
-        if idx == 1:
-            return next(ip_net.hosts())
-        else:
-            return next(islice(ip_net.hosts(), idx-1, None, idx-1))
+    h = blake2b(digest_size=16)
+    h.update(sg[0].packed if sg[0] is not None else b'')
+    h.update(b'|')
+    h.update(sg[1].packed)
+    h.update(probe.to_bytes(4, 'big'))
+    return int.from_bytes(h.digest(), 'big')
 
+def sg_from_json(sg_val):
+    return (ip_address(sg_val[0]) if sg_val[0] is not None else None, ip_address(sg_val[1]))
+
+def sg_key(sg):
+    '''
+    Packs an (S,G) of ipaddress objects into one int, for keying the
+    state dicts without holding a tuple and two address objects per
+    entry:
+      ipv4 (S,G):  S<<32 | G            (below 2^64)
+      ipv4 (*,G):  1<<64 | G
+      ipv6 (S,G):  1<<256 | S<<128 | G
+      ipv6 (*,G):  1<<257 | G
+    '''
+    src, grp = sg
+    if grp.version == 4:
+        if src is None:
+            return (1<<64) | int(grp)
+        return (int(src)<<32) | int(grp)
+    if src is None:
+        return (1<<257) | int(grp)
+    return (1<<256) | (int(src)<<128) | int(grp)
+
+def sg_from_key(key):
+    '''the (S,G) of ipaddress objects that sg_key packed into key'''
+    if key < (1<<64):
+        return (IPv4Address(key>>32), IPv4Address(key & 0xffffffff))
+    if key < (1<<65):
+        return (None, IPv4Address(key & 0xffffffff))
+    if key < (1<<257):
+        return (IPv6Address((key>>128) & ((1<<128)-1)), IPv6Address(key & ((1<<128)-1)))
+    return (None, IPv6Address(key & ((1<<128)-1)))
 
 class PoolRange(object):
     def __init__(self, pool_fname, idx, range_val, default_source):
@@ -102,9 +85,9 @@ class PoolRange(object):
         else:
             self.source_range = ip_network(source_range_str)
             self.source_count = self.source_range.num_addresses
-        self.usable_ranges = []
+        self.usable_intervals = []
         self.group_count = 0
-        self.in_use = []
+        self.in_use = 0 # assigned (S,G)s in this range, counted by LocalPool
 
         exclude = []
 
@@ -142,38 +125,106 @@ class PoolRange(object):
                 warning(f'ignoring groupex-range="{groupex}": not a subnet o {self.base_group_range}')
                 continue
 
-            skip = False
-            for prior_exclude in exclude:
-                if prior_exclude.overlaps(groupex):
-                    if strict:
-                        raise ValueError(f'failed parse of {pool_fname}: groupex-range {groupex} overlaps with {prior_exclude}')
-                    warning(f'ignoring groupex-range="{groupex}": overlaps with previous groupex-range="{prior_exclude}"')
-                    skip = True
-                    break
-            if skip:
-                continue
-
             exclude.append(groupex)
 
-        valid_ranges = [self.base_group_range]
-        remaining_excludes = []
-        for ex in exclude:
-            new_valid = []
-            for rg in valid_ranges:
-                if ex.subnet_of(rg):
-                    new_valid.extend(rg.address_exclude(ex))
-                else:
-                    new_valid.add(rg)
-            valid_ranges = new_valid
-        
-        self.usable_ranges = valid_ranges
-        self.group_count = sum(map(lambda x: x.num_addresses, self.usable_ranges))
+        # excludes and the usable ranges left after them are kept as
+        # sorted integer [start, end) intervals, so thousands of excludes
+        # are a sort and a merge instead of address_exclude splitting the
+        # range into a pile of subnets per exclude.
+        exclude_intervals = [net_interval(groupex) for groupex in exclude]
+        for i, j in find_overlaps(exclude_intervals):
+            if strict:
+                raise ValueError(f'failed parse of {pool_fname}: groupex-range {exclude[j]} overlaps with {exclude[i]}')
+            warning(f'groupex-range="{exclude[j]}" overlaps with groupex-range="{exclude[i]}", excluding both')
+
+        self.usable_intervals = subtract_intervals(
+                net_interval(self.base_group_range),
+                merge_intervals(exclude_intervals))
+        self.compile()
+
+    def compile(self):
+        '''
+        Flattens usable_intervals into (start, offset) segments so
+        that an index into the range turns into an address with a bisect
+        and an add instead of walking the networks.
+        group_offsets[i] is the count of group addresses before segment i.
+        '''
+        self.addr_type = type(self.base_group_range.network_address)
+        self.group_starts = []
+        self.group_offsets = []
+        group_count = 0
+        for start, end in self.usable_intervals:
+            self.group_starts.append(start)
+            self.group_offsets.append(group_count)
+            group_count += end - start
+        self.group_count = group_count
+        self.sg_count = self.group_count * self.source_count
+
+        if self.source_range in set(['keep','asm']):
+            self.source_start = None
+        else:
+            self.source_start = int(self.source_range.network_address)
+            self.source_type = type(self.source_range.network_address)
+
+    def group_index(self, group):
+        '''the group idx of a group address, or None if it's not usable in this range'''
+        if type(group) is not self.addr_type:
+            return None
+        grp_int = int(group)
+        seg = bisect_right(self.group_starts, grp_int) - 1
+        if seg < 0:
+            return None
+        seg_end = self.group_offsets[seg+1] if seg+1 < len(self.group_offsets) else self.group_count
+        grp_idx = self.group_offsets[seg] + grp_int - self.group_starts[seg]
+        if grp_idx >= seg_end:
+            return None
+        return grp_idx
+
+    def index_of(self, local_sg, for_global_sg):
+        '''the inverse of sg_at: the range idx of local_sg, or None if it's outside the range'''
+        grp_idx = self.group_index(local_sg[1])
+        if grp_idx is None:
+            return None
+        if self.source_start is None:
+            if self.source_range == 'asm':
+                if local_sg[0] is not None:
+                    return None
+            elif local_sg[0] != for_global_sg[0]:
+                return None
+            return grp_idx
+        if type(local_sg[0]) is not self.source_type:
+            return None
+        src_idx = int(local_sg[0]) - self.source_start
+        if src_idx < 0 or src_idx >= self.source_count:
+            return None
+        return src_idx * self.group_count + grp_idx
+
+    def group_at(self, grp_idx):
+        seg = bisect_right(self.group_offsets, grp_idx) - 1
+        return self.addr_type(self.group_starts[seg] + grp_idx - self.group_offsets[seg])
+
+    def sg_at(self, range_idx, for_global_sg):
+        '''
+        Returns the local (source,group) for an index in [0, sg_count).
+        for_global_sg supplies the source when the range keeps it.
+        '''
+        src_idx, grp_idx = divmod(range_idx, self.group_count)
+        if self.source_start is None:
+            if src_idx != 0:
+                raise IndexError(f'range source idx {src_idx} outside {self.source_range} range (range_idx={range_idx})')
+            if self.source_range == 'asm':
+                source_ip = None
+            else:
+                source_ip = for_global_sg[0]
+        else:
+            source_ip = self.source_type(self.source_start + src_idx)
+        return (source_ip, self.group_at(grp_idx))
 
 class LocalPool(object):
     def __init__(self, pool_fname, pool_json):
         self.ranges = []
         self.assigned_sgs = dict()
-        self.assigned_idxs = OrderedDict()
+        self.assigned_idxs = dict()
 
         group_pool = pool_json.get('group-pool')
         if not group_pool:
@@ -186,205 +237,364 @@ class LocalPool(object):
                 continue
 
         for name,val in group_pool.items():
-            if name not in set(['ranges','default-source-range','note']):
+            if name not in set(['ranges','default-source-range','allocation','slot-tracking','note']):
                 warning(f'ignoring group-pool item "{name}" in {pool_fname}')
                 continue
 
+        # random: any free (S,G) in the pool
+        # hashed: prefer an (S,G) picked by a hash of the global (S,G), so
+        #   the same global (S,G) usually lands on the same local one when
+        #   it's re-subscribed or the server restarts.
+        self.allocation = group_pool.get('allocation', 'random')
+        if self.allocation not in set(['random','hashed']):
+            if strict:
+                raise ValueError(f'failed parse of {pool_fname}: unknown allocation "{self.allocation}" (expected random or hashed)')
+            warning(f'unknown allocation "{self.allocation}" in {pool_fname}, using random')
+            self.allocation = 'random'
+        self.hash_probes = 4
+
+        # fenwick: a FenwickSlots index, exact for any utilization
+        # sparse: a SparseSlots set, for pools so big they'll never be
+        #   more than a sliver full (memory goes only with assignments)
+        # auto: sparse for pools over 2^32 (S,G)s, fenwick otherwise
+        self.slot_tracking = group_pool.get('slot-tracking', 'auto')
+        if self.slot_tracking not in set(['auto','fenwick','sparse']):
+            if strict:
+                raise ValueError(f'failed parse of {pool_fname}: unknown slot-tracking "{self.slot_tracking}" (expected auto, fenwick or sparse)')
+            warning(f'unknown slot-tracking "{self.slot_tracking}" in {pool_fname}, using auto')
+            self.slot_tracking = 'auto'
+
         idx = 0
         sg_count = 0
+        self.range_offsets = []
         for range_val in group_pool.get('ranges'):
             pool_range = PoolRange(pool_fname, idx, range_val, self.default_source_range)
             self.ranges.append(pool_range)
-            cur_count = pool_range.group_count * pool_range.source_count
-            sg_count += cur_count
+            self.range_offsets.append(sg_count)
+            sg_count += pool_range.sg_count
             idx += 1
         self.sg_count = sg_count
-        # TBD: sanity checks: do they overlap?  complain somehow.
+        if self.slot_tracking == 'sparse' or (self.slot_tracking == 'auto' and sg_count > 2**32):
+            self.free_slots = SparseSlots(sg_count)
+        else:
+            self.free_slots = FenwickSlots(sg_count)
+        self.check_overlaps(pool_fname)
+
+    def check_overlaps(self, pool_fname):
+        '''
+        Complains about ranges whose usable groups overlap with sources
+        that can collide, since they'd hand out the same local (S,G) for
+        two pool idxs.  A 'keep' source can collide with anything but
+        'asm'.
+        '''
+        def sources_overlap(a, b):
+            if a == 'asm' or b == 'asm':
+                return a == b
+            if a == 'keep' or b == 'keep':
+                return True
+            return a.overlaps(b)
+
+        for version in (4, 6):
+            segs = []
+            for pool_range in self.ranges:
+                if pool_range.base_group_range.version != version:
+                    continue
+                segs.extend((interval, pool_range) for interval in pool_range.usable_intervals)
+            for i, j in find_overlaps([interval for interval, pool_range in segs]):
+                range_a, range_b = segs[i][1], segs[j][1]
+                if range_a is range_b or not sources_overlap(range_a.source_range, range_b.source_range):
+                    continue
+                if strict:
+                    raise ValueError(f'failed parse of {pool_fname}: group-range {range_b.base_group_range} (source {range_b.source_range}) overlaps with group-range {range_a.base_group_range} (source {range_a.source_range})')
+                warning(f'group-range {range_b.base_group_range} (source {range_b.source_range}) overlaps with group-range {range_a.base_group_range} (source {range_a.source_range}) in {pool_fname}')
+
+    def sg_at_index(self, idx, for_global_sg):
+        '''
+        Maps a flat pool index in [0, sg_count) to a local (source,group):
+        a bisect over range_offsets picks the PoolRange, then the range
+        does the same over its group segments.
+        '''
+        if idx < 0 or idx >= self.sg_count:
+            raise IndexError(f'pool idx {idx} outside pool of {self.sg_count}')
+        rng_idx = bisect_right(self.range_offsets, idx) - 1
+        rng = self.ranges[rng_idx]
+        return rng.sg_at(idx - self.range_offsets[rng_idx], for_global_sg)
+
+    def index_of(self, local_sg, for_global_sg):
+        '''the pool idx that maps to local_sg, or None if it's not in the pool'''
+        for rng, offset in zip(self.ranges, self.range_offsets):
+            range_idx = rng.index_of(local_sg, for_global_sg)
+            if range_idx is not None:
+                return offset + range_idx
+        return None
 
     def borrow_local_sg(self, for_global_gsg):
-        for_global_sg = for_global_gsg.sg
-        info(f'borrowing sg from pool for {for_global_sg}')
-        if len(self.assigned_idxs) >= self.sg_count:
-            # all available sgs are assigned
+        '''borrow_idx, returning the local (S,G) instead of its idx'''
+        idx = self.borrow_idx(for_global_gsg)
+        if idx is None:
             return None
+        return self.local_sg(idx)
+
+    @timed('mnat_borrow_local_sg_seconds')
+    def borrow_idx(self, for_global_gsg):
+        '''
+        Takes a free pool idx for for_global_gsg and returns it, or None
+        if the pool is exhausted.
+        '''
+        for_global_sg = for_global_gsg.sg
+        info('borrowing sg from pool for %s', for_global_sg)
 
-        idx = randrange(self.sg_count - len(self.assigned_idxs))
-        for lower_idxs in self.assigned_idxs.keys():
-            if lower_idxs >= idx:
-                break
-            idx += 1
-
-        next_idx = idx
-        orig_idx = idx
         unexpected_tryfails = []
-        while True:
-            if len(unexpected_tryfails) != 0 and next_idx == orig_idx:
-                warning(f'assignment fail-safe: wrapped the available idxs ({len(unexpected_tryfails)} unexpected failure indexes in pool assignment from {orig_idx})')
-                return None
-
+        while self.free_slots.free_count() > 0:
             if len(unexpected_tryfails) > 50:
                 warning(f'assignment loop failsafe: hit unexpected failures on idxs: {unexpected_tryfails}')
                 return None
 
-            idx = next_idx
-            next_idx = (idx + 1) % self.sg_count
-
+            idx = self.pick_free_idx(for_global_sg, unexpected_tryfails)
+            if idx is None:
+                warning(f'assignment loop failsafe: every free idx tried failed: {unexpected_tryfails}')
+                return None
             if idx in self.assigned_idxs:
-                warning(f'generated idx {idx} hit existing assigned_idx with {self.assigned_idxs[idx]} and looped idx {self.assigned_sgs.get(self.assigned_idxs[idx])}')
+                warning(f'internal error: free slot idx {idx} hit existing assigned_idx with {sg_from_key(self.assigned_idxs[idx])}')
                 unexpected_tryfails.append(idx)
                 continue
 
-            range_idx = idx
-            found = False
-            for rng in self.ranges:
-                rng_sg_count = rng.source_count * rng.group_count
-                if range_idx < rng_sg_count:
-                    found = True
-                    break
-                range_idx -= rng_sg_count
-
-            if not found:
-                warning(f'range fail-safe: orig_idx {orig_idx} reached end of ranges with {range_idx} from {idx} overall')
-                return None
-
-            src_idx = range_idx // rng.group_count
-            grp_idx = range_idx % rng.group_count
-
-            source_ip = None
-
-            if rng.source_range in set(['keep','asm']):
-                if src_idx != 0:
-                    warning(f'range source idx fail-safe: src_idx = {src_idx} on src,grp counts {rng.source_count},{rng.group_count}, range_idx={range_idx}')
-                    return None
-                if rng.source_range == 'asm':
-                    source_ip = None
-                else:
-                    source_ip = for_global_sg[0]
-            else:
-                source_ip = get_nth_address(rng.source_range, src_idx)
-
-            info(f'picked source ip {source_ip} from idx {idx} (src_idx={src_idx}/{rng.source_count})')
-
-            net_idx = grp_idx
-            found=False
-            for grp_net in rng.usable_ranges:
-                if net_idx < grp_net.num_addresses:
-                    found = True
-                    break
-                net_idx -= grp_net.num_addresses
-
-            if not found:
-                warning(f'group net fail-safe: orig_idx {orig_idx} found source {source_ip} on {src_idx} but missed group on {grp_idx}')
+            try:
+                sg = self.sg_at_index(idx, for_global_sg)
+            except IndexError as e:
+                warning(f'range fail-safe: idx {idx}: {e}')
                 return None
 
-            group_ip = get_nth_address(grp_net, net_idx)
-
-            info(f'picked group ip {group_ip} from idx {idx} (grp_idx={grp_idx}->net_idx={net_idx} from {grp_net})')
-            sg = (source_ip,group_ip)
-            if sg in self.assigned_sgs:
-                warning(f'generated assigned_sg {sg} on idx {idx} but hit existing assigned_sg with {assigned_sgs[sg]}')
+            info('picked %s->%s from idx %d', sg[0], sg[1], idx)
+            key = sg_key(sg)
+            if key in self.assigned_sgs:
+                # only possible with overlapping ranges
+                warning(f'generated assigned_sg {sg} on idx {idx} but hit existing assigned_sg with {self.assigned_sgs[key]}')
                 unexpected_tryfails.append(idx)
                 continue
 
-            if idx in self.assigned_idxs:
-                warning(f'internal error: after checking assigned idx hit assigned idx already present for {idx} finding {sg} vs. {self.assigned_idxs[sg]}')
-                unexpected_tryfails.append(idx)
-                continue
+            self.take_idx(idx, key)
+            return idx
 
-            self.assigned_idxs[idx] = sg
-            self.assigned_sgs[sg] = idx
-            return sg
+        # all available sgs are assigned
+        return None
 
+    def pick_free_idx(self, for_global_sg, tried=()):
+        '''
+        Picks a free pool idx for for_global_sg, other than the ones in
+        tried (prior picks for this borrow that turned out unusable), or
+        None if there's none left to try.
+
+        For hashed allocation, tries hash_probes hashed idxs in turn, then
+        falls back to the first free idx at or after the preferred one
+        (wrapping), from the free-slot index, stepping past tried ones.
+        Either way a given global (S,G) deterministically gets the same
+        idx from the same pool state.
+        '''
+        if self.allocation != 'hashed':
+            return self.free_slots.random_free()
+
+        tried = set(tried)
+        for probe in range(self.hash_probes):
+            idx = sg_hash(for_global_sg, probe) % self.sg_count
+            if idx not in self.assigned_idxs and idx not in tried:
+                return idx
+        start = sg_hash(for_global_sg, 0) % self.sg_count
+        for i in range(len(tried) + 1):
+            idx = self.free_slots.free_at_or_after(start)
+            if idx not in tried:
+                return idx
+            start = (idx + 1) % self.sg_count
         return None
 
+    def range_of(self, idx):
+        return self.ranges[bisect_right(self.range_offsets, idx) - 1]
+
+    def take_idx(self, idx, key):
+        self.assigned_idxs[idx] = key
+        self.assigned_sgs[key] = idx
+        self.free_slots.take(idx)
+        self.range_of(idx).in_use += 1
+
+    def local_sg(self, idx):
+        '''the local (S,G) assigned at pool idx'''
+        return sg_from_key(self.assigned_idxs[idx])
+
+    def claim_local_sg(self, idx, for_global_sg):
+        '''
+        Assigns a specific pool idx instead of a random one, for putting
+        back a known assignment.  Returns the local sg, or None if the
+        idx is outside the pool or already taken.
+        '''
+        if idx in self.assigned_idxs:
+            return None
+        try:
+            sg = self.sg_at_index(idx, for_global_sg)
+        except IndexError:
+            return None
+        key = sg_key(sg)
+        if key in self.assigned_sgs:
+            return None
+        self.take_idx(idx, key)
+        return sg
+
     def return_local_sg(self, sg):
-        if sg not in self.assigned_sgs:
+        idx = self.assigned_sgs.get(sg_key(sg))
+        if idx is None:
             warning(f'local sg {sg} returned but was not assigned')
             return False
+        return self.return_idx(idx)
 
-        idx = self.assigned_sgs[sg]
-        del(self.assigned_sgs[sg])
-
-        if idx not in self.assigned_idxs:
-            warning(f'internal error: idx {idx} from return of local sg {sg} not in assigned_idxs')
+    def return_idx(self, idx):
+        key = self.assigned_idxs.pop(idx, None)
+        if key is None:
+            warning(f'internal error: returned idx {idx} not in assigned_idxs')
             return False
+        del(self.assigned_sgs[key])
+        self.range_of(idx).in_use -= 1
 
-        adding_new = (len(self.assigned_idxs) == self.sg_count)
-        del(self.assigned_idxs[idx])
+        adding_new = (self.free_slots.free_count() == 0)
+        self.free_slots.release(idx)
 
         return adding_new
 
 class Watcher(object):
+    '''
+    generation counts changes to what the watcher's mapped (S,G)s
+    report, and changes remembers the last change_log_size of them as
+    (generation, GlobalSG.key), so a poll can be answered with only
+    what changed since the generation the client last saw.  A change
+    that isn't tracked per (S,G) (its monitors changing) bumps
+    reset_generation instead, meaning anything older needs the full
+    list.
+
+    response_cache holds (generation, response) from cached_response,
+    so a poll that finds nothing changed reuses the last one.
+    '''
+    __slots__ = ('watcher_id', 'subscribed_gsgs', 'last_refresh', 'monitors',
+            'generation', 'reset_generation', 'changes', 'response_cache')
+    change_log_size = 1024
+
     def __init__(self, watcher_id):
         self.watcher_id = watcher_id
-        self.subscribed_gsgs = {}  # { GlobalSG.sg: GlobalSG }
+        self.subscribed_gsgs = {}  # { GlobalSG.key: GlobalSG }
         self.last_refresh = datetime.now()
         self.monitors = {} # { monitor_id: Monitor)
+        self.generation = 0
+        self.reset_generation = 0
+        self.changes = deque(maxlen=self.change_log_size)
+        self.response_cache = None
 
     def refresh(self):
         self.last_refresh = datetime.now()
 
-    def unsubscribe(self, top_assignments, sg):
-        if sg not in self.subscribed_gsgs:
-            warning(f'tried to remove {sg} from {self.watcher_id} when not present')
+    def note_change(self, key):
+        self.generation += 1
+        self.changes.append((self.generation, key))
+
+    def note_reset(self):
+        self.generation += 1
+        self.reset_generation = self.generation
+        self.changes.clear()
+
+    def changed_keys_since(self, since):
+        '''
+        The GlobalSG.keys changed after generation since, or None if the
+        change log doesn't go back that far.
+        '''
+        if since < self.reset_generation:
+            return None
+        changes = self.changes
+        if len(changes) == changes.maxlen and changes[0][0] - 1 > since:
+            return None
+        keys = {}
+        for generation, key in reversed(changes):
+            if generation <= since:
+                break
+            keys[key] = True
+        return list(keys)
+
+    def unsubscribe(self, top_assignments, key):
+        gsg = self.subscribed_gsgs.pop(key, None)
+        if not gsg:
+            warning(f'tried to remove {sg_from_key(key)} from {self.watcher_id} when not present')
             return
-        gsg = self.subscribed_gsgs[sg]
-        del(self.subscribed_gsgs[sg])
         del(gsg.subscribed_watchers[self.watcher_id])
+        top_assignments.note_change(self, key)
+        sg = gsg.sg
+        top_assignments.touch_watcher(self)
+        top_assignments.touch_gsg(gsg)
+        top_assignments.record({'op':'unsub', 'id':self.watcher_id, 'sg':sg_to_json(sg)})
         if len(gsg.subscribed_watchers) == 0:
-            info(f'all subscribers of {sg[0]}->{sg[1]} left')
-            del(top_assignments.subscribed_sgs[gsg.sg])
-            if gsg.assignment:
-                newly_freed = top_assignments.local_pool.return_local_sg(gsg.assignment.local_sg)
-                info(f'unassigned {gsg.assignment.local_sg[0]}->{gsg.assignment.local_sg[1]}, new space={newly_freed}')
-                gsg.assignment = None
-                if newly_freed:
-                    for sg,gsg in top_assignments.subscribed_sgs.items():
-                        if not gsg.assignment:
-                            local_sg = top_assignments.local_pool.borrow_local_sg(gsg)
-                            if local_sg:
-                                assignment = LocalAssignment(gsg, local_sg)
-                                gsg.assignment = assignment
-                                info(f'assigned {gsg.assignment.local_sg[0]}->{gsg.assignment.local_sg[1]} for {gsg.assignment.global_sg.sg[0]}->{gsg.assignment.global_sg.sg[1]}')
-                                break
-
-    def subscribe(self, top_assignments, sg):
-        gsg = top_assignments.subscribed_sgs.get(sg)
+            info('all subscribers of %s->%s left', sg[0], sg[1])
+            del(top_assignments.subscribed_sgs[key])
+            top_assignments.gsg_changed(gsg)
+            top_assignments.monitor_index.remove_sg(gsg)
+            if gsg.local_idx is not None:
+                top_assignments.release_local(gsg)
+            else:
+                top_assignments.pending.discard(gsg)
+        elif gsg.local_idx is None:
+            top_assignments.pending.update(gsg)
+
+    def subscribe(self, top_assignments, key):
+        gsg = top_assignments.subscribed_sgs.get(key)
+        is_new = False
         if not gsg:
-            gsg = GlobalSG(sg, top_assignments.new_sg_id())
-            top_assignments.subscribed_sgs[sg] = gsg
+            gsg = GlobalSG(key, top_assignments.new_sg_id())
+            top_assignments.subscribed_sgs[key] = gsg
+            top_assignments.monitor_index.add_sg(gsg)
+            top_assignments.gsg_changed(gsg)
+            is_new = True
+
+        if self.watcher_id not in gsg.subscribed_watchers:
+            gsg.subscribed_watchers[self.watcher_id] = self
+            if not is_new and gsg.local_idx is None:
+                top_assignments.pending.update(gsg)
+        if key not in self.subscribed_gsgs:
+            self.subscribed_gsgs[key] = gsg
+            top_assignments.note_change(self, key)
+            top_assignments.touch_watcher(self)
+            top_assignments.touch_gsg(gsg)
+            top_assignments.record({'op':'sub', 'id':self.watcher_id, 'sg':sg_to_json(gsg.sg), 'sg-id':gsg.sg_id})
+
+        if is_new:
             try:
-                local_sg = top_assignments.local_pool.borrow_local_sg(gsg)
+                top_assignments.assign_local(gsg)
             except Exception as e:
                 error(str(e))
                 error(traceback.format_exc())
                 raise
 
-            if local_sg:
-                assignment = LocalAssignment(gsg, local_sg)
-                gsg.assignment = assignment
-                info(f'assigned {gsg.assignment.local_sg[0]}->{gsg.assignment.local_sg[1]} for {gsg.assignment.global_sg.sg[0]}->{gsg.assignment.global_sg.sg[1]}')
-            else:
-                info(f'no local assignment returned for {gsg.assignment.global_sg.sg[0]}->{gsg.assignment.global_sg.sg[1]}')
-
-        if self.watcher_id not in gsg.subscribed_watchers:
-            gsg.subscribed_watchers[self.watcher_id] = self
-        if gsg.sg not in self.subscribed_gsgs:
-            self.subscribed_gsgs[gsg.sg] = gsg
-
-class LocalAssignment(object):
-    def __init__(self, global_sg, local_sg):
-        self.global_sg = global_sg
-        self.local_sg = local_sg
-
 class GlobalSG(object):
-    def __init__(self, sg, sg_id):
-        self.sg = sg
+    '''
+    A global (S,G) with at least one subscribed watcher.  It's held as
+    its packed sg_key, and its local assignment as the pool idx
+    (local_idx, None while unassigned) rather than a copy of the local
+    (S,G): both turn back into addresses on demand, so the millions of
+    these a big deployment holds cost a few ints each instead of
+    tuples of address objects.
+
+    fragment holds (local_idx, rendered) from Assignments.fragment
+    while one was asked for, so the watchers sharing it don't each
+    render it again; it's stale once local_idx moves.
+    '''
+    __slots__ = ('key', 'subscribed_watchers', 'local_idx', 'sg_id', 'fragment')
+
+    def __init__(self, key, sg_id):
+        self.key = key
         self.subscribed_watchers = {} # { Watcher.watcher_id: Watcher }
-        self.assignment = None
+        self.local_idx = None
         self.sg_id = sg_id
+        self.fragment = None
+
+    @property
+    def sg(self):
+        return sg_from_key(self.key)
 
 class BaseMonitor(object):
+    __slots__ = ('monitor_id',)
+
     def __init__(self, monitor_id):
         self.monitor_id = monitor_id
 
@@ -392,6 +602,8 @@ class BaseMonitor(object):
         return False
 
 class SourcePrefixMonitor(BaseMonitor):
+    __slots__ = ('src_pre',)
+
     def __init__(self, monitor_id, src_pre):
         super().__init__(monitor_id)
         self.src_pre = src_pre
@@ -401,133 +613,954 @@ class SourcePrefixMonitor(BaseMonitor):
             return True
         return False
 
+    def to_json(self):
+        return {'id': self.monitor_id, 'global-source-prefix': str(self.src_pre)}
+
+class PendingQueue(object):
+    '''
+    GlobalSGs waiting for a local assignment because the pool was full.
+
+    With order='fifo' they're handed out in the order they arrived, with
+    order='subscribers' the one with the most subscribed watchers goes
+    first (ties in arrival order).  add, discard and pop are O(1) for
+    fifo and O(log n) for subscribers, where subscriber count changes
+    push a fresh heap entry and the stale one is skipped when popped.
+    '''
+    def __init__(self, order='fifo'):
+        if order not in set(['fifo', 'subscribers']):
+            raise ValueError(f'unknown pending order "{order}" (expected fifo or subscribers)')
+        self.order = order
+        self.waiting = {} # { GlobalSG.key: GlobalSG } (insertion-ordered)
+        self.heap = []    # [ (-subscriber count, seq, GlobalSG.key) ]
+        self.entries = {} # { GlobalSG.key: (-subscriber count, seq) } (live heap entries)
+        self.next_seq = 0
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def _push(self, gsg):
+        entry = (-len(gsg.subscribed_watchers), self.next_seq)
+        self.next_seq += 1
+        self.entries[gsg.key] = entry
+        heappush(self.heap, entry + (gsg.key,))
+        if len(self.heap) > 2*len(self.entries) + 16:
+            self.heap = [entry + (key,) for key, entry in self.entries.items()]
+            heapify(self.heap)
+
+    def add(self, gsg):
+        if gsg.key in self.waiting:
+            return
+        self.waiting[gsg.key] = gsg
+        if self.order == 'subscribers':
+            self._push(gsg)
+
+    def discard(self, gsg):
+        if self.waiting.pop(gsg.key, None) and self.order == 'subscribers':
+            del(self.entries[gsg.key])
+
+    def update(self, gsg):
+        '''call when the subscriber count of a waiting GlobalSG changed'''
+        if self.order != 'subscribers' or gsg.key not in self.waiting:
+            return
+        if self.entries[gsg.key][0] != -len(gsg.subscribed_watchers):
+            self._push(gsg)
+
+    def pop(self):
+        if not self.waiting:
+            return None
+        if self.order == 'fifo':
+            key, gsg = next(iter(self.waiting.items()))
+            del(self.waiting[key])
+            return gsg
+        while True:
+            weight, seq, key = heappop(self.heap)
+            if self.entries.get(key) == (weight, seq):
+                del(self.entries[key])
+                return self.waiting.pop(key)
+
+def load_pool_file():
+    '''Returns (pool_fname, pool_json) from MNAT_POOL or the default location.'''
+    pool_fname = getenv('MNAT_POOL')
+    if pool_fname:
+        info(f'Loading {pool_fname} (set by MNAT_POOL environment)')
+    else:
+        pool_fname = '/etc/mnat/pool.json'
+        info(f'Loading {pool_fname} (default location)')
+
+    if isfile(pool_fname):
+        with open(pool_fname) as f:
+            pool_fd = f.read()
+        pool_json = json.loads(pool_fd)
+    else:
+        warning(f'no file at {pool_fname}, using default')
+        pool_fname = '(internal-default)'
+        pool_json = {'group-pool':{'ranges':[
+                { 'group-range': '239.1.1.0/29',
+                  'source-range':'10.9.1.2/32' } ] } }
+
+    return pool_fname, pool_json
+
+class InvariantStats(object):
+    '''Counts and timing for Assignments.check_invariants.'''
+    def __init__(self):
+        self.checks = 0
+        self.full_checks = 0
+        self.watchers_checked = 0
+        self.sgs_checked = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, full, watcher_count, sg_count, seconds):
+        self.checks += 1
+        if full:
+            self.full_checks += 1
+        self.watchers_checked += watcher_count
+        self.sgs_checked += sg_count
+        self.seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+
+    def __repr__(self):
+        return f'{self.checks} invariant checks ({self.full_checks} full), {self.watchers_checked} watchers and {self.sgs_checked} sgs checked in {self.seconds:.3f}s (max {self.max_seconds:.3f}s)'
+
+invariant_seconds = metrics.histogram('mnat_check_invariants_seconds')
+
 class Assignments(object):
     def __init__(self):
         self.watchers = {} # { Watcher.watcher_id : Watcher }
-        self.subscribed_sgs = {} # { GlobalSG.sg : GlobalSG }
+        self.subscribed_sgs = {} # { GlobalSG.key : GlobalSG }
+        self.monitor_index = MonitorIndex()
         self.timeout_duration = timedelta(seconds=60)
-        self.recheck_delay = timedelta(seconds=15)
         self.next_sg_id = 1
-        self.last_check = datetime.now()
-
-        pool_fname = getenv('MNAT_POOL')
-        if pool_fname:
-            info(f'Loading {pool_fname} (set by MNAT_POOL environment)')
-        else:
-            pool_fname = '/etc/mnat/pool.json'
-            info(f'Loading {pool_fname} (default location)')
-
-        if isfile(pool_fname):
-            with open(pool_fname) as f:
-                pool_fd = f.read()
-            pool_json = json.loads(pool_fd)
-        else:
-            warning(f'no file at {pool_fname}, using default')
-            pool_fname = '(internal-default)'
-            pool_json = {'group-pool':{'ranges':[
-                    { 'group-range': '239.1.1.0/29',
-                      'source-range':'10.9.1.2/32' } ] } }
-
-        self.local_pool = LocalPool(pool_fname, pool_json)
+        self.expiry = ExpiryScheduler(self.timeout_duration)
+        self.expiry_loop = None
+        self.expiry_handle = None
+
+        self.invariant_mode = getenv('MNAT_INVARIANTS', 'incremental')
+        if self.invariant_mode not in set(['full', 'incremental', 'sampled', 'off']):
+            raise ValueError(f'unknown MNAT_INVARIANTS mode "{self.invariant_mode}" (expected full, incremental, sampled or off)')
+        self.invariant_sample_rate = float(getenv('MNAT_INVARIANT_SAMPLE_RATE', '0.01'))
+        self.invariant_stats = InvariantStats()
+        self.touched_watchers = {} # { Watcher.watcher_id: Watcher } since the last check
+        self.touched_gsgs = {} # { GlobalSG.key: GlobalSG } since the last check
+
+        self.pool_source = load_pool_file()
+        self.local_pool = LocalPool(*self.pool_source)
+
+        # a standby (see replication.py) mirrors an active server's
+        # changes and rejects its own clients' until it takes over
+        self.standby = False
+        self.replicas = None
+
+        # watcher generations only mean something to the process that
+        # counted them, so the ones handed to clients carry this
+        self.generation_epoch = urandom(4).hex()
+        # called with the watcher_id whenever a watcher's generation
+        # moves (see push.py)
+        self.watcher_changed = None
+
+        pending_order = getenv('MNAT_PENDING_ORDER', 'fifo')
+        self.pending = PendingQueue(pending_order)
+
+        self.journal = None
+        self.replaying = False
+        journal_dir = getenv('MNAT_JOURNAL')
+        if journal_dir:
+            self.journal = AssignmentJournal(journal_dir,
+                    int(getenv('MNAT_JOURNAL_COMPACT', '10000')))
+            self.restore_from_journal()
 
     def new_sg_id(self):
         ret = self.next_sg_id
         self.next_sg_id += 1
         return ret
 
+    def assign_local(self, gsg):
+        '''
+        Borrows a local (S,G) for gsg, or queues it as pending if the
+        pool is exhausted.  Returns whether it got an assignment.
+        '''
+        idx = self.local_pool.borrow_idx(gsg)
+        sg = gsg.sg
+        if idx is None:
+            info('no local assignment available for %s->%s, pending (%d already waiting)', sg[0], sg[1], len(self.pending))
+            self.pending.add(gsg)
+            return False
+
+        gsg.local_idx = idx
+        local_sg = self.local_pool.local_sg(idx)
+        self.gsg_changed(gsg)
+        self.touch_gsg(gsg)
+        self.record({'op':'assign', 'sg':sg_to_json(sg),
+            'idx':idx, 'local':sg_to_json(local_sg)})
+        info('assigned %s->%s for %s->%s', local_sg[0], local_sg[1], sg[0], sg[1])
+        return True
+
+    def local_sg_of(self, gsg):
+        '''the local (S,G) assigned to gsg, or None'''
+        if gsg.local_idx is None:
+            return None
+        return self.local_pool.local_sg(gsg.local_idx)
+
+    def watcher_ids(self):
+        return list(self.watchers.keys())
+
+    def gsg_changed(self, gsg):
+        '''notes a change to gsg for every watcher it's mapped for'''
+        key = gsg.key
+        for w in gsg.subscribed_watchers.values():
+            self.note_change(w, key)
+        for watcher_id in self.monitor_index.watchers_covering(gsg):
+            w = self.watchers.get(watcher_id)
+            if w:
+                self.note_change(w, key)
+
+    def note_change(self, w, key):
+        w.note_change(key)
+        if self.watcher_changed:
+            self.watcher_changed(w.watcher_id)
+
+    def parse_generation(self, generation):
+        '''the watcher generation in a token from mapped_sgs_since, or None if it's not from this process'''
+        if not generation or not isinstance(generation, str):
+            return None
+        epoch, sep, count = generation.partition('.')
+        if epoch != self.generation_epoch or not count.isdigit():
+            return None
+        return int(count)
+
+    def refresh_watcher(self, watcher_id):
+        '''Returns False if there's no such watcher.'''
+        self.check_active()
+        w = self.watchers.get(watcher_id)
+        if not w:
+            return False
+        w.refresh()
+        # too frequent for the journal, but a standby needs them to
+        # expire watchers at the right time after it takes over
+        if self.replicas:
+            self.replicas.send({'op':'refresh', 'id':watcher_id})
+        return True
+
+    def refresh_watchers(self, watcher_ids):
+        '''refresh_watcher for each, returning the ids with no such watcher'''
+        self.check_active()
+        return [watcher_id for watcher_id in watcher_ids if not self.refresh_watcher(watcher_id)]
+
+    def mapped_sgs(self, watcher_id):
+        '''
+        [(global sg, sg_id, local sg or None)] for the watcher's
+        subscribed (S,G)s followed by the ones under its monitors, each
+        once, or None if there's no such watcher.
+        '''
+        w = self.watchers.get(watcher_id)
+        if not w:
+            return None
+        mapped = []
+        seen = set()
+        for key, gsg in w.subscribed_gsgs.items():
+            seen.add(key)
+            mapped.append((gsg.sg, gsg.sg_id, self.local_sg_of(gsg)))
+
+        # the monitor index already knows which GlobalSGs fall under each
+        # monitor, so this is proportional to what's reported
+        for mon in w.monitors.values():
+            for key, gsg in self.monitor_index.sgs_under(watcher_id, mon.monitor_id).items():
+                if key not in seen:
+                    seen.add(key)
+                    mapped.append((gsg.sg, gsg.sg_id, self.local_sg_of(gsg)))
+        return mapped
+
+    def fragment(self, gsg, render):
+        '''
+        render(global sg, sg_id, local sg or None) for gsg, kept on gsg
+        until its local assignment changes.  render is always the same
+        function (mapped_sg_json, for the state handlers), and what it
+        returns is shared, so callers mustn't modify it.
+        '''
+        cached = gsg.fragment
+        if cached and cached[0] == gsg.local_idx:
+            return cached[1]
+        rendered = render(gsg.sg, gsg.sg_id, self.local_sg_of(gsg))
+        gsg.fragment = (gsg.local_idx, rendered)
+        return rendered
+
+    def mapped_fragments(self, watcher_id, render):
+        '''mapped_sgs(watcher_id) as fragments from render, or None if there's no such watcher'''
+        w = self.watchers.get(watcher_id)
+        if not w:
+            return None
+        fragments = [self.fragment(gsg, render) for gsg in w.subscribed_gsgs.values()]
+        if w.monitors:
+            seen = w.subscribed_gsgs
+            found = {}
+            for mon in w.monitors.values():
+                for key, gsg in self.monitor_index.sgs_under(watcher_id, mon.monitor_id).items():
+                    if key not in seen and key not in found:
+                        found[key] = True
+                        fragments.append(self.fragment(gsg, render))
+        return fragments
+
+    def cached_response(self, watcher_id, build):
+        '''
+        build(watcher_id), reused until the watcher's generation moves
+        (anything that changes its mapped (S,G)s moves it), or None if
+        there's no such watcher.  Like fragment, the answer is shared.
+        '''
+        w = self.watchers.get(watcher_id)
+        if not w:
+            return None
+        if self.standby:
+            # records are applied without counting generations
+            return build(watcher_id)
+        cached = w.response_cache
+        if cached and cached[0] == w.generation:
+            return cached[1]
+        response = build(watcher_id)
+        w.response_cache = (w.generation, response)
+        return response
+
+    def mapped_sgs_since(self, watcher_id, generation):
+        '''
+        What changed in mapped_sgs(watcher_id) since the generation
+        token the client got from an earlier call (or None), as
+        (generation, kind, mapped, removed):
+          unchanged: nothing changed, mapped and removed are empty
+          delta: mapped holds only the entries added or changed, and
+            removed the global (S,G)s that aren't mapped any more
+          full: mapped is the whole list, since the changes from that
+            generation weren't kept (or it's from another process)
+        or None if there's no such watcher.
+        '''
+        w = self.watchers.get(watcher_id)
+        if not w:
+            return None
+        current = f'{self.generation_epoch}.{w.generation}'
+        since = self.parse_generation(generation)
+        keys = None
+        if since is not None and since <= w.generation and not self.standby:
+            if since == w.generation:
+                return current, 'unchanged', [], []
+            keys = w.changed_keys_since(since)
+        if keys is None:
+            return current, 'full', self.mapped_sgs(watcher_id), []
+
+        mapped = []
+        removed = []
+        for key in keys:
+            gsg = self.subscribed_sgs.get(key)
+            if gsg and (key in w.subscribed_gsgs or self.monitor_index.watcher_covers(watcher_id, key)):
+                mapped.append((gsg.sg, gsg.sg_id, self.local_sg_of(gsg)))
+            else:
+                removed.append(sg_from_key(key))
+        return current, 'delta', mapped, removed
+
+    def release_local(self, gsg):
+        '''
+        Returns gsg's local (S,G) to the pool and hands the freed space
+        to the next pending GlobalSG, if any are waiting.
+        '''
+        if enabled(INFO):
+            # only looked up for the log
+            local_sg = self.local_pool.local_sg(gsg.local_idx)
+            info('unassigned %s->%s (%d pending)', local_sg[0], local_sg[1], len(self.pending))
+        self.local_pool.return_idx(gsg.local_idx)
+        gsg.local_idx = None
+        self.touch_gsg(gsg)
+        self.record({'op':'unassign', 'sg':sg_to_json(gsg.sg)})
+        while len(self.pending) and self.local_pool.free_slots.free_count() > 0:
+            if not self.assign_local(self.pending.pop()):
+                break
+
+    def reload_pool(self):
+        '''
+        Re-reads the pool file and moves to the new pool, keeping every
+        assignment whose local (S,G) is still inside it.  Only the ones
+        that fall outside get a new local (S,G), or go pending if the new
+        pool is full.  Returns a dict of counts (kept, moved, pending).
+        '''
+        if self.standby:
+            warning("not reloading the pool on a standby: it uses the active server's pool")
+            return None
+        try:
+            pool_source = load_pool_file()
+            new_pool = LocalPool(*pool_source)
+        except Exception as e:
+            error(f'pool reload failed, keeping the current pool: {e}')
+            return None
+        self.pool_source = pool_source
+
+        old_pool = self.local_pool
+        displaced = []
+        kept = 0
+        for gsg in sorted(self.subscribed_sgs.values(), key=lambda x: x.sg_id):
+            if gsg.local_idx is None:
+                continue
+            global_sg = gsg.sg
+            local_sg = old_pool.local_sg(gsg.local_idx)
+            idx = new_pool.index_of(local_sg, global_sg)
+            if idx is not None and new_pool.claim_local_sg(idx, global_sg) == local_sg:
+                gsg.local_idx = idx
+                kept += 1
+            else:
+                displaced.append((gsg, local_sg))
+
+        self.local_pool = new_pool
+        for gsg in self.subscribed_sgs.values():
+            # rendered from the old pool's idxs
+            gsg.fragment = None
+        for gsg, old_local in displaced:
+            gsg.local_idx = None
+            self.gsg_changed(gsg)
+            self.touch_gsg(gsg)
+            sg = gsg.sg
+            self.record({'op':'unassign', 'sg':sg_to_json(sg)})
+            if self.assign_local(gsg):
+                new_local = self.local_sg_of(gsg)
+                info(f'pool reload moved {sg[0]}->{sg[1]} from {old_local[0]}->{old_local[1]} to {new_local[0]}->{new_local[1]}')
+            else:
+                info(f'pool reload unassigned {sg[0]}->{sg[1]} from {old_local[0]}->{old_local[1]}')
+
+        while len(self.pending) and self.local_pool.free_slots.free_count() > 0:
+            if not self.assign_local(self.pending.pop()):
+                break
+
+        # the pool idxs of kept assignments changed too
+        self.write_snapshot()
+        if self.replicas:
+            self.replicas.resync()
+        self.check_invariants()
+
+        report = {
+            'kept': kept,
+            'moved': len(displaced),
+            'pending': len(self.pending),
+        }
+        info(f'reloaded pool: {old_pool.sg_count} -> {new_pool.sg_count} sgs, {report}')
+        return report
+
+    def metric_counts(self):
+        '''the counts for metrics.render, all kept up to date as things change'''
+        pool = self.local_pool
+        assigned_count = len(pool.assigned_idxs)
+        return {
+            'watchers': len(self.watchers),
+            'global_sgs': len(self.subscribed_sgs),
+            'assigned_sgs': assigned_count,
+            'unassigned_sgs': len(self.subscribed_sgs) - assigned_count,
+            'ranges': [{'idx': rng.idx, 'group_range': rng.base_group_range,
+                    'size': rng.sg_count, 'in_use': rng.in_use} for rng in pool.ranges],
+        }
+
+    def check_active(self):
+        if self.standby:
+            raise ValueError('this server is a standby, not accepting changes')
+
     def create_watcher(self, watcher_id):
+        self.check_active()
+        return self.add_watcher(watcher_id)
+
+    def create_watchers(self, watcher_ids):
+        self.check_active()
+        return [self.add_watcher(watcher_id) for watcher_id in watcher_ids]
+
+    def add_watcher(self, watcher_id):
         if watcher_id in self.watchers:
             raise ValueError(f'watcher-id {watcher_id} already taken')
         w = Watcher(watcher_id)
         self.watchers[watcher_id] = w
+        self.expiry.schedule(w)
+        self.arm_expiry()
+        self.record({'op':'watcher', 'id':watcher_id})
         return w
 
+    def remove_watcher(self, w):
+        info('removing watcher %s (last refresh %s)', w.watcher_id, w.last_refresh)
+        del(self.watchers[w.watcher_id])
+        self.touch_watcher(w)
+        while len(w.subscribed_gsgs):
+            key = next(iter(w.subscribed_gsgs))
+            w.unsubscribe(self, key)
+        self.apply_monitors(w, [])
+        self.record({'op':'drop-watcher', 'id':w.watcher_id})
+        if self.watcher_changed:
+            self.watcher_changed(w.watcher_id)
+
+    def start_expiry_task(self, loop):
+        '''
+        Expires watchers from a timer on loop (the jetconf event loop)
+        close to their deadlines, instead of only when a request
+        happens to call check_timeouts.
+        '''
+        self.expiry_loop = loop
+        self.arm_expiry()
+
+    def stop_expiry_task(self):
+        if self.expiry_handle:
+            self.expiry_handle.cancel()
+            self.expiry_handle = None
+        self.expiry_loop = None
+
+    def arm_expiry(self):
+        if not self.expiry_loop or self.expiry_handle:
+            return
+        if self.standby:
+            # nothing pops the heap until promote() rebuilds it
+            return
+        deadline = self.expiry.next_deadline()
+        if deadline is None:
+            return
+        delay = max(0, (deadline - datetime.now()).total_seconds())
+        self.expiry_handle = self.expiry_loop.call_later(delay, self.run_expiry)
+
+    def run_expiry(self):
+        self.expiry_handle = None
+        try:
+            self.check_timeouts()
+        except Exception as e:
+            error(f'watcher expiry failed: {e}')
+            error(traceback.format_exc())
+        finally:
+            self.arm_expiry()
+
+    @timed('mnat_check_timeouts_seconds')
     def check_timeouts(self):
-        now = datetime.now()
-        if now - self.last_check < self.recheck_delay:
+        '''
+        Expires the watchers that are past their deadline.  Cheap enough
+        to call from request handlers: when nothing is due it's a peek at
+        the top of the expiry heap.
+        '''
+        if self.standby:
+            # the active expires them, and the records say so
+            return
+        expired = self.expiry.pop_expired(self.watchers, datetime.now())
+        if not expired:
             return
 
+        for w in expired:
+            self.remove_watcher(w)
         self.check_invariants()
-        self.last_check = now
-        removes = []
-        for w in self.watchers.values():
-            if now - w.last_refresh > self.timeout_duration:
-                removes.append(w)
-        for w in removes:
-            del(self.watchers[w.watcher_id])
-            gsg_removes = []
-            while len(w.subscribed_gsgs):
-                gsg = next(iter(w.subscribed_gsgs.values()))
-                w.unsubscribe(self, gsg.sg)
-        self.check_invariants()
+        self.maybe_compact()
 
     def set_monitors(self, watcher_id, monitors):
-        info(f'setting monitors {watcher_id}: {monitors}')
-        self.check_invariants()
+        info('setting monitors %s: %s', watcher_id, monitors)
+        self.check_active()
         w = self.watchers.get(watcher_id)
         if not w:
             w = self.create_watcher(watcher_id)
+        self.apply_monitors(w, monitors)
+        self.record({'op':'monitors', 'id':watcher_id,
+            'monitors':[mon.to_json() for mon in w.monitors.values()]})
+        self.touch_watcher(w)
+        self.check_invariants()
+        self.maybe_compact()
+
+    def apply_monitors(self, w, monitors):
+        changed = False
         set_ids = set()
         for monitor in monitors:
             mid = monitor['id']
-            set_ids.update(mid)
+            set_ids.add(mid)
             src_pre_str = monitor.get('global-source-prefix')
             if src_pre_str:
                 src_pre = ip_network(src_pre_str)
+                prior = w.monitors.get(mid)
+                if prior and prior.src_pre == src_pre:
+                    continue
                 mon = SourcePrefixMonitor(mid, src_pre)
                 w.monitors[mon.monitor_id] = mon
+                self.monitor_index.add_monitor(w.watcher_id, mon, self.subscribed_sgs)
+                changed = True
 
         removes = set(w.monitors.keys()) - set_ids
         for mid in removes:
             del(w.monitors[mid])
+            self.monitor_index.remove_monitor(w.watcher_id, mid)
+            changed = True
+        if changed:
+            w.note_reset()
+            if self.watcher_changed:
+                self.watcher_changed(w.watcher_id)
 
     def set_subscribed_sgs(self, watcher_id, sgs):
-        info(f'setting sgs {watcher_id}: {sgs}')
-        self.check_invariants()
+        info('setting sgs %s: %s', watcher_id, sgs)
+        self.check_active()
         w = self.watchers.get(watcher_id)
         if not w:
             w = self.create_watcher(watcher_id)
+        self.apply_subscribed_sgs(w, sgs)
+        self.check_invariants()
+        self.maybe_compact()
+
+    def set_watchers_subscribed_sgs(self, watcher_sgs):
+        '''
+        set_subscribed_sgs for each (watcher_id, sgs) in watcher_sgs,
+        with one invariant check and compaction check for all of them.
+        '''
+        info('setting sgs of %d watchers', len(watcher_sgs))
+        self.check_active()
+        for watcher_id, sgs in watcher_sgs:
+            debug('setting sgs %s: %s', watcher_id, sgs)
+            w = self.watchers.get(watcher_id)
+            if not w:
+                w = self.add_watcher(watcher_id)
+            self.apply_subscribed_sgs(w, sgs)
+        self.check_invariants()
+        self.maybe_compact()
+
+    def apply_subscribed_sgs(self, w, sgs):
+        keys = [sg_key(sg) for sg in sgs]
         if w.subscribed_gsgs:
-            checks = set(sgs)
+            checks = set(keys)
             removes = list(filter(lambda x: x not in checks, w.subscribed_gsgs.keys()))
-            for sg in removes:
-                w.unsubscribe(self, sg)
-        for sg in sgs:
-            w.subscribe(self, sg)
+            for key in removes:
+                w.unsubscribe(self, key)
+        for key in keys:
+            w.subscribe(self, key)
+
+    def update_subscribed_sgs(self, watcher_id, unsubscribes, subscribes):
+        '''
+        Changes some of a watcher's subscribed sgs without the rest of
+        the list, for the joined-sg edits of a yang-patch.
+        '''
+        info('updating sgs %s: -%s +%s', watcher_id, unsubscribes, subscribes)
+        self.check_active()
+        w = self.watchers.get(watcher_id)
+        if not w:
+            w = self.create_watcher(watcher_id)
+        for sg in unsubscribes:
+            w.unsubscribe(self, sg_key(sg))
+        for sg in subscribes:
+            w.subscribe(self, sg_key(sg))
         self.check_invariants()
+        self.maybe_compact()
 
-    def check_invariants(self):
+    def record(self, rec):
+        if self.replaying:
+            return
+        if self.journal:
+            self.journal.append(rec)
+        if self.replicas:
+            self.replicas.send(rec)
+
+    def maybe_compact(self):
+        if self.journal and self.journal.needs_compaction():
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        if not self.journal:
+            return
+        info(f'compacting journal ({self.journal.records_since_snapshot} records since last snapshot)')
+        self.journal.write_snapshot(self.snapshot())
+
+    def close_journal(self):
+        if self.journal:
+            self.write_snapshot()
+            self.journal.close()
+
+    def snapshot(self, refresh_times=False):
+        '''
+        The full state as plain json: watchers with their monitors and
+        subscribed (S,G)s, and GlobalSGs with their pool idx and local
+        (S,G) when assigned.  With refresh_times, watchers also carry
+        their last refresh (for a standby's sync; a restart from the
+        journal gives every watcher a fresh lease instead).
+        '''
+        watchers = []
         for wid, w in self.watchers.items():
+            w_dat = {
+                'id': wid,
+                'monitors': [mon.to_json() for mon in w.monitors.values()],
+                'sgs': [sg_to_json(sg_from_key(key)) for key in w.subscribed_gsgs.keys()],
+            }
+            if refresh_times:
+                w_dat['last-refresh'] = w.last_refresh.isoformat()
+            watchers.append(w_dat)
+        sgs = []
+        for gsg in self.subscribed_sgs.values():
+            sg_dat = {'sg': sg_to_json(gsg.sg), 'sg-id': gsg.sg_id}
+            if gsg.local_idx is not None:
+                sg_dat['idx'] = gsg.local_idx
+                sg_dat['local'] = sg_to_json(self.local_pool.local_sg(gsg.local_idx))
+            sgs.append(sg_dat)
+        return {
+            'version': 1,
+            'next-sg-id': self.next_sg_id,
+            'watchers': watchers,
+            'sgs': sgs,
+        }
+
+    def load_snapshot(self, snap):
+        self.next_sg_id = max(self.next_sg_id, snap.get('next-sg-id', 1))
+        for rec in snapshot_records(snap):
+            self.apply_record(rec)
+
+    def apply_record(self, rec):
+        '''
+        Applies one journal record literally, without the side effects
+        the original change had (those were recorded separately): a
+        sub doesn't borrow, an unsub doesn't hand space to pending
+        GlobalSGs, and an assign claims the recorded pool idx.
+        '''
+        op = rec['op']
+        if op == 'watcher':
+            w = self.watchers.get(rec['id'])
+            if not w:
+                w = self.add_watcher(rec['id'])
+            if 'last-refresh' in rec:
+                w.last_refresh = datetime.fromisoformat(rec['last-refresh'])
+        elif op == 'refresh':
+            w = self.watchers.get(rec['id'])
+            if w:
+                w.refresh()
+        elif op == 'drop-watcher':
+            w = self.watchers.get(rec['id'])
+            if w:
+                for key in list(w.subscribed_gsgs.keys()):
+                    self.apply_record({'op':'unsub', 'id':w.watcher_id, 'sg':sg_to_json(sg_from_key(key))})
+                self.apply_monitors(w, [])
+                del(self.watchers[w.watcher_id])
+        elif op == 'monitors':
+            w = self.watchers.get(rec['id'])
+            if w:
+                self.apply_monitors(w, rec['monitors'])
+        elif op == 'sub-sg' or op == 'sub':
+            key = sg_key(sg_from_json(rec['sg']))
+            gsg = self.subscribed_sgs.get(key)
+            if not gsg:
+                gsg = GlobalSG(key, rec['sg-id'])
+                self.subscribed_sgs[key] = gsg
+                self.monitor_index.add_sg(gsg)
+                if gsg.sg_id >= self.next_sg_id:
+                    self.next_sg_id = gsg.sg_id + 1
+            if op == 'sub':
+                w = self.watchers.get(rec['id'])
+                if w:
+                    gsg.subscribed_watchers[w.watcher_id] = w
+                    w.subscribed_gsgs[key] = gsg
+        elif op == 'unsub':
+            key = sg_key(sg_from_json(rec['sg']))
+            w = self.watchers.get(rec['id'])
+            gsg = self.subscribed_sgs.get(key)
+            if w and gsg and key in w.subscribed_gsgs:
+                del(w.subscribed_gsgs[key])
+                del(gsg.subscribed_watchers[w.watcher_id])
+                if len(gsg.subscribed_watchers) == 0:
+                    del(self.subscribed_sgs[key])
+                    self.monitor_index.remove_sg(gsg)
+                    if gsg.local_idx is not None:
+                        self.local_pool.return_idx(gsg.local_idx)
+                        gsg.local_idx = None
+        elif op == 'assign':
+            sg = sg_from_json(rec['sg'])
+            gsg = self.subscribed_sgs.get(sg_key(sg))
+            if gsg and gsg.local_idx is None:
+                local_sg = self.local_pool.claim_local_sg(rec['idx'], sg)
+                expected_sg = sg_from_json(rec['local'])
+                if local_sg != expected_sg:
+                    # the pool changed since this was recorded
+                    warning(f'could not restore {expected_sg[0]}->{expected_sg[1]} (pool idx {rec["idx"]}) for {sg[0]}->{sg[1]}')
+                    if local_sg:
+                        self.local_pool.return_local_sg(local_sg)
+                else:
+                    gsg.local_idx = rec['idx']
+        elif op == 'unassign':
+            gsg = self.subscribed_sgs.get(sg_key(sg_from_json(rec['sg'])))
+            if gsg and gsg.local_idx is not None:
+                self.local_pool.return_idx(gsg.local_idx)
+                gsg.local_idx = None
+        else:
+            warning(f'ignoring unknown journal record {rec}')
+
+    def restore_from_journal(self):
+        snap, records = self.journal.load()
+        self.replaying = True
+        try:
+            if snap:
+                self.load_snapshot(snap)
+            for rec in records:
+                try:
+                    self.apply_record(rec)
+                except Exception as e:
+                    warning(f'failed to replay journal record {rec}: {e}')
+        finally:
+            self.replaying = False
+
+        self.resume_after_replay()
+        info(f'restored {len(self.watchers)} watchers and {len(self.subscribed_sgs)} sgs ({len(self.pending)} unassigned) from journal')
+        self.write_snapshot()
+
+    def resume_after_replay(self):
+        '''
+        After state was rebuilt from records (which don't carry the
+        pending queue), queues the unassigned GlobalSGs in sg_id order,
+        assigns what fits and checks the result.
+        '''
+        for gsg in sorted(self.subscribed_sgs.values(), key=lambda x: x.sg_id):
+            if gsg.local_idx is None:
+                self.pending.add(gsg)
+        while len(self.pending) and self.local_pool.free_slots.free_count() > 0:
+            if not self.assign_local(self.pending.pop()):
+                break
+
+        for wid, w in self.watchers.items():
+            self.check_watcher_invariants(wid, w)
+        for key, gsg in self.subscribed_sgs.items():
+            self.check_gsg_invariants(key, gsg)
+
+    def reset_replica(self, pool_fname, pool_json, next_sg_id):
+        '''Drops all the state, ahead of a full sync from the active server onto its pool.'''
+        self.pool_source = (pool_fname, pool_json)
+        self.local_pool = LocalPool(pool_fname, pool_json)
+        self.watchers = {}
+        self.subscribed_sgs = {}
+        self.monitor_index = MonitorIndex()
+        self.expiry = ExpiryScheduler(self.timeout_duration)
+        self.pending = PendingQueue(self.pending.order)
+        self.touched_watchers = {}
+        self.touched_gsgs = {}
+        self.next_sg_id = next_sg_id
+        self.generation_epoch = urandom(4).hex()
+
+    def promote(self):
+        '''
+        Takes over from the active server this standby was mirroring:
+        starts accepting changes and expiring watchers (by their
+        replicated refresh times), with every local (S,G) as it was.
+        '''
+        self.standby = False
+        self.replaying = False
+        # generations weren't counted while replaying
+        self.generation_epoch = urandom(4).hex()
+        self.resume_after_replay()
+        self.write_snapshot()
+        # the heap entries are from when the watchers were synced, and
+        # replicated refreshes didn't move them
+        if self.expiry_handle:
+            self.expiry_handle.cancel()
+            self.expiry_handle = None
+        self.expiry = ExpiryScheduler(self.timeout_duration)
+        for w in self.watchers.values():
+            self.expiry.schedule(w)
+        self.arm_expiry()
+        info(f'took over as active with {len(self.watchers)} watchers and {len(self.subscribed_sgs)} sgs ({len(self.pending)} unassigned)')
+
+    def touch_watcher(self, w):
+        if self.invariant_mode == 'incremental':
+            self.touched_watchers[w.watcher_id] = w
+
+    def touch_gsg(self, gsg):
+        if self.invariant_mode == 'incremental':
+            self.touched_gsgs[gsg.key] = gsg
+
+    def check_invariants(self):
+        '''
+        Cross-checks the watcher<->GlobalSG back-references, according to
+        invariant_mode (MNAT_INVARIANTS in the environment):
+          full: every watcher and GlobalSG, every time (O(total state))
+          incremental: only the watchers and GlobalSGs touched since the
+            last check (the default)
+          sampled: a full check on a random invariant_sample_rate
+            fraction of calls
+          off: nothing
+        '''
+        mode = self.invariant_mode
+        if mode == 'off':
+            return
+
+        full = False
+        if mode == 'full':
+            full = True
+        elif mode == 'sampled':
+            if random() >= self.invariant_sample_rate:
+                return
+            full = True
+
+        start = perf_counter()
+        if full:
+            watchers = self.watchers
+            gsgs = self.subscribed_sgs
+        else:
+            watchers = self.touched_watchers
+            gsgs = self.touched_gsgs
+            self.touched_watchers = {}
+            self.touched_gsgs = {}
+
+        for wid, w in watchers.items():
+            self.check_watcher_invariants(wid, w)
+        for key, gsg in gsgs.items():
+            self.check_gsg_invariants(key, gsg)
+
+        seconds = perf_counter() - start
+        self.invariant_stats.record(full, len(watchers), len(gsgs), seconds)
+        invariant_seconds.observe(seconds)
+
+    def check_watcher_invariants(self, wid, w):
+        try:
+            assert(wid == w.watcher_id)
+        except:
+            print(f'invariant fail wid: {wid}')
+            raise
+        if self.watchers.get(wid) is not w:
+            # removed since it was touched
             try:
-                assert(wid == w.watcher_id)
+                assert(len(w.subscribed_gsgs) == 0)
             except:
-                print(f'invariant fail wid: {wid}')
+                print(f'invariant fail removed wid: {wid}')
                 raise
-            for sg, gsg in w.subscribed_gsgs.items():
-                try:
-                    assert(sg == gsg.sg)
-                    assert(sg in self.subscribed_sgs)
-                    assert(wid in gsg.subscribed_watchers)
-                    assert(gsg.subscribed_watchers[wid] is w)
-                except:
-                    print(f'invariant fail wid-backref: {wid}: {sg}')
-                    raise
-
-        for sg, gsg in self.subscribed_sgs.items():
+            return
+        for mid, mon in w.monitors.items():
             try:
-                assert(sg == gsg.sg)
+                assert(self.monitor_index.monitors.get((wid, mid)) is mon)
             except:
-                print(f'invariant fail sg: {sg}')
+                print(f'invariant fail wid-monitor: {wid}: {mid}')
+                raise
+        for key, gsg in w.subscribed_gsgs.items():
+            try:
+                assert(key == gsg.key)
+                assert(key in self.subscribed_sgs)
+                assert(wid in gsg.subscribed_watchers)
+                assert(gsg.subscribed_watchers[wid] is w)
+            except:
+                print(f'invariant fail wid-backref: {wid}: {sg_from_key(key)}')
                 raise
-            for wid, w in gsg.subscribed_watchers.items():
-                try:
-                    assert(wid == w.watcher_id)
-                    assert(wid in self.watchers)
-                    assert(sg in w.subscribed_gsgs)
-                    assert(w.subscribed_gsgs[sg] is gsg)
-                except:
-                    print(f'invariant fail sg-backref: {wid}: {sg}')
-                    raise
 
-assigned = Assignments()
+    def check_gsg_invariants(self, key, gsg):
+        try:
+            assert(key == gsg.key)
+        except:
+            print(f'invariant fail sg: {sg_from_key(key)}')
+            raise
+        if self.subscribed_sgs.get(key) is not gsg:
+            # all its subscribers left since it was touched
+            try:
+                assert(len(gsg.subscribed_watchers) == 0)
+                assert(gsg.local_idx is None)
+            except:
+                print(f'invariant fail removed sg: {gsg.sg}')
+                raise
+            return
+        try:
+            if gsg.local_idx is not None:
+                assert(gsg.local_idx in self.local_pool.assigned_idxs)
+        except:
+            print(f'invariant fail sg-assignment: {gsg.sg}')
+            raise
+        for mon_key in self.monitor_index.covering.get(key, ()):
+            try:
+                assert(self.monitor_index.monitors[mon_key].includes(gsg))
+                assert(self.monitor_index.covered[mon_key].get(key) is gsg)
+            except:
+                print(f'invariant fail sg-monitor: {mon_key}: {gsg.sg}')
+                raise
+        for wid, w in gsg.subscribed_watchers.items():
+            try:
+                assert(wid == w.watcher_id)
+                assert(wid in self.watchers)
+                assert(key in w.subscribed_gsgs)
+                assert(w.subscribed_gsgs[key] is gsg)
+            except:
+                print(f'invariant fail sg-backref: {wid}: {gsg.sg}')
+                raise
 
+assigned = Assignments()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+from heapq import heappush, heappop
+
+class ExpiryScheduler(object):
+    '''
+    Min-heap of (deadline, watcher) with one entry per watcher.
+
+    Refreshing a watcher only moves its last_refresh, it doesn't touch
+    the heap.  When an entry comes due, the watcher's real deadline is
+    checked: if it was refreshed in the meantime the entry is pushed
+    back at the new deadline, otherwise it's expired.  So a refresh is
+    O(1), and each watcher costs one O(log n) re-push per timeout period
+    instead of a scan of every watcher on every request.
+
+    Entries hold the Watcher itself rather than its id, so the entry of
+    a watcher that's gone is dropped when it comes due even if a new
+    watcher has taken the same id since.
+    '''
+    def __init__(self, timeout_duration):
+        self.timeout_duration = timeout_duration
+        self.heap = []  # [ (deadline, seq, Watcher) ]
+        self.next_seq = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, watcher):
+        deadline = watcher.last_refresh + self.timeout_duration
+        # seq breaks deadline ties, so Watchers are never compared
+        heappush(self.heap, (deadline, self.next_seq, watcher))
+        self.next_seq += 1
+
+    def next_deadline(self):
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def pop_expired(self, watchers, now):
+        '''
+        Returns the watchers (looked up in the watchers dict) whose
+        deadline has passed as of now, rescheduling any that were
+        refreshed since their entry was pushed.
+        '''
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, seq, w = heappop(self.heap)
+            if watchers.get(w.watcher_id) is not w:
+                # removed, and maybe replaced under the same id
+                continue
+            if w.last_refresh + self.timeout_duration > now:
+                self.schedule(w)
+            else:
+                expired.append(w)
+        return expired
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+'''
+mnat-server without jetconf: the ietf-mnat RESTCONF resources the mnat
+clients use, served straight from h2 on an asyncio loop.
+
+jetconf brings yangson's schema handling, NACM, per-user staging and
+its own routing to every request, for a handful of paths whose shapes
+are fixed.  This serves those paths under the same API root, with the
+same json in and out, so the H2Protocol clients can't tell the
+difference:
+
+ * POST <root>/operations/ietf-mnat:<rpc>, for the rpcs in rpcs.py
+ * GET <root>/data/ietf-mnat:assigned-channels[/watcher=<id>]
+ * GET, POST, PUT and DELETE of <root>/data/ietf-mnat:egress-global-joined
+   and ietf-mnat:ingress-watching watcher entries, kept in a
+   WatcherConfig (as with MNAT_WATCHER_CONFIG=direct)
+ * GET /metrics, the prometheus text of metrics.py (which MNAT_METRICS
+   also serves as plain HTTP, as under jetconf)
+
+Everything else is refused the way a server without it would: a PATCH
+gets 405, so egresses send PUTs instead, and establish-subscription
+gets operation-not-supported, so clients poll.  The MNAT_* settings of
+the assignments (pool, journal, replication) apply as they do
+under jetconf.
+
+Run from the server/module directory:
+    python3 -m jetconf_mnat.h2_server --cert server.crt --key server.key
+'''
+
+import sys
+import argparse
+import asyncio
+import json
+import logging
+import signal
+import ssl
+import traceback
+from urllib.parse import unquote
+
+from colorlog import info, warning, error, debug, basicConfig
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import (RequestReceived, DataReceived, StreamEnded, StreamReset,
+        WindowUpdated, ConnectionTerminated)
+from h2.exceptions import ProtocolError, StreamClosedError
+
+from .assignments import assigned
+from .assigned_json import watcher_assignments_json
+from .watcher_config import WatcherConfig, EntryExists
+from .replication import start_replication
+from .metrics import metrics, start_metrics, CTYPE_METRICS
+from . import rpcs
+
+CTYPE_YANG_JSON = 'application/yang-data+json'
+
+EGRESS = 'ietf-mnat:egress-global-joined'
+INGRESS = 'ietf-mnat:ingress-watching'
+ASSIGNED = 'ietf-mnat:assigned-channels'
+
+class RestconfError(Exception):
+    '''An error answer, as jetconf's HttpResponse.error makes them.'''
+    def __init__(self, status, tag, message):
+        super().__init__(message)
+        self.status = status
+        self.tag = tag
+
+    def body(self):
+        return dumps({'ietf-restconf:errors': {'error': [{
+            'error-type': 'protocol',
+            'error-tag': self.tag,
+            'error-message': str(self)
+        }]}})
+
+def dumps(value):
+    return json.dumps(value, separators=(',',':')).encode()
+
+def parse_body(body):
+    try:
+        return json.loads(body) if body else {}
+    except ValueError as e:
+        raise RestconfError(400, 'malformed-message', f'Failed to parse request body: {e}')
+
+class MnatApi(object):
+    '''
+    The request handling, apart from the transport: handle() takes a
+    request's method, path and body and gives the status and body of
+    the answer.
+    '''
+    def __init__(self, top, root='/mnat-ds'):
+        self.top = top
+        self.root = root
+        self.watcher_config = WatcherConfig()
+
+    def handle(self, method, path, body):
+        try:
+            return self.route(method, path.split('?', 1)[0], body)
+        except RestconfError as e:
+            return e.status, e.body()
+        except EntryExists as e:
+            return 409, RestconfError(409, 'data-exists', str(e)).body()
+        except ValueError as e:
+            return 400, RestconfError(400, 'invalid-value', str(e)).body()
+        except Exception as e:
+            error(f'{method} {path} failed: {e}')
+            error(traceback.format_exc())
+            return 500, RestconfError(500, 'operation-failed', str(e)).body()
+
+    def route(self, method, path, body):
+        if path.startswith(self.root + '/operations/'):
+            if method != 'POST':
+                raise RestconfError(405, 'operation-not-supported', f'{method} of an operation')
+            return self.invoke_op(path[len(self.root + '/operations/'):], body)
+        if path.startswith(self.root + '/data/'):
+            return self.data(method, path[len(self.root + '/data/'):], body)
+        raise RestconfError(404, 'invalid-value', f'No resource {path}')
+
+    def invoke_op(self, name, body):
+        module, sep, op = name.partition(':')
+        handler = rpcs.RPCS.get(op) if module == 'ietf-mnat' else None
+        if not handler:
+            raise RestconfError(400, 'operation-not-supported', f'No handler for operation {name}')
+        value = parse_body(body)
+        if not isinstance(value, dict):
+            raise ValueError('Operation input must be an object')
+        output = handler(self.top, value.get('ietf-mnat:input') or {})
+        if output is None:
+            return 204, b''
+        return 200, dumps(output)
+
+    def data(self, method, path, body):
+        container, sep, entry = path.partition('/')
+        watcher_id = None
+        if entry:
+            if not entry.startswith('watcher=') or '/' in entry:
+                raise RestconfError(404, 'invalid-value', f'No resource {path}')
+            watcher_id = unquote(entry[len('watcher='):])
+
+        if container == ASSIGNED:
+            if method != 'GET':
+                raise RestconfError(405, 'operation-not-supported', f'{method} of {container}')
+            return 200, dumps(self.get_assigned(watcher_id))
+        if container not in (EGRESS, INGRESS):
+            raise RestconfError(404, 'invalid-value', f'No resource {path}')
+
+        egress = container == EGRESS
+        config = self.watcher_config
+        if method == 'GET':
+            if watcher_id is None:
+                return 200, dumps({container: config.egress_json() if egress else config.ingress_json()})
+            if egress:
+                joined = config.egress.get(watcher_id)
+                value = joined.to_json(watcher_id) if joined else None
+            else:
+                value = config.ingress.get(watcher_id)
+            if value is None:
+                raise RestconfError(404, 'invalid-value', f'No watcher {watcher_id} in {container}')
+            return 200, dumps({'ietf-mnat:watcher': [value]})
+        if method == 'POST' and watcher_id is None:
+            config.create(self.top, egress, parse_body(body))
+            return 201, b''
+        if method == 'PUT' and watcher_id is not None:
+            existed = config.update(self.top, egress, watcher_id, parse_body(body))
+            return (204 if existed else 201), b''
+        if method == 'DELETE' and watcher_id is not None:
+            if not config.delete(egress, watcher_id):
+                raise RestconfError(404, 'invalid-value', f'No watcher {watcher_id} in {container}')
+            return 204, b''
+        raise RestconfError(405, 'operation-not-supported', f'{method} of {path}')
+
+    def get_assigned(self, watcher_id):
+        self.top.check_timeouts()
+        if watcher_id is None:
+            watchers = [watcher_assignments_json(self.top, wid) for wid in self.top.watcher_ids()]
+            return {ASSIGNED: {'watcher': [w for w in watchers if w]}}
+        watcher_dat = watcher_assignments_json(self.top, watcher_id)
+        if not watcher_dat:
+            # jetconf answers an unknown watcher with an empty 200 (see
+            # AssignedWatcherHandler), and the clients take that as
+            # their cue to get a new watcher-id
+            warning(f'no such watcher-id: {watcher_id} in assigned-channels/watcher')
+            return {}
+        return {'ietf-mnat:watcher': [watcher_dat]}
+
+class H2ServerProtocol(asyncio.Protocol):
+    '''
+    One client connection.  A request is handled when its stream ends,
+    and its answer goes out as fast as the client's flow control
+    windows let it.
+    '''
+    def __init__(self, api, max_body=1<<24):
+        self.api = api
+        self.max_body = max_body
+        self.conn = H2Connection(config=H2Configuration(client_side=False, header_encoding='utf-8'))
+        self.transport = None
+        self.requests = {}  # { stream id: [headers, body chunks, body length] }
+        self.unsent = {}    # { stream id: response data waiting on a window }
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def connection_lost(self, exc):
+        self.requests.clear()
+        self.unsent.clear()
+
+    def data_received(self, data):
+        try:
+            events = self.conn.receive_data(data)
+        except ProtocolError as e:
+            warning(f'closing connection on protocol error: {e}')
+            self.flush()
+            self.transport.close()
+            return
+
+        for event in events:
+            if isinstance(event, RequestReceived):
+                self.requests[event.stream_id] = [dict(event.headers), [], 0]
+            elif isinstance(event, DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                req = self.requests.get(event.stream_id)
+                if req:
+                    req[2] += len(event.data)
+                    # past max_body only the length is kept, for the 413
+                    if req[2] <= self.max_body:
+                        req[1].append(event.data)
+            elif isinstance(event, StreamEnded):
+                self.dispatch(event.stream_id)
+            elif isinstance(event, StreamReset):
+                self.requests.pop(event.stream_id, None)
+                self.unsent.pop(event.stream_id, None)
+            elif isinstance(event, WindowUpdated):
+                if event.stream_id:
+                    self.send_unsent(event.stream_id)
+                else:
+                    for stream_id in list(self.unsent):
+                        self.send_unsent(stream_id)
+            elif isinstance(event, ConnectionTerminated):
+                self.flush()
+                self.transport.close()
+                return
+        self.flush()
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.transport.write(data)
+
+    def dispatch(self, stream_id):
+        headers, chunks, length = self.requests.pop(stream_id)
+        method, path = headers.get(':method'), headers.get(':path', '')
+        ctype = CTYPE_YANG_JSON
+        if length > self.max_body:
+            # the clients take a reset stream as a dead connection
+            status, body = 413, RestconfError(413, 'request-too-large',
+                    f'{length} byte body (the limit is {self.max_body})').body()
+        elif method == 'GET' and path.split('?', 1)[0] == '/metrics':
+            status, body = 200, metrics.render(self.api.top).encode()
+            ctype = CTYPE_METRICS
+        else:
+            status, body = self.api.handle(method, path, b''.join(chunks))
+        debug('%s %s: %d (%d bytes)', method, path, status, len(body))
+        self.respond(stream_id, status, body, ctype)
+
+    def respond(self, stream_id, status, body, ctype=CTYPE_YANG_JSON):
+        headers = [(':status', str(status)), ('server', 'mnat-server'),
+                ('content-length', str(len(body)))]
+        if body:
+            headers.append(('content-type', ctype))
+        self.conn.send_headers(stream_id, headers, end_stream=not body)
+        if body:
+            self.unsent[stream_id] = body
+            self.send_unsent(stream_id)
+
+    def send_unsent(self, stream_id):
+        data = self.unsent.get(stream_id)
+        if data is None:
+            return
+        try:
+            size = min(self.conn.local_flow_control_window(stream_id), len(data))
+            frame_size = self.conn.max_outbound_frame_size
+            for offset in range(0, size, frame_size):
+                self.conn.send_data(stream_id, data[offset:min(offset + frame_size, size)])
+            if size == len(data):
+                self.conn.end_stream(stream_id)
+                del(self.unsent[stream_id])
+            else:
+                self.unsent[stream_id] = data[size:]
+        except StreamClosedError:
+            del(self.unsent[stream_id])
+
+def tls_context(certfile, keyfile, client_ca):
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.options |= ssl.OP_NO_COMPRESSION
+    ctx.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    ctx.set_alpn_protocols(['h2'])
+    if client_ca:
+        ctx.load_verify_locations(cafile=client_ca)
+        ctx.verify_mode = ssl.CERT_REQUIRED
+    return ctx
+
+def main(args_in):
+    parser = argparse.ArgumentParser(description='mnat-server on h2 and asyncio, without jetconf')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('--listen',
+            help='address to listen on (default: all of them)')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--root', default='/mnat-ds',
+            help='the API root, as jetconf\'s API_ROOT')
+    parser.add_argument('--cert', help='server certificate (pem)')
+    parser.add_argument('--key', help='server certificate\'s private key (pem)')
+    parser.add_argument('--client-ca',
+            help='CA that client certificates must chain to (default: no client certificates asked for)')
+    parser.add_argument('--no-tls', action='store_true',
+            help='serve HTTP/2 without TLS (h2c with prior knowledge), for local testing')
+    args = parser.parse_args(args_in[1:])
+
+    level = logging.WARNING
+    if args.verbose >= 2:
+        level = logging.DEBUG
+    elif args.verbose >= 1:
+        level = logging.INFO
+    # force: loading the pool at import already logged through the defaults
+    basicConfig(level=level, force=True)
+
+    ctx = None
+    if not args.no_tls:
+        if not args.cert or not args.key:
+            parser.error('--cert and --key are needed (or --no-tls)')
+        ctx = tls_context(args.cert, args.key, args.client_ca)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    assigned.start_expiry_task(loop)
+    # kill -HUP reloads the pool file, keeping assignments that still fit
+    loop.add_signal_handler(signal.SIGHUP, assigned.reload_pool)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, loop.stop)
+    replication = start_replication(assigned, loop)
+    metrics_server = start_metrics(assigned, loop)
+
+    api = MnatApi(assigned, args.root)
+    server = loop.run_until_complete(loop.create_server(
+        lambda: H2ServerProtocol(api), host=args.listen, port=args.port, ssl=ctx))
+    info(f'serving {args.root} on {args.listen or "*"} port {args.port}{" (no tls)" if not ctx else ""}')
+    try:
+        loop.run_forever()
+    finally:
+        info('cleaning up')
+        server.close()
+        if metrics_server:
+            metrics_server.stop()
+        if replication:
+            replication.stop()
+        assigned.stop_expiry_task()
+        assigned.close_journal()
+        loop.close()
+    return 0
+
+if __name__=="__main__":
+    ret=main(sys.argv)
+    sys.exit(ret)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+from heapq import heappush, heappop
+
+def net_interval(net):
+    '''the half-open integer interval [start, end) of an ip_network'''
+    start = int(net.network_address)
+    return (start, start + net.num_addresses)
+
+def find_overlaps(intervals):
+    '''
+    Returns (i, j) index pairs (i < j) for every pair of intervals that
+    overlap, from a sort and a sweep that only keeps the intervals still
+    open at each start, so it's O(k log k) plus the number of overlaps
+    rather than comparing every pair.
+    '''
+    order = sorted(range(len(intervals)), key=lambda i: intervals[i])
+    open_ends = []  # heap of (end, idx)
+    overlaps = []
+    for i in order:
+        start, end = intervals[i]
+        while open_ends and open_ends[0][0] <= start:
+            heappop(open_ends)
+        for prior_end, j in open_ends:
+            overlaps.append((min(i,j), max(i,j)))
+        heappush(open_ends, (end, i))
+    return overlaps
+
+def merge_intervals(intervals):
+    '''sorted, disjoint union of intervals, with touching ones joined'''
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+def subtract_intervals(base, excludes):
+    '''
+    Returns the sorted intervals left of base after removing excludes,
+    which must be sorted and disjoint (as from merge_intervals).
+    '''
+    start, end = base
+    remaining = []
+    for ex_start, ex_end in excludes:
+        if ex_end <= start:
+            continue
+        if ex_start >= end:
+            break
+        if ex_start > start:
+            remaining.append((start, ex_start))
+        start = max(start, ex_end)
+    if start < end:
+        remaining.append((start, end))
+    return remaining
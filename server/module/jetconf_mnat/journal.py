@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+from colorlog import info, warning
+from os import fsync, rename, makedirs
+from os.path import isfile, join
+import json
+
+class AssignmentJournal(object):
+    '''
+    Append-only on-disk record of the changes to Assignments, plus a
+    periodically compacted snapshot, so a restarted server comes back
+    with the same watchers and the same local (S,G) for every global
+    (S,G) instead of reshuffling them all.
+
+    The directory holds snapshot.json (the full state as of the last
+    compaction) and journal.jsonl (one json record per change since
+    then).  Records are flushed to the OS as they're written, so they
+    survive a crash of the server process; the snapshot is fsynced and
+    renamed into place, so a crash mid-compaction leaves the previous
+    snapshot and journal intact.
+    '''
+    def __init__(self, dirname, compact_after=10000):
+        self.dirname = dirname
+        self.snapshot_fname = join(dirname, 'snapshot.json')
+        self.journal_fname = join(dirname, 'journal.jsonl')
+        self.compact_after = compact_after
+        self.records_since_snapshot = 0
+        self.journal_f = None
+        makedirs(dirname, exist_ok=True)
+
+    def load(self):
+        '''
+        Returns (snapshot, records): the last snapshot (or None) and the
+        list of journal records written after it.  A torn last line
+        (from a crash mid-write) is dropped.
+        '''
+        snapshot = None
+        if isfile(self.snapshot_fname):
+            with open(self.snapshot_fname) as f:
+                snapshot = json.load(f)
+
+        records = []
+        if isfile(self.journal_fname):
+            with open(self.journal_fname) as f:
+                line_num = 0
+                for line in f:
+                    line_num += 1
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError as e:
+                        warning(f'{self.journal_fname}:{line_num}: dropping unreadable journal record ({e})')
+        info(f'loaded journal from {self.dirname}: {"a" if snapshot else "no"} snapshot and {len(records)} records')
+        return snapshot, records
+
+    def append(self, rec):
+        if not self.journal_f:
+            self.journal_f = open(self.journal_fname, 'a')
+        self.journal_f.write(json.dumps(rec, separators=(',',':')) + '\n')
+        self.journal_f.flush()
+        self.records_since_snapshot += 1
+
+    def needs_compaction(self):
+        return self.records_since_snapshot >= self.compact_after
+
+    def write_snapshot(self, snapshot):
+        '''
+        Replaces the snapshot and truncates the journal.  snapshot must
+        reflect every record appended so far.
+        '''
+        tmp_fname = self.snapshot_fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(snapshot, f, separators=(',',':'))
+            f.flush()
+            fsync(f.fileno())
+        rename(tmp_fname, self.snapshot_fname)
+
+        if self.journal_f:
+            self.journal_f.close()
+        self.journal_f = open(self.journal_fname, 'w')
+        self.records_since_snapshot = 0
+
+    def close(self):
+        if self.journal_f:
+            self.journal_f.close()
+            self.journal_f = None
+
+def snapshot_records(snap):
+    '''
+    The records that rebuild a snapshot when applied to empty state:
+    every GlobalSG and its assignment, then the watchers with their
+    monitors and subscriptions.
+    '''
+    for sg_dat in snap.get('sgs', []):
+        yield {'op':'sub-sg', 'sg':sg_dat['sg'], 'sg-id':sg_dat['sg-id']}
+        if 'idx' in sg_dat:
+            yield {'op':'assign', 'sg':sg_dat['sg'],
+                'idx':sg_dat['idx'], 'local':sg_dat['local']}
+    for w_dat in snap.get('watchers', []):
+        w_rec = {'op':'watcher', 'id':w_dat['id']}
+        if 'last-refresh' in w_dat:
+            w_rec['last-refresh'] = w_dat['last-refresh']
+        yield w_rec
+        yield {'op':'monitors', 'id':w_dat['id'], 'monitors':w_dat['monitors']}
+        for sg_val in w_dat['sgs']:
+            yield {'op':'sub', 'id':w_dat['id'], 'sg':sg_val}
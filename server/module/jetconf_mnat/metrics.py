@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+from colorlog import info, debug
+from bisect import bisect_left
+from functools import wraps
+from os import getenv, unlink
+from os.path import exists
+from time import perf_counter
+import asyncio
+
+from .addresses import parse_address
+
+# histogram bucket upper bounds in seconds, 10us to 10s (and +Inf)
+BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+        1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'mnat_watchers': 'watchers with a live watcher-id',
+    'mnat_global_sgs': 'global (S,G)s subscribed by at least one watcher',
+    'mnat_assigned_sgs': 'global (S,G)s with a local (S,G) assigned',
+    'mnat_unassigned_sgs': 'global (S,G)s waiting on an exhausted pool',
+    'mnat_pool_range_size': 'local (S,G)s in the pool range',
+    'mnat_pool_range_in_use': 'local (S,G)s of the pool range assigned',
+    'mnat_borrow_local_sg_seconds': 'time to pick and take a free pool slot',
+    'mnat_check_timeouts_seconds': 'time to expire the watchers past their deadline',
+    'mnat_check_invariants_seconds': 'time of the invariant checks that ran (see MNAT_INVARIANTS)',
+    'mnat_watcher_assignments_seconds': "time to build a watcher's assigned-channels entry",
+    'mnat_rpc_seconds': 'time in each rpc handler',
+}
+
+class Histogram(object):
+    '''
+    Counts of observed durations per bucket of BUCKETS, plus their sum.
+    An observe is a bisect and two adds, so these stay on all the time.
+    '''
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+
+class Metrics(object):
+    '''
+    The histograms, by metric name and labels.  The counts of watchers,
+    (S,G)s and pool use aren't kept here: the assignments keep them up
+    to date as they change (see metric_counts) and they're read at
+    scrape time.
+    '''
+    def __init__(self):
+        self.histograms = {} # { (name, ((label, value),...)): Histogram }
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if not hist:
+            hist = Histogram()
+            self.histograms[key] = hist
+        return hist
+
+    def timed(self, name, **labels):
+        '''decorator observing each call's duration in the named histogram'''
+        hist = self.histogram(name, **labels)
+        def wrap(fn):
+            @wraps(fn)
+            def timed_fn(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    hist.observe(perf_counter() - start)
+            return timed_fn
+        return wrap
+
+    def render(self, top):
+        '''the counts of top (an Assignments) and the histograms, in the prometheus text format'''
+        lines = []
+        def family(name, kind):
+            lines.append(f'# HELP {name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        counts = top.metric_counts()
+        for name in ('watchers', 'global_sgs', 'assigned_sgs', 'unassigned_sgs'):
+            family(f'mnat_{name}', 'gauge')
+            lines.append(f'mnat_{name} {counts[name]}')
+        ranges = counts['ranges']
+        for name, field in (('mnat_pool_range_size', 'size'), ('mnat_pool_range_in_use', 'in_use')):
+            family(name, 'gauge')
+            for rng in ranges:
+                lines.append(f'{name}{{range="{rng["idx"]}",group_range="{rng["group_range"]}"}} {rng[field]}')
+
+        by_name = {}
+        for (name, labels), hist in self.histograms.items():
+            by_name.setdefault(name, []).append((labels, hist))
+        for name, hists in sorted(by_name.items()):
+            family(name, 'histogram')
+            for labels, hist in sorted(hists, key=lambda x: x[0]):
+                label_str = ''.join(f'{label}="{value}",' for label, value in labels)
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), hist.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label_str}le="{bound}"}} {cumulative}')
+                label_str = label_str.rstrip(',')
+                if label_str:
+                    label_str = f'{{{label_str}}}'
+                lines.append(f'{name}_sum{label_str} {hist.total:.6f}')
+                lines.append(f'{name}_count{label_str} {cumulative}')
+        lines.append('')
+        return '\n'.join(lines)
+
+metrics = Metrics()
+timed = metrics.timed
+
+CTYPE_METRICS = 'text/plain; version=0.0.4; charset=utf-8'
+
+class MetricsServer(object):
+    '''
+    A plain-HTTP scrape endpoint: GET /metrics answers metrics.render,
+    anything else gets a 404.  Each connection gets one answer and is
+    closed.
+    '''
+    def __init__(self, top, address):
+        self.top = top
+        self.address = address
+        self.server = None
+
+    def start(self, loop):
+        kind, addr = parse_address(self.address)
+        if kind == 'unix':
+            if exists(addr):
+                # left over from an earlier run
+                unlink(addr)
+            coro = asyncio.start_unix_server(self.serve, path=addr)
+        else:
+            coro = asyncio.start_server(self.serve, host=addr[0], port=addr[1])
+        if loop.is_running():
+            loop.create_task(self.listen(coro))
+        else:
+            loop.run_until_complete(self.listen(coro))
+
+    async def listen(self, coro):
+        self.server = await coro
+        info(f'metrics: serving /metrics on {self.address}')
+
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    async def serve(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                # headers, ignored
+                pass
+            method, path = (request_line.decode('latin-1').split() + ['', ''])[:2]
+            if method == 'GET' and path.split('?', 1)[0] == '/metrics':
+                status, ctype, body = '200 OK', CTYPE_METRICS, metrics.render(self.top).encode()
+            else:
+                status, ctype, body = '404 Not Found', 'text/plain', b'not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except ConnectionError as e:
+            debug(f'metrics: dropped scrape: {e}')
+        finally:
+            writer.close()
+
+def start_metrics(top, loop):
+    '''
+    Serves the metrics at MNAT_METRICS ("tcp:<host>:<port>" or
+    "unix:<path>"), if it's set.  Returns the MetricsServer, or None.
+    '''
+    address = getenv('MNAT_METRICS')
+    if not address:
+        return None
+    server = MetricsServer(top, address)
+    server.start(loop)
+    return server
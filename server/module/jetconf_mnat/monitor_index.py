@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+class MonitorIndex(object):
+    '''
+    Which GlobalSGs fall under each watcher's source-prefix monitors,
+    kept up to date as monitors and GlobalSGs come and go, so that
+    reporting a watcher's monitored (S,G)s costs the size of the answer
+    instead of a scan of every monitor against every GlobalSG.
+
+    Monitor prefixes are kept in one hash table per (ip version, prefix
+    length), keyed by the prefix bits of the network.  Finding the
+    monitors covering a new GlobalSG's source is one lookup per prefix
+    length in use (at most 33 or 129), which is what a path-compressed
+    trie would cost too, without the node bookkeeping.
+
+    Monitors are keyed by (watcher_id, monitor_id).
+    '''
+    def __init__(self):
+        self.tables = {}   # { (version, prefixlen): { prefix bits: set(monitor key) } }
+        self.monitors = {} # { monitor key: SourcePrefixMonitor }
+        self.covered = {}  # { monitor key: { GlobalSG.key: GlobalSG } }
+        self.covering = {} # { GlobalSG.key: set(monitor key) } (only sgs under some monitor)
+
+    @staticmethod
+    def prefix_bits(addr, version, prefixlen):
+        return int(addr) >> ((32 if version == 4 else 128) - prefixlen)
+
+    def add_monitor(self, watcher_id, mon, subscribed_sgs):
+        '''
+        Indexes mon for watcher_id, replacing any monitor with the same
+        id.  The GlobalSGs already under it are found with one pass over
+        subscribed_sgs; after that they're kept up to date by add_sg and
+        remove_sg.
+        '''
+        key = (watcher_id, mon.monitor_id)
+        if key in self.monitors:
+            self.remove_monitor(watcher_id, mon.monitor_id)
+        src_pre = mon.src_pre
+        table_key = (src_pre.version, src_pre.prefixlen)
+        bits = self.prefix_bits(src_pre.network_address, src_pre.version, src_pre.prefixlen)
+        self.tables.setdefault(table_key, {}).setdefault(bits, set()).add(key)
+        self.monitors[key] = mon
+
+        covered = {}
+        for sg_key, gsg in subscribed_sgs.items():
+            if mon.includes(gsg):
+                covered[sg_key] = gsg
+                self.covering.setdefault(sg_key, set()).add(key)
+        self.covered[key] = covered
+
+    def remove_monitor(self, watcher_id, monitor_id):
+        key = (watcher_id, monitor_id)
+        mon = self.monitors.pop(key, None)
+        if not mon:
+            return
+        src_pre = mon.src_pre
+        table_key = (src_pre.version, src_pre.prefixlen)
+        bits = self.prefix_bits(src_pre.network_address, src_pre.version, src_pre.prefixlen)
+        table = self.tables[table_key]
+        keys = table[bits]
+        keys.discard(key)
+        if not keys:
+            del(table[bits])
+            if not table:
+                del(self.tables[table_key])
+
+        for sg_key in self.covered.pop(key):
+            keys = self.covering[sg_key]
+            keys.discard(key)
+            if not keys:
+                del(self.covering[sg_key])
+
+    def covering_monitors(self, sg):
+        '''keys of the monitors whose prefix holds sg's source, by lookup'''
+        src = sg[0]
+        if src is None:
+            return set()
+        found = set()
+        for (version, prefixlen), table in self.tables.items():
+            if version != src.version:
+                continue
+            keys = table.get(self.prefix_bits(src, version, prefixlen))
+            if keys:
+                found.update(keys)
+        return found
+
+    def add_sg(self, gsg):
+        if not self.tables:
+            return
+        keys = self.covering_monitors(gsg.sg)
+        if not keys:
+            return
+        self.covering[gsg.key] = keys
+        for key in keys:
+            self.covered[key][gsg.key] = gsg
+
+    def remove_sg(self, gsg):
+        keys = self.covering.pop(gsg.key, None)
+        if not keys:
+            return
+        for key in keys:
+            del(self.covered[key][gsg.key])
+
+    def sgs_under(self, watcher_id, monitor_id):
+        '''{ GlobalSG.key: GlobalSG } for the subscribed GlobalSGs under a monitor'''
+        return self.covered.get((watcher_id, monitor_id), {})
+
+    def watcher_covers(self, watcher_id, key):
+        '''whether any of watcher_id's monitors covers the GlobalSG with key'''
+        return any(wid == watcher_id for wid, mid in self.covering.get(key, ()))
+
+    def watchers_covering(self, gsg):
+        '''the ids of the watchers with a monitor covering gsg'''
+        return set(watcher_id for watcher_id, monitor_id in self.covering.get(gsg.key, ()))
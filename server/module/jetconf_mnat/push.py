@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+from colorlog import info, warning, error, debug
+from datetime import datetime, timezone
+from os import getenv
+import json
+import traceback
+
+from jetconf.http_handlers import HttpResponse, HttpStatus, RestconfErrType, ERRTAG_INVVALUE
+from .assigned_json import assigned_changes_json
+
+STREAM_NAME = 'ietf-mnat:assignment-updates'
+
+# the AssignmentPush the op handlers hand subscriptions to, if any
+assignment_push = None
+
+class Subscription(object):
+    __slots__ = ('sub_id', 'watcher_id', 'created', 'generation', 'stream')
+
+    def __init__(self, sub_id, watcher_id, created):
+        self.sub_id = sub_id
+        self.watcher_id = watcher_id
+        self.created = created
+        self.generation = None
+        self.stream = None  # the jetconf EventStream, once the client GETs it
+
+class AssignmentPush(object):
+    '''
+    The ietf-mnat:assignment-updates subscriptions: establish-subscription
+    makes one for a watcher and answers with a uri, and a GET of that uri
+    becomes a long-lived event stream (see EventStream in
+    server/jetconf.patch) carrying an assignment-update notification
+    each time the watcher's mapped-sg set changes.
+
+    The first notification on a stream is the full list and each later
+    one is the delta from the one before, from mapped_sgs_since.
+    Changes are coalesced: the assignments report every change to a
+    watcher (watcher_changed), and the subscriptions of the changed
+    watchers get one notification per pass of the event loop.
+
+    A stream that's blocked on flow control doesn't queue up more
+    notifications: when it drains, one delta catches it up.  A comment
+    goes out every keepalive_seconds so a client can tell a quiet
+    stream from a dead one.
+    '''
+    def __init__(self, top, keepalive_seconds=10.0, unclaimed_seconds=30.0):
+        self.top = top
+        self.keepalive_seconds = keepalive_seconds
+        self.unclaimed_seconds = unclaimed_seconds
+        self.subs = {}  # { sub_id: Subscription }
+        self.watcher_subs = {}  # { watcher_id: { sub_id: Subscription } }
+        self.next_sub_id = 1
+        self.changed = {}  # { watcher_id: True } since the last flush
+        self.path_prefix = None
+        self.loop = None
+        self.flush_handle = None
+        self.keepalive_handle = None
+
+    def start(self, loop, path_prefix):
+        self.loop = loop
+        self.path_prefix = path_prefix
+        self.top.watcher_changed = self.watcher_changed
+        self.keepalive_handle = loop.call_later(self.keepalive_seconds, self.keepalive)
+        info(f'push: assignment-updates streams under {path_prefix}')
+
+    def stop(self):
+        self.top.watcher_changed = None
+        for handle in (self.flush_handle, self.keepalive_handle):
+            if handle:
+                handle.cancel()
+        self.flush_handle = self.keepalive_handle = None
+        for sub in list(self.subs.values()):
+            if sub.stream:
+                sub.stream.close()
+        self.subs.clear()
+        self.watcher_subs.clear()
+
+    def establish(self, watcher_id):
+        '''a new subscription to watcher_id's assignments, as (id, uri)'''
+        if getattr(self.top, 'standby', False):
+            raise ValueError('this server is a standby, not accepting subscriptions')
+        if watcher_id not in self.top.watcher_ids():
+            raise ValueError(f'Found no watcher-id {watcher_id}')
+        self.drop_unclaimed()
+        sub = Subscription(self.next_sub_id, watcher_id, self.loop.time())
+        self.next_sub_id += 1
+        self.subs[sub.sub_id] = sub
+        self.watcher_subs.setdefault(watcher_id, {})[sub.sub_id] = sub
+        info(f'push: subscription {sub.sub_id} for watcher {watcher_id}')
+        return sub.sub_id, f'{self.path_prefix}{sub.sub_id}'
+
+    def drop_unclaimed(self):
+        '''drops subscriptions nobody came to GET'''
+        too_old = self.loop.time() - self.unclaimed_seconds
+        for sub in list(self.subs.values()):
+            if not sub.stream and sub.created < too_old:
+                self.drop(sub)
+
+    def drop(self, sub):
+        self.subs.pop(sub.sub_id, None)
+        subs = self.watcher_subs.get(sub.watcher_id)
+        if subs:
+            subs.pop(sub.sub_id, None)
+            if not subs:
+                del(self.watcher_subs[sub.watcher_id])
+
+    def serve(self, ev_stream, headers, client_cert):
+        '''the jetconf event stream handler for GETs of the uris from establish'''
+        sub_id = headers[':path'].split('?')[0][len(self.path_prefix):].rstrip('/')
+        sub = self.subs.get(int(sub_id)) if sub_id.isdigit() else None
+        if not sub or sub.stream:
+            return HttpResponse.error(HttpStatus.NotFound, RestconfErrType.Application,
+                    ERRTAG_INVVALUE, err_msg=f'no subscription {sub_id} waiting')
+        info(f'push: streaming subscription {sub.sub_id} for watcher {sub.watcher_id}')
+        sub.stream = ev_stream
+
+        def closed(stream):
+            info(f'push: subscription {sub.sub_id} for watcher {sub.watcher_id} closed')
+            self.drop(sub)
+
+        ev_stream.on_close = closed
+        ev_stream.on_drain = lambda stream: self.send_update(sub)
+        self.send_update(sub)
+        return None
+
+    def watcher_changed(self, watcher_id):
+        if watcher_id not in self.watcher_subs:
+            return
+        self.changed[watcher_id] = True
+        if not self.flush_handle:
+            self.flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        changed, self.changed = self.changed, {}
+        for watcher_id in changed:
+            for sub in list(self.watcher_subs.get(watcher_id, {}).values()):
+                self.send_update(sub)
+
+    def send_update(self, sub):
+        stream = sub.stream
+        if not stream or stream.closed or stream.pending:
+            # not streaming yet, or it'll catch up when it drains
+            return
+        try:
+            changes = self.top.mapped_sgs_since(sub.watcher_id, sub.generation)
+        except Exception as e:
+            error(f'push: update for watcher {sub.watcher_id} failed: {e}')
+            error(traceback.format_exc())
+            return
+        if changes is None:
+            info(f'push: watcher {sub.watcher_id} is gone, ending subscription {sub.sub_id}')
+            stream.close()
+            return
+        if changes[1] == 'unchanged':
+            return
+        sub.generation = changes[0]
+        update = assigned_changes_json(changes)
+        update['watcher-id'] = sub.watcher_id
+        notification = {
+            'ietf-restconf:notification': {
+                'eventTime': datetime.now(timezone.utc).isoformat(),
+                'ietf-mnat:assignment-update': update
+            }
+        }
+        debug('push: %s update to %s for watcher %s', changes[1], sub.generation, sub.watcher_id)
+        stream.send_event(json.dumps(notification, separators=(',',':')))
+
+    def keepalive(self):
+        self.keepalive_handle = None
+        for sub in list(self.subs.values()):
+            if sub.stream and not sub.stream.pending:
+                sub.stream.send_comment('keepalive')
+        self.drop_unclaimed()
+        self.keepalive_handle = self.loop.call_later(self.keepalive_seconds, self.keepalive)
+
+def start_push(top, loop):
+    '''
+    Sets up establish-subscription for ietf-mnat:assignment-updates,
+    streaming under <API_ROOT>/subscriptions/, if this jetconf has
+    event streams (server/jetconf.patch).  Returns the AssignmentPush,
+    or None.
+    '''
+    from jetconf import config
+    from jetconf.rest_server import H2Protocol
+    global assignment_push
+    if not hasattr(H2Protocol, 'EVENT_STREAM_HANDLERS'):
+        warning('jetconf without event streams (see server/jetconf.patch): no push, clients will poll')
+        return None
+    keepalive = float(getenv('MNAT_PUSH_KEEPALIVE', '10'))
+    path_prefix = f'{config.CFG.http["API_ROOT"]}/subscriptions/'
+    assignment_push = AssignmentPush(top, keepalive_seconds=keepalive)
+    assignment_push.start(loop, path_prefix)
+    H2Protocol.EVENT_STREAM_HANDLERS[path_prefix] = assignment_push.serve
+    return assignment_push
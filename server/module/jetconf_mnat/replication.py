@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+from colorlog import info, warning, error
+from os import getenv, unlink
+from os.path import exists
+import asyncio
+import json
+import traceback
+from .journal import snapshot_records
+from .addresses import parse_address
+
+def encode(rec):
+    return (json.dumps(rec, separators=(',',':')) + '\n').encode()
+
+class ReplicationSource(object):
+    '''
+    The active server's side of replication: listens for standby
+    servers and streams every change to the assignments to them, as
+    the same records the journal holds (plus watcher refreshes), one
+    json record per line.
+
+    A standby that connects first gets the whole state, as the records
+    that would rebuild it from scratch between a sync-start (carrying
+    the pool) and a sync-end.  That's written out in one go from the
+    event loop, so no change can land in the middle of it.  A ping goes
+    out every ping_interval seconds so a standby can tell a quiet
+    active from a dead one.
+
+    A standby that can't keep up (more than max_backlog bytes unsent)
+    is dropped; it resyncs when it reconnects.
+    '''
+    def __init__(self, top, address, ping_interval=1.0, max_backlog=1<<28):
+        self.top = top
+        self.address = address
+        self.ping_interval = ping_interval
+        self.max_backlog = max_backlog
+        self.replicas = set()  # { StreamWriter }
+        self.server = None
+        self.loop = None
+        self.ping_handle = None
+
+    def start(self, loop):
+        self.loop = loop
+        kind, addr = parse_address(self.address)
+        if kind == 'unix':
+            if exists(addr):
+                # left over from an earlier run
+                unlink(addr)
+            coro = asyncio.start_unix_server(self.serve_replica, path=addr)
+        else:
+            coro = asyncio.start_server(self.serve_replica, host=addr[0], port=addr[1])
+        if loop.is_running():
+            loop.create_task(self.listen(coro))
+        else:
+            loop.run_until_complete(self.listen(coro))
+        self.ping_handle = loop.call_later(self.ping_interval, self.ping)
+
+    async def listen(self, coro):
+        self.server = await coro
+        info(f'replication: active, listening for standbys on {self.address}')
+
+    def stop(self):
+        if self.ping_handle:
+            self.ping_handle.cancel()
+            self.ping_handle = None
+        for writer in list(self.replicas):
+            writer.close()
+        self.replicas.clear()
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    async def serve_replica(self, reader, writer):
+        peer = writer.get_extra_info('peername') or self.address
+        info(f'replication: standby connected from {peer}, sending {len(self.top.watchers)} watchers and {len(self.top.subscribed_sgs)} sgs')
+        self.write_sync(writer)
+        self.replicas.add(writer)
+        try:
+            # a standby never sends anything: this just waits for it to go away
+            while await reader.read(4096):
+                pass
+        except (ConnectionError, OSError) as e:
+            info(f'replication: standby {peer} failed: {e}')
+        finally:
+            self.replicas.discard(writer)
+            writer.close()
+        info(f'replication: standby {peer} disconnected')
+
+    def write_sync(self, writer):
+        top = self.top
+        pool_fname, pool_json = top.pool_source
+        writer.write(encode({'op':'sync-start', 'pool-file':pool_fname,
+            'pool':pool_json, 'next-sg-id':top.next_sg_id}))
+        for rec in snapshot_records(top.snapshot(refresh_times=True)):
+            writer.write(encode(rec))
+        writer.write(encode({'op':'sync-end'}))
+
+    def send(self, rec):
+        if not self.replicas:
+            return
+        line = encode(rec)
+        for writer in list(self.replicas):
+            if writer.transport.get_write_buffer_size() > self.max_backlog:
+                warning(f'replication: dropping standby {writer.get_extra_info("peername")}, too far behind')
+                self.replicas.discard(writer)
+                writer.close()
+                continue
+            writer.write(line)
+
+    def resync(self):
+        '''sends the whole state again, for changes that aren't recorded one by one (a pool reload)'''
+        for writer in self.replicas:
+            self.write_sync(writer)
+
+    def ping(self):
+        self.send({'op':'ping'})
+        self.ping_handle = self.loop.call_later(self.ping_interval, self.ping)
+
+class ReplicationStandby(object):
+    '''
+    The standby server's side of replication: connects to the active
+    server, keeps a warm copy of its assignments by applying the
+    records it streams, and takes over once it has heard nothing
+    (records or pings) for takeover_seconds, keeping every local (S,G)
+    mapping the active had handed out.
+
+    It only takes over after a complete sync, so a standby that never
+    reached the active keeps retrying rather than coming up empty.
+    While standing by, the assignments reject changes from clients.
+    on_promote runs after the takeover (to start serving standbys of
+    its own).
+    '''
+    def __init__(self, top, address, takeover_seconds=3.0, retry_seconds=0.5, on_promote=None):
+        self.top = top
+        self.address = address
+        self.takeover_seconds = takeover_seconds
+        self.retry_seconds = retry_seconds
+        self.on_promote = on_promote
+        self.loop = None
+        self.task = None
+        self.watchdog_handle = None
+        self.synced = False
+        self.promoted = False
+        self.last_heard = None
+        self.records_applied = 0
+
+    def start(self, loop):
+        self.loop = loop
+        self.top.standby = True
+        self.top.replaying = True
+        self.task = loop.create_task(self.run())
+        self.watchdog_handle = loop.call_later(self.takeover_seconds / 4, self.watchdog)
+        info(f'replication: standby of {self.address}, taking over after {self.takeover_seconds}s of silence')
+
+    def stop(self):
+        if self.watchdog_handle:
+            self.watchdog_handle.cancel()
+            self.watchdog_handle = None
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def connect(self):
+        kind, addr = parse_address(self.address)
+        if kind == 'unix':
+            return await asyncio.open_unix_connection(addr, limit=1<<24)
+        return await asyncio.open_connection(addr[0], addr[1], limit=1<<24)
+
+    async def run(self):
+        while not self.promoted:
+            try:
+                reader, writer = await self.connect()
+            except OSError:
+                await asyncio.sleep(self.retry_seconds)
+                continue
+            info(f'replication: connected to active {self.address}')
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self.last_heard = self.loop.time()
+                    self.handle(json.loads(line))
+            except (ConnectionError, OSError, ValueError) as e:
+                warning(f'replication: stream from {self.address} failed: {e}')
+            finally:
+                writer.close()
+            warning(f'replication: lost active {self.address}')
+            await asyncio.sleep(self.retry_seconds)
+
+    def handle(self, rec):
+        op = rec['op']
+        if op == 'ping':
+            return
+        if op == 'sync-start':
+            self.synced = False
+            self.top.reset_replica(rec['pool-file'], rec['pool'], rec['next-sg-id'])
+        elif op == 'sync-end':
+            self.synced = True
+            info(f'replication: synced {len(self.top.watchers)} watchers and {len(self.top.subscribed_sgs)} sgs from {self.address}')
+        else:
+            self.top.apply_record(rec)
+            self.records_applied += 1
+
+    def watchdog(self):
+        self.watchdog_handle = None
+        if self.synced and self.loop.time() - self.last_heard > self.takeover_seconds:
+            self.promote()
+            return
+        self.watchdog_handle = self.loop.call_later(self.takeover_seconds / 4, self.watchdog)
+
+    def promote(self):
+        silent = self.loop.time() - self.last_heard
+        warning(f'replication: nothing from active {self.address} for {silent:.2f}s, taking over')
+        self.promoted = True
+        self.stop()
+        self.top.promote()
+        if self.on_promote:
+            try:
+                self.on_promote()
+            except Exception as e:
+                error(f'replication: after takeover: {e}')
+                error(traceback.format_exc())
+
+def start_replication(top, loop):
+    '''
+    Sets up replication from the environment: MNAT_REPLICATION_LISTEN
+    makes this server an active that standbys can connect to, and
+    MNAT_REPLICATION_STANDBY_OF makes it a standby of that active (which
+    starts listening on MNAT_REPLICATION_LISTEN, if set, once it takes
+    over).  Returns the ReplicationSource or ReplicationStandby, or None.
+    '''
+    listen = getenv('MNAT_REPLICATION_LISTEN')
+    active = getenv('MNAT_REPLICATION_STANDBY_OF')
+    if not listen and not active:
+        return None
+
+    def become_active():
+        top.replicas = ReplicationSource(top, listen)
+        top.replicas.start(loop)
+        return top.replicas
+
+    if not active:
+        return become_active()
+
+    takeover = float(getenv('MNAT_REPLICATION_TAKEOVER', '3'))
+    standby = ReplicationStandby(top, active, takeover,
+            on_promote=become_active if listen else None)
+    standby.start(loop)
+    return standby
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# the ietf-mnat rpcs against an Assignments, json input to json output,
+# shared by the jetconf op handlers and h2_server (so no jetconf
+# imports here).  Bad input raises ValueError.
+
+from colorlog import info, debug
+from logging import INFO
+from os import urandom
+from base64 import b32encode
+
+from .assigned_json import assigned_changes_json
+from .watcher_config import check_members, channel_from_json
+from .metrics import timed
+from mnat.lazylog import Sampled
+
+# seconds between a client's refreshes, as told to it
+REFRESH_PERIOD = 20
+
+# most watcher-ids one get-new-watcher-ids call makes (the count leaf's
+# range in ietf-mnat.yang)
+MAX_NEW_WATCHER_IDS = 1000
+
+# every watcher refreshes each REFRESH_PERIOD, so with many watchers
+# logging each one would be most of the log
+refresh_log = Sampled(INFO, 100)
+
+def input_arg(input_args, name, module='ietf-mnat'):
+    '''
+    input_args[name], which depending on the yangson version is keyed
+    with or without its module name.
+    '''
+    value = input_args.get(name)
+    if value is None:
+        value = input_args.get(f'{module}:{name}')
+    return value
+
+def watcher_list(input_args):
+    '''
+    The watcher list of a bulk rpc's input, checked for a string id in
+    each entry.
+    '''
+    watchers = input_arg(input_args, 'watcher') or []
+    if not isinstance(watchers, list):
+        raise ValueError(f'watcher must be a list, not {watchers!r}')
+    for watcher in watchers:
+        if not isinstance(watcher, dict) or not isinstance(watcher.get('id'), str):
+            raise ValueError(f'each watcher needs a string id, not {watcher!r}')
+    return watchers
+
+def joined_sgs(watcher):
+    '''
+    The (source, group)s of a set-joined-sgs watcher entry, checked as
+    an egress-global-joined PUT checks them.
+    '''
+    what = f'joined-sg of watcher {watcher["id"]}'
+    joined = watcher.get('joined-sg', [])
+    if not isinstance(joined, list):
+        raise ValueError(f'{what} must be a list')
+    sgs = []
+    for sgd in joined:
+        check_members(sgd, {'source', 'group', 'asm-group'}, what)
+        sgs.append(channel_from_json(sgd, what))
+    return sgs
+
+def new_watcher_id():
+    return b32encode(urandom(10)).decode('utf-8')
+
+@timed('mnat_rpc_seconds', rpc='refresh-watcher-id')
+def refresh_watcher_id(top, input_args):
+    watch_id = input_arg(input_args, 'watcher-id')
+    refresh_log('called refresh-watcher-id: %s', watch_id)
+    debug('  (from input args: %s)', input_args)
+    top.check_timeouts()
+
+    if not watch_id or not isinstance(watch_id, str):
+        raise ValueError(f'Could not extract watcher-id from {input_args}')
+    if not top.refresh_watcher(watch_id):
+        raise ValueError(f'Found no watcher-id {watch_id}')
+
+@timed('mnat_rpc_seconds', rpc='get-assigned-changes')
+def get_assigned_changes(top, input_args):
+    watch_id = input_arg(input_args, 'watcher-id')
+    generation = input_arg(input_args, 'generation')
+    debug('called get-assigned-changes: %s since %s', watch_id, generation)
+    top.check_timeouts()
+
+    if not watch_id or not isinstance(watch_id, str):
+        raise ValueError(f'Could not extract watcher-id from {input_args}')
+    changes = top.mapped_sgs_since(watch_id, generation)
+    if changes is None:
+        raise ValueError(f'Found no watcher-id {watch_id}')
+    return assigned_changes_json(changes)
+
+@timed('mnat_rpc_seconds', rpc='refresh-and-get-changes')
+def refresh_and_get_changes(top, input_args):
+    watch_id = input_arg(input_args, 'watcher-id')
+    generation = input_arg(input_args, 'generation')
+    debug('called refresh-and-get-changes: %s since %s', watch_id, generation)
+    top.check_timeouts()
+
+    if not watch_id or not isinstance(watch_id, str):
+        raise ValueError(f'Could not extract watcher-id from {input_args}')
+    if not top.refresh_watcher(watch_id):
+        raise ValueError(f'Found no watcher-id {watch_id}')
+    changes = top.mapped_sgs_since(watch_id, generation)
+    if changes is None:
+        raise ValueError(f'Found no watcher-id {watch_id}')
+    output = assigned_changes_json(changes)
+    output['refresh-period'] = REFRESH_PERIOD
+    return output
+
+@timed('mnat_rpc_seconds', rpc='get-new-watcher-id')
+def get_new_watcher_id(top, input_args):
+    info('called get-new-watcher-id: %s', input_args)
+    watcher_id = new_watcher_id()
+    top.create_watcher(watcher_id)
+    return {'watcher-id': watcher_id, 'refresh-period': REFRESH_PERIOD,
+            'refresh-and-get-changes': [None]}
+
+# bulk versions, for a node that fronts many watchers: each does its
+# timeout and invariant checks once for the whole request
+
+@timed('mnat_rpc_seconds', rpc='get-new-watcher-ids')
+def get_new_watcher_ids(top, input_args):
+    count = input_arg(input_args, 'count')
+    info('called get-new-watcher-ids: %s', count)
+    if count is None:
+        raise ValueError(f'Could not extract count from {input_args}')
+    if not isinstance(count, int) or isinstance(count, bool) or not 1 <= count <= MAX_NEW_WATCHER_IDS:
+        raise ValueError(f'count must be an integer from 1 to {MAX_NEW_WATCHER_IDS}, not {count!r}')
+    watcher_ids = [new_watcher_id() for i in range(count)]
+    top.create_watchers(watcher_ids)
+    return {'watcher-id': watcher_ids, 'refresh-period': REFRESH_PERIOD}
+
+@timed('mnat_rpc_seconds', rpc='refresh-watcher-ids')
+def refresh_watcher_ids(top, input_args):
+    watch_ids = input_arg(input_args, 'watcher-id') or []
+    if not isinstance(watch_ids, list):
+        raise ValueError(f'watcher-id must be a list, not {watch_ids!r}')
+    refresh_log('called refresh-watcher-ids: %d watchers', len(watch_ids))
+    debug('  (from input args: %s)', input_args)
+    top.check_timeouts()
+
+    unknown = top.refresh_watchers(list(watch_ids))
+    if unknown:
+        info('refresh-watcher-ids: no watchers %s', unknown)
+    return {'unknown-watcher-id': unknown, 'refresh-period': REFRESH_PERIOD}
+
+# set-joined-sgs goes straight to the assignments and leaves any
+# egress-global-joined entry of the watcher as it was, so a watcher's
+# joined list should come from one or the other, not both
+@timed('mnat_rpc_seconds', rpc='set-joined-sgs')
+def set_joined_sgs(top, input_args):
+    watchers = watcher_list(input_args)
+    info('called set-joined-sgs: %d watchers', len(watchers))
+    top.check_timeouts()
+
+    watcher_sgs = [(watcher['id'], joined_sgs(watcher)) for watcher in watchers]
+    top.set_watchers_subscribed_sgs(watcher_sgs)
+
+@timed('mnat_rpc_seconds', rpc='get-watchers-assigned-changes')
+def get_watchers_assigned_changes(top, input_args):
+    watchers = watcher_list(input_args)
+    debug('called get-watchers-assigned-changes: %d watchers', len(watchers))
+    top.check_timeouts()
+
+    output = []
+    unknown = []
+    for watcher in watchers:
+        watch_id = watcher['id']
+        changes = top.mapped_sgs_since(watch_id, watcher.get('generation'))
+        if changes is None:
+            unknown.append(watch_id)
+            continue
+        entry = assigned_changes_json(changes)
+        entry['id'] = watch_id
+        output.append(entry)
+    return {'watcher': output, 'unknown-watcher-id': unknown}
+
+# { rpc name: handler }, the ietf-mnat rpcs in here
+RPCS = {
+    'get-new-watcher-id': get_new_watcher_id,
+    'refresh-watcher-id': refresh_watcher_id,
+    'get-assigned-changes': get_assigned_changes,
+    'refresh-and-get-changes': refresh_and_get_changes,
+    'get-new-watcher-ids': get_new_watcher_ids,
+    'refresh-watcher-ids': refresh_watcher_ids,
+    'set-joined-sgs': set_joined_sgs,
+    'get-watchers-assigned-changes': get_watchers_assigned_changes,
+}
@@ -1,20 +1,165 @@
 from jetconf.data import JsonDatastore
-from jetconf.journal import RpcInfo
-from typing import Any, Tuple
-from yangson.instance import InstanceNode, InstanceRoute
-from colorlog import info
+from jetconf.journal import RpcInfo, ChangeType, DataChange
+from jetconf.errors import JetconfError, InstanceAlreadyPresent, NoHandlerError
+from typing import Any, List, Tuple, Optional
+from yangson.instance import InstanceNode, InstanceRoute, EntryKeys
+from yangson.exceptions import NonexistentInstance, YangsonException
+from colorlog import info, warning, debug
+from os import getenv
 from .assignments import assigned
+from .watcher_config import WatcherConfig, JoinedConfig, EntryExists, entry_value, joined_sg_from_json, sg_from_joined
 from ipaddress import ip_address
 
+EGRESS = 'ietf-mnat:egress-global-joined'
+INGRESS = 'ietf-mnat:ingress-watching'
+
+class MissingEntry(NonexistentInstance):
+    def __init__(self, path, text='no such entry'):
+        self.path = path
+        self.text = text
+
+    def __str__(self):
+        return f'{self.path}: {self.text}'
+
+def joined_patch_changes(joined, edits, entry_key):
+    '''
+    Checks the edits of a yang-patch of an egress watcher's
+    JoinedConfig, returning the { entry id: (json entry, sg) or None }
+    changes they make.
+    entry_key gives the joined-sg id an edit's target names, or
+    raises NoHandlerError if it names anything else.  The first bad
+    edit raises YangPatchEditError, as jetconf's yang_patch_rpc does.
+    '''
+    # only in a jetconf with server/jetconf.patch, the one with PATCH
+    from jetconf.errors import YangPatchEditError
+    changes = {}
+    for edit in edits:
+        edit_id = edit.get('edit-id') if isinstance(edit, dict) else None
+        try:
+            if not isinstance(edit, dict):
+                raise ValueError('Edit must be an object')
+            operation = edit.get('operation')
+            target = edit.get('target')
+            if not isinstance(target, str) or not target.startswith('/'):
+                raise ValueError('Edit target must be a path starting with "/"')
+            sg_id = entry_key(target)
+            cur = changes[sg_id] if sg_id in changes else joined.entries.get(sg_id)
+            if operation in ('delete', 'remove'):
+                if cur is None:
+                    if operation == 'remove':
+                        continue
+                    raise MissingEntry(target)
+                changes[sg_id] = None
+                continue
+            elif operation not in ('create', 'replace'):
+                raise NoHandlerError(f'Unsupported yang-patch operation "{operation}"')
+            if cur is not None and operation == 'create':
+                raise InstanceAlreadyPresent(f'Edit target "{target}" already present')
+            sgd = entry_value(edit.get('value'), 'ietf-mnat:joined-sg')
+            new_id, sg = joined_sg_from_json(sgd)
+            if new_id != sg_id:
+                raise ValueError('Key "id" of the edit value doesn\'t match the target')
+            changes[sg_id] = (sgd, sg)
+        except (JetconfError, YangsonException, ValueError) as e:
+            raise YangPatchEditError(edit_id, e)
+    return changes
+
 class UserDatastore(JsonDatastore):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # MNAT_WATCHER_CONFIG=direct (the default) keeps the watcher
+        # entries of egress-global-joined and ingress-watching in a
+        # WatcherConfig instead of the yangson tree, "yangson" keeps
+        # them in the tree like the rest of the config data.
+        self.watcher_config = None
+        mode = getenv('MNAT_WATCHER_CONFIG', 'direct')
+        if mode == 'direct':
+            if self.nacm:
+                warning('MNAT_WATCHER_CONFIG=direct is ignored with NACM enabled (using yangson)')
+            else:
+                self.watcher_config = WatcherConfig()
+        elif mode != 'yangson':
+            raise ValueError(f'unknown MNAT_WATCHER_CONFIG "{mode}" (expected direct or yangson)')
+
+    def watcher_target(self, rpc: RpcInfo) -> Optional[Tuple[str, InstanceRoute]]:
+        '''
+        (container name, instance route) when the request is for the
+        egress-global-joined or ingress-watching data and that's kept
+        in the watcher_config, else None.
+        '''
+        if not self.watcher_config or not rpc.path.startswith(('/' + EGRESS, '/' + INGRESS)):
+            return None
+        ii = self.parse_ii(rpc.path, rpc.path_format)
+        return f'{ii[0].namespace}:{ii[0].name}', ii
+
+    def target_watcher_id(self, rpc: RpcInfo, ii: InstanceRoute) -> str:
+        if len(ii) != 3 or not isinstance(ii[2], EntryKeys):
+            raise NoHandlerError(f'{rpc.path}: only whole watcher entries can be changed with MNAT_WATCHER_CONFIG=direct')
+        return ii[2].keys[('id', None)]
+
+    def with_watcher_config(self, root: InstanceNode) -> InstanceNode:
+        root = root.put_member(EGRESS, self.watcher_config.egress_json(), raw=True).top()
+        return root.put_member(INGRESS, self.watcher_config.ingress_json(), raw=True).top()
+
+    def get_node_rpc(self, rpc: RpcInfo, staging=False) -> InstanceNode:
+        target = self.watcher_target(rpc)
+        if target:
+            container, ii = target
+            return self.with_watcher_config(self.get_data_root()).goto(ii)
+        n = super().get_node_rpc(rpc, staging)
+        if self.watcher_config and not rpc.path.strip('/'):
+            n = self.with_watcher_config(n)
+        return n
+
+    def add_to_journal_rpc(self, ch_type: ChangeType, rpc: RpcInfo, value: Optional[Any], new_root: InstanceNode, nacm_modified: bool):
+        # the watcher_config changes are done already, nothing to commit
+        if self.watcher_target(rpc):
+            return
+        super().add_to_journal_rpc(ch_type, rpc, value, new_root, nacm_modified)
+
+    def create_watcher_config(self, container: str, value: Any):
+        try:
+            self.watcher_config.create(assigned, container == EGRESS, value)
+        except EntryExists as e:
+            raise InstanceAlreadyPresent(str(e))
+
+    def update_watcher_config(self, container: str, watcher_id: str, value: Any):
+        # unlike jetconf's PUT, this creates the entry if there wasn't one
+        self.watcher_config.update(assigned, container == EGRESS, watcher_id, value)
+
+    def patch_watcher_config(self, rpc: RpcInfo, watcher_id: str, edits: List[Any]):
+        def entry_key(target):
+            ii = self.parse_ii(rpc.path + target, rpc.path_format)
+            if len(ii) != 5 or ii[3].name != 'joined-sg' or not isinstance(ii[4], EntryKeys):
+                raise NoHandlerError(f'{target}: only joined-sg entries can be edited with MNAT_WATCHER_CONFIG=direct')
+            return ii[4].keys[('id', None)]
+
+        config = self.watcher_config
+        joined = config.egress.get(watcher_id) or JoinedConfig()
+        changes = joined_patch_changes(joined, edits, entry_key)
+        unsubscribes, subscribes = joined.joins_and_leaves(changes)
+        info('patched egress joined %s', watcher_id)
+        assigned.update_subscribed_sgs(watcher_id, unsubscribes, subscribes)
+        joined.apply(changes)
+        config.egress[watcher_id] = joined
+
     def create_node_rpc(self, root: InstanceNode, rpc: RpcInfo, value: Any) -> Tuple[InstanceNode, bool]:
-        info(f'create_node_rpc called: path={rpc.path}, value={value}')
+        target = self.watcher_target(rpc)
+        if target:
+            container, ii = target
+            if len(ii) != 1:
+                raise NoHandlerError(f'{rpc.path}: only whole watcher entries can be created with MNAT_WATCHER_CONFIG=direct')
+            self.create_watcher_config(container, value)
+            return root, False
+
+        info('create_node_rpc called: path=%s', rpc.path)
+        debug('  value=%s', value)
         ret = super().create_node_rpc(root, rpc, value)
-        info(f'create_node_rpc finished: ret={ret[0].path},ret[1]')
+        info('create_node_rpc finished: ret=%s, %s', ret[0].path, ret[1])
         if rpc.path == '/ietf-mnat:egress-global-joined' and \
                 isinstance(value, dict) and 'ietf-mnat:watcher' in value:
             watcher_id = value['ietf-mnat:watcher']['id']
-            info('created egress joined {watcher_id}')
+            info('created egress joined %s', watcher_id)
             sgs = []
             for sgd in value['ietf-mnat:watcher']['joined-sg']:
                 sg = (ip_address(sgd['source']), ip_address(sgd['group']))
@@ -23,20 +168,27 @@ class UserDatastore(JsonDatastore):
         elif rpc.path == '/ietf-mnat:ingress-watching' and \
                 isinstance(value, dict) and 'ietf-mnat:watcher' in value:
             watcher_id = value['ietf-mnat:watcher']['id']
-            info('created ingress watching {watcher_id}')
+            info('created ingress watching %s', watcher_id)
             monitors = value['ietf-mnat:watcher']['monitor']
             assigned.set_monitors(watcher_id, monitors)
 
         return ret
 
     def update_node_rpc(self, root: InstanceNode, rpc: RpcInfo, value: Any) -> Tuple[InstanceNode, bool]:
-        info(f'update_node_rpc called: path={rpc.path}, value={value}')
+        target = self.watcher_target(rpc)
+        if target:
+            container, ii = target
+            self.update_watcher_config(container, self.target_watcher_id(rpc, ii), value)
+            return root, False
+
+        info('update_node_rpc called: path=%s', rpc.path)
+        debug('  value=%s', value)
         ret = super().update_node_rpc(root, rpc, value)
-        info(f'update_node_rpc finished: ret={ret[0].path},ret[1]')
+        info('update_node_rpc finished: ret=%s, %s', ret[0].path, ret[1])
         if rpc.path.startswith('/ietf-mnat:egress-global-joined/watcher=') and \
                 isinstance(value, dict) and 'ietf-mnat:watcher' in value:
             watcher_id = self.get_dm().parse_resource_id(rpc.path)[-1].keys[('id',None)]
-            info('updated egress joined {watcher_id}')
+            info('updated egress joined %s', watcher_id)
             sgs = []
             for sgd in value['ietf-mnat:watcher']['joined-sg']:
                 sg = (ip_address(sgd['source']), ip_address(sgd['group']))
@@ -45,19 +197,89 @@ class UserDatastore(JsonDatastore):
         elif rpc.path.startswith('/ietf-mnat:ingress-watching/watcher=') and \
                 isinstance(value, dict) and 'ietf-mnat:watcher' in value:
             watcher_id = self.get_dm().parse_resource_id(rpc.path)[-1].keys[('id',None)]
-            info('updated ingress watching {watcher_id}')
+            info('updated ingress watching %s', watcher_id)
             monitors = value['ietf-mnat:watcher']['monitor']
             assigned.set_monitors(watcher_id, monitors)
 
         return ret
 
-    '''
     def delete_node_rpc(self, root: InstanceNode, rpc: RpcInfo) -> Tuple[InstanceNode, bool]:
-        info(f'delete_node_rpc called: root={rpc.path}')
-        ret = super().delete_node_rpc(root, rpc)
-        info(f'delete_node_rpc finished: ret={ret[0].path}')
+        target = self.watcher_target(rpc)
+        if target:
+            container, ii = target
+            watcher_id = self.target_watcher_id(rpc, ii)
+            if not self.watcher_config.delete(container == EGRESS, watcher_id):
+                raise MissingEntry(rpc.path)
+            return root, False
+
+        return super().delete_node_rpc(root, rpc)
+
+    def yang_patch_rpc(self, root: InstanceNode, rpc: RpcInfo, edits: List[Any]) -> Tuple[InstanceNode, List[DataChange]]:
+        info('yang_patch_rpc called: path=%s, %d edits', rpc.path, len(edits))
+        target = self.watcher_target(rpc)
+        if target:
+            container, ii = target
+            watcher_id = self.target_watcher_id(rpc, ii)
+            if container != EGRESS:
+                raise NoHandlerError(f'{rpc.path}: only egress-global-joined watchers can be patched with MNAT_WATCHER_CONFIG=direct')
+            self.patch_watcher_config(rpc, watcher_id, edits)
+            return root, []
+
+        ret = super().yang_patch_rpc(root, rpc, edits)
+        if rpc.path.startswith('/ietf-mnat:egress-global-joined/watcher='):
+            watcher_id = self.get_dm().parse_resource_id(rpc.path)[-1].keys[('id',None)]
+            changes = self.joined_sg_changes(rpc.path, root, ret[1])
+            if changes:
+                unsubscribes, subscribes = changes
+                info('patched egress joined %s', watcher_id)
+                assigned.update_subscribed_sgs(watcher_id, unsubscribes, subscribes)
+            else:
+                # edits above the joined-sg entries, go by the whole list
+                info('patched egress joined %s (full list)', watcher_id)
+                joined = ret[0].goto(self.parse_ii(rpc.path, rpc.path_format)).value.get('joined-sg', [])
+                assigned.set_subscribed_sgs(watcher_id, [sg_from_joined(sgd) for sgd in joined])
+
         return ret
-    '''
+
+    def joined_sg_changes(self, watcher_path, root, changes):
+        '''
+        The (unsubscribes, subscribes) made by yang-patch changes under
+        an egress watcher, or None if any of them touch more than single
+        joined-sg entries.  An (S,G) that's removed and added back under
+        another id comes out of both lists, so it stays subscribed.
+        '''
+        entry_prefix = watcher_path + '/joined-sg='
+        unsubscribes, subscribes = {}, {}
+
+        def removed(sgd):
+            sg = sg_from_joined(sgd)
+            if sg in subscribes:
+                del(subscribes[sg])
+            else:
+                unsubscribes[sg] = True
+
+        def added(sgd):
+            sg = sg_from_joined(sgd)
+            if sg in unsubscribes:
+                del(unsubscribes[sg])
+            else:
+                subscribes[sg] = True
+
+        for change in changes:
+            path = change.rpc_info.path
+            if change.change_type == ChangeType.CREATE and path == watcher_path and \
+                    'ietf-mnat:joined-sg' in change.input_data:
+                added(change.input_data['ietf-mnat:joined-sg'])
+            elif path.startswith(entry_prefix):
+                if change.change_type != ChangeType.CREATE:
+                    removed(root.goto(self.parse_ii(path, change.rpc_info.path_format)).value)
+                if change.change_type == ChangeType.REPLACE:
+                    added(change.input_data['ietf-mnat:joined-sg'])
+            else:
+                return None
+            root = change.root_after_change
+
+        return list(unsubscribes), list(subscribes)
 
     # Save and Load methods can be customized here
 
@@ -1,10 +1,41 @@
 from colorlog import info
+import asyncio
+import signal
+from .assignments import assigned
+from .replication import start_replication
+from .push import start_push
+from .metrics import start_metrics
+
+replication = None
+push = None
+metrics_server = None
 
 
 def jc_startup():
     info("Backend: init")
+    # jetconf's RestServer picks up this same loop after startup.
+    loop = asyncio.get_event_loop()
+    assigned.start_expiry_task(loop)
+    # kill -HUP reloads the pool file, keeping assignments that still fit
+    loop.add_signal_handler(signal.SIGHUP, assigned.reload_pool)
+    # active/standby, from MNAT_REPLICATION_*
+    global replication
+    replication = start_replication(assigned, loop)
+    # establish-subscription for ietf-mnat:assignment-updates
+    global push
+    push = start_push(assigned, loop)
+    # a prometheus scrape endpoint, from MNAT_METRICS
+    global metrics_server
+    metrics_server = start_metrics(assigned, loop)
 
 
 def jc_end():
     info("Backend: cleaning up")
-
+    if metrics_server:
+        metrics_server.stop()
+    if push:
+        push.stop()
+    if replication:
+        replication.stop()
+    assigned.stop_expiry_task()
+    assigned.close_journal()
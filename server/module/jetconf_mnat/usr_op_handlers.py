@@ -1,6 +1,4 @@
 from colorlog import info, warning, error, debug
-from os import urandom
-from base64 import b32encode
 
 from yangson.instance import InstanceRoute
 from yangson.exceptions import NonexistentInstance
@@ -8,33 +6,55 @@ from yangson.exceptions import NonexistentInstance
 from jetconf.helpers import JsonNodeT, PathFormat
 from jetconf.data import BaseDatastore
 from .assignments import assigned
+from .rpcs import input_arg
+from .metrics import timed
+from . import rpcs
+from . import push
 
 class OpHandlersContainer:
     def __init__(self, ds: BaseDatastore):
         self.ds = ds
 
+    @timed('mnat_rpc_seconds', rpc='establish-subscription')
     def establish_subscription_op(self, input_args: JsonNodeT, username: str) -> JsonNodeT:
-        info(f'called establish_subscription: {input_args}')
-        return {'id':2}
+        info('called establish_subscription: %s', input_args)
+        stream = input_arg(input_args, 'stream-filter-name', 'ietf-subscribed-notifications') or \
+                input_arg(input_args, 'stream', 'ietf-subscribed-notifications')
+        if stream != push.STREAM_NAME:
+            raise ValueError(f'Unknown stream {stream} (only {push.STREAM_NAME} is supported)')
+        watch_id = input_arg(input_args, 'watcher-id')
+        if not watch_id:
+            raise ValueError(f'Could not extract watcher-id from {input_args}')
+        if not push.assignment_push:
+            raise ValueError('No server push here (jetconf without event streams)')
+        sub_id, uri = push.assignment_push.establish(watch_id)
+        return {'id': sub_id, 'ietf-mnat:uri': uri}
+
+    # the ietf-mnat rpcs themselves are in rpcs.py, shared with h2_server
 
     def refresh_watcher_id_op(self, input_args: JsonNodeT, username: str) -> JsonNodeT:
-        watch_id = input_args.get('watcher-id')
-        info(f'called refresh-watcher-id: {watch_id}')
-        debug(f'  (from input args: {input_args})')
-        assigned.check_timeouts()
+        return rpcs.refresh_watcher_id(assigned, input_args)
 
-        if not watch_id:
-            raise ValueError(f'Could not extract watcher-id from {input_args}')
-        w = assigned.watchers.get(watch_id)
-        if not w:
-            raise ValueError(f'Found no watcher-id {watch_id}')
-        w.refresh()
+    def get_assigned_changes_op(self, input_args: JsonNodeT, username: str) -> JsonNodeT:
+        return rpcs.get_assigned_changes(assigned, input_args)
+
+    def refresh_and_get_changes_op(self, input_args: JsonNodeT, username: str) -> JsonNodeT:
+        return rpcs.refresh_and_get_changes(assigned, input_args)
 
     def get_new_watcher_id_op(self, input_args: JsonNodeT, username: str) -> JsonNodeT:
-        info(f'called get-new-watcher-id: {input_args}')
-        watcher_id = b32encode(urandom(10)).decode('utf-8')
-        assigned.create_watcher(watcher_id)
-        return {'watcher-id': watcher_id, 'refresh-period': 20}
+        return rpcs.get_new_watcher_id(assigned, input_args)
+
+    def get_new_watcher_ids_op(self, input_args: JsonNodeT, username: str) -> JsonNodeT:
+        return rpcs.get_new_watcher_ids(assigned, input_args)
+
+    def refresh_watcher_ids_op(self, input_args: JsonNodeT, username: str) -> JsonNodeT:
+        return rpcs.refresh_watcher_ids(assigned, input_args)
+
+    def set_joined_sgs_op(self, input_args: JsonNodeT, username: str) -> JsonNodeT:
+        return rpcs.set_joined_sgs(assigned, input_args)
+
+    def get_watchers_assigned_changes_op(self, input_args: JsonNodeT, username: str) -> JsonNodeT:
+        return rpcs.get_watchers_assigned_changes(assigned, input_args)
 
 def register_op_handlers(ds: BaseDatastore):
     op_handlers_obj = OpHandlersContainer(ds)
@@ -44,4 +64,15 @@ def register_op_handlers(ds: BaseDatastore):
             "ietf-mnat:get-new-watcher-id")
     ds.handlers.op.register(op_handlers_obj.refresh_watcher_id_op,
             "ietf-mnat:refresh-watcher-id")
-
+    ds.handlers.op.register(op_handlers_obj.get_assigned_changes_op,
+            "ietf-mnat:get-assigned-changes")
+    ds.handlers.op.register(op_handlers_obj.refresh_and_get_changes_op,
+            "ietf-mnat:refresh-and-get-changes")
+    ds.handlers.op.register(op_handlers_obj.get_new_watcher_ids_op,
+            "ietf-mnat:get-new-watcher-ids")
+    ds.handlers.op.register(op_handlers_obj.refresh_watcher_ids_op,
+            "ietf-mnat:refresh-watcher-ids")
+    ds.handlers.op.register(op_handlers_obj.set_joined_sgs_op,
+            "ietf-mnat:set-joined-sgs")
+    ds.handlers.op.register(op_handlers_obj.get_watchers_assigned_changes_op,
+            "ietf-mnat:get-watchers-assigned-changes")
@@ -2,78 +2,27 @@ from yangson.instance import InstanceRoute
 from jetconf.helpers import JsonNodeT
 from jetconf.handler_base import StateDataListHandler, StateDataContainerHandler
 from jetconf.data import BaseDatastore
-from colorlog import info, warning
+from colorlog import info, warning, debug
 
 from .assignments import assigned
+from mnat.lazylog import Lazy
+from .assigned_json import watcher_assignments_json
 
-def generate_watcher_assignments(w):
-    mapped_sgs = []
-    monitored = set()
-    for gsg in w.subscribed_gsgs.values():
-        monitored.update(gsg.sg)
-        source = gsg.sg[0]
-        group = gsg.sg[1]
-        sg_id = gsg.sg_id
-        sg_dat = {
-            'id': sg_id,
-            'global-subscription': {
-                'source': str(source),
-                'group': str(group)
-            }
-          }
-        if gsg.assignment:
-            sg_dat['state'] = 'assigned-local-multicast'
-            # tbd: support asm-group:
-            sg_dat['local-mapping'] = {
-                    'source': str(gsg.assignment.local_sg[0]),
-                    'group': str(gsg.assignment.local_sg[1]),
-                }
-        else:
-            sg_dat['state'] = 'unassigned'
-        mapped_sgs.append(sg_dat)
-
-    for mon in w.monitors.values():
-        for gsg in assigned.subscribed_sgs.values():
-            if gsg.sg not in monitored:
-                if mon.includes(gsg):
-                    monitored.update(gsg.sg)
-                    source = gsg.sg[0]
-                    group = gsg.sg[1]
-                    sg_id = gsg.sg_id
-                    sg_dat = {
-                        'id': sg_id,
-                        'global-subscription': {
-                            'source': str(source),
-                            'group': str(group)
-                        }
-                      }
-                    if gsg.assignment:
-                        sg_dat['state'] = 'assigned-local-multicast'
-                        # tbd: support asm-group:
-                        sg_dat['local-mapping'] = {
-                                'source': str(gsg.assignment.local_sg[0]),
-                                'group': str(gsg.assignment.local_sg[1]),
-                            }
-                    else:
-                        sg_dat['state'] = 'unassigned'
-                    mapped_sgs.append(sg_dat)
-
-
-    return {
-        'id': w.watcher_id,
-        'mapped-sg': mapped_sgs
-    }
+def generate_watcher_assignments(watcher_id):
+    return watcher_assignments_json(assigned, watcher_id)
 
 def generate_watchers_list():
     watchers_list = []
-    for w in assigned.watchers.values():
-        watchers_list.append(generate_watcher_assignments(w))
+    for watcher_id in assigned.watcher_ids():
+        watcher_dat = generate_watcher_assignments(watcher_id)
+        if watcher_dat:
+            watchers_list.append(watcher_dat)
     return watchers_list
 
 class AssignedWatcherHandler(StateDataListHandler):
     def generate_list(self, node_ii: InstanceRoute, username: str, staging: bool) -> JsonNodeT:
         # This method has to generate entire list
-        info(f'MappedSG List {node_ii}')
+        info('MappedSG List %s', node_ii)
         assigned.check_timeouts()
         return generate_watchers_list()
 
@@ -82,8 +31,8 @@ class AssignedWatcherHandler(StateDataListHandler):
         watcher_id = node_ii[-1].keys.get(('id', None))
         assigned.check_timeouts()
 
-        w = assigned.watchers.get(watcher_id)
-        if not w:
+        watcher_dat = generate_watcher_assignments(watcher_id)
+        if not watcher_dat:
             # these all fail with an uncomfortable unhandled exception and closing of the connection instead of an error code:
             '''
             return {
@@ -103,10 +52,10 @@ class AssignedWatcherHandler(StateDataListHandler):
             # return None
             # raise ValueError(f'Found no watcher-id {watcher_id}')
             warning(f'no such watcher-id: {watcher_id} in assigned-channels/watcher generate_item')
-            info(f'live watcher ids: {list(assigned.watchers.keys())}')
+            debug('live watcher ids: %s', Lazy(assigned.watcher_ids))
             return {}
 
-        return generate_watcher_assignments(w)
+        return watcher_dat
 
 class AssignedChannelsHandler(StateDataContainerHandler):
     def generate_node(self, node_ii: InstanceRoute, username: str, staging: bool) -> JsonNodeT:
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+from colorlog import info
+from ipaddress import ip_address, ip_network
+
+class EntryExists(ValueError):
+    pass
+
+def sg_from_joined(sgd):
+    return (ip_address(sgd['source']), ip_address(sgd['group']))
+
+def distinct_sgs(entries):
+    return list(dict.fromkeys(sg for sgd, sg in entries.values()))
+
+def check_members(value, allowed, what):
+    if not isinstance(value, dict):
+        raise ValueError(f'{what} must be an object')
+    extra = set(value) - allowed
+    if extra:
+        raise ValueError(f'unknown members {sorted(extra)} in {what}')
+
+def check_string(value, name, what):
+    val = value.get(name)
+    if not isinstance(val, str):
+        raise ValueError(f'{what} needs a string "{name}"')
+    return val
+
+def check_list(value, name, what):
+    val = value.get(name, [])
+    if not isinstance(val, list):
+        raise ValueError(f'"{name}" of {what} must be a list')
+    return val
+
+def entry_value(value, member):
+    '''
+    The one list entry in a PUT/POST/yang-patch body, which can come as
+    the object or as a list holding just it.
+    '''
+    if not isinstance(value, dict) or len(value) != 1:
+        raise ValueError(f'body must hold exactly one member, {member}')
+    if member not in value:
+        raise ValueError(f'unexpected member {list(value)[0]} (expected {member})')
+    entry = value[member]
+    if isinstance(entry, list):
+        if len(entry) != 1:
+            raise ValueError(f'{member} must hold exactly one entry')
+        entry = entry[0]
+    return entry
+
+def channel_from_json(sgd, what):
+    '''
+    Checks the multicast-channel members (source and group) of sgd the
+    way the yang model would, returning (source, group).
+    '''
+    if 'asm-group' in sgd:
+        raise ValueError(f'{what}: asm-group joins are not supported')
+    src_str = check_string(sgd, 'source', what)
+    grp_str = check_string(sgd, 'group', what)
+    try:
+        src = ip_address(src_str)
+        grp = ip_address(grp_str)
+    except ValueError as e:
+        raise ValueError(f'{what}: {e}')
+    if not grp.is_multicast:
+        raise ValueError(f'{what}: group {grp} is not multicast')
+    return src, grp
+
+def joined_sg_from_json(sgd):
+    '''
+    Checks one egress-global-joined joined-sg entry the way the yang
+    model would, returning (entry id, (source, group)).
+    '''
+    check_members(sgd, {'id', 'source', 'group', 'asm-group'}, 'joined-sg')
+    sg_id = check_string(sgd, 'id', 'joined-sg')
+    return sg_id, channel_from_json(sgd, f'joined-sg {sg_id}')
+
+def monitor_from_json(mon):
+    check_members(mon, {'id', 'global-source-prefix'}, 'monitor')
+    mon_id = check_string(mon, 'id', 'monitor')
+    if 'global-source-prefix' in mon:
+        try:
+            ip_network(check_string(mon, 'global-source-prefix', f'monitor {mon_id}'))
+        except ValueError as e:
+            raise ValueError(f'monitor {mon_id}: {e}')
+    return mon_id
+
+class JoinedConfig(object):
+    '''
+    One egress watcher's joined-sg list: the entries as received, in
+    order, and how many entries name each (S,G), so an edit of a few
+    entries knows which (S,G)s it joins or leaves without a pass over
+    the whole list.
+    '''
+    __slots__ = ('entries', 'counts')
+
+    def __init__(self):
+        self.entries = {}  # { entry id: (json entry, sg) }
+        self.counts = {}   # { sg: number of entries }
+
+    def apply(self, changes):
+        '''changes: { entry id: (json entry, sg) or None to remove }'''
+        for sg_id, new in changes.items():
+            old = self.entries.get(sg_id)
+            if old:
+                count = self.counts[old[1]] - 1
+                if count:
+                    self.counts[old[1]] = count
+                else:
+                    del(self.counts[old[1]])
+            if new:
+                self.entries[sg_id] = new
+                self.counts[new[1]] = self.counts.get(new[1], 0) + 1
+            elif old:
+                del(self.entries[sg_id])
+
+    def joins_and_leaves(self, changes):
+        '''
+        The (unsubscribes, subscribes) that applying changes would make.
+        '''
+        deltas = {}
+        for sg_id, new in changes.items():
+            old = self.entries.get(sg_id)
+            if old:
+                deltas[old[1]] = deltas.get(old[1], 0) - 1
+            if new:
+                deltas[new[1]] = deltas.get(new[1], 0) + 1
+        unsubscribes, subscribes = [], []
+        for sg, delta in deltas.items():
+            before = self.counts.get(sg, 0)
+            if before and not before + delta:
+                unsubscribes.append(sg)
+            elif not before and delta > 0:
+                subscribes.append(sg)
+        return unsubscribes, subscribes
+
+    def to_json(self, watcher_id):
+        return {'id': watcher_id, 'joined-sg': [sgd for sgd, sg in self.entries.values()]}
+
+class WatcherConfig(object):
+    '''
+    The egress-global-joined and ingress-watching watcher entries, kept
+    as the json they came in as instead of in jetconf's yangson tree.
+
+    These lists are write-mostly: an egress PUTs or patches its whole
+    joined list every time it changes and nothing reads it back but
+    the Assignments it feeds.  Going through the yangson tree costs a
+    schema-driven conversion and validation of every entry and a copy
+    of the path to it on each write, and then the data sits in the
+    per-user staging journal.  Here the fixed shape of a watcher entry
+    is checked directly, and UserDatastore hands the result to the
+    Assignments and keeps the json for GETs.
+
+    create, update and delete are the POST, PUT and DELETE of a watcher
+    entry, handing its (S,G)s or monitors to the Assignments top.  A
+    bad body raises ValueError.  There's nothing from jetconf in here,
+    so h2_server keeps its watcher entries with it too.
+    '''
+    def __init__(self):
+        self.egress = {}   # { watcher id: JoinedConfig }
+        self.ingress = {}  # { watcher id: json watcher entry }
+
+    def prune(self, watcher_ids):
+        '''drops the entries of watchers the Assignments no longer have'''
+        for watchers in (self.egress, self.ingress):
+            for watcher_id in [wid for wid in watchers if wid not in watcher_ids]:
+                del(watchers[watcher_id])
+
+    def parse_joined(self, value, watcher_id=None):
+        '''
+        Checks an egress watcher body, returning (watcher id,
+        { entry id: (json entry, sg) }).
+        '''
+        watcher = entry_value(value, 'ietf-mnat:watcher')
+        check_members(watcher, {'id', 'joined-sg'}, 'watcher')
+        wid = check_string(watcher, 'id', 'watcher')
+        if watcher_id is not None and wid != watcher_id:
+            raise ValueError(f'watcher id {wid} does not match the target {watcher_id}')
+        entries = {}
+        for sgd in check_list(watcher, 'joined-sg', f'watcher {wid}'):
+            sg_id, sg = joined_sg_from_json(sgd)
+            if sg_id in entries:
+                raise ValueError(f'watcher {wid}: duplicate joined-sg id {sg_id}')
+            entries[sg_id] = (sgd, sg)
+        return wid, entries
+
+    def parse_watching(self, value, watcher_id=None):
+        '''Checks an ingress watcher body, returning (watcher id, monitors).'''
+        watcher = entry_value(value, 'ietf-mnat:watcher')
+        check_members(watcher, {'id', 'monitor'}, 'watcher')
+        wid = check_string(watcher, 'id', 'watcher')
+        if watcher_id is not None and wid != watcher_id:
+            raise ValueError(f'watcher id {wid} does not match the target {watcher_id}')
+        monitors = check_list(watcher, 'monitor', f'watcher {wid}')
+        mon_ids = set()
+        for mon in monitors:
+            mon_id = monitor_from_json(mon)
+            if mon_id in mon_ids:
+                raise ValueError(f'watcher {wid}: duplicate monitor id {mon_id}')
+            mon_ids.add(mon_id)
+        return wid, monitors
+
+    def set_joined(self, watcher_id, entries):
+        joined = JoinedConfig()
+        joined.apply(entries)
+        self.egress[watcher_id] = joined
+
+    def set_watching(self, watcher_id, monitors):
+        self.ingress[watcher_id] = {'id': watcher_id, 'monitor': monitors}
+
+    def egress_json(self):
+        return {'watcher': [joined.to_json(wid) for wid, joined in self.egress.items()]}
+
+    def ingress_json(self):
+        return {'watcher': list(self.ingress.values())}
+
+    def create(self, top, egress, value):
+        '''
+        Adds the watcher entry in value to egress-global-joined (egress)
+        or ingress-watching, raising EntryExists if it has one already.
+        '''
+        # a new watcher is a good time to forget the ones that expired
+        self.prune(set(top.watcher_ids()))
+        if egress:
+            watcher_id, entries = self.parse_joined(value)
+            if watcher_id in self.egress:
+                raise EntryExists(f'egress-global-joined watcher {watcher_id} already present')
+            info('created egress joined %s (%d sgs)', watcher_id, len(entries))
+            top.set_subscribed_sgs(watcher_id, distinct_sgs(entries))
+            self.set_joined(watcher_id, entries)
+        else:
+            watcher_id, monitors = self.parse_watching(value)
+            if watcher_id in self.ingress:
+                raise EntryExists(f'ingress-watching watcher {watcher_id} already present')
+            info('created ingress watching %s', watcher_id)
+            top.set_monitors(watcher_id, monitors)
+            self.set_watching(watcher_id, monitors)
+        return watcher_id
+
+    def update(self, top, egress, watcher_id, value):
+        '''
+        Replaces the watcher's entry with the one in value.  Like a
+        RESTCONF PUT, this creates the entry if there wasn't one, and
+        returns whether there was.
+        '''
+        if egress:
+            watcher_id, entries = self.parse_joined(value, watcher_id)
+            info('updated egress joined %s (%d sgs)', watcher_id, len(entries))
+            top.set_subscribed_sgs(watcher_id, distinct_sgs(entries))
+            existed = watcher_id in self.egress
+            self.set_joined(watcher_id, entries)
+        else:
+            watcher_id, monitors = self.parse_watching(value, watcher_id)
+            info('updated ingress watching %s', watcher_id)
+            top.set_monitors(watcher_id, monitors)
+            existed = watcher_id in self.ingress
+            self.set_watching(watcher_id, monitors)
+        return existed
+
+    def delete(self, egress, watcher_id):
+        '''
+        Drops the watcher's entry, returning False if it had none.  As
+        with the yangson tree, the watcher's assignments stay until it
+        expires.
+        '''
+        watchers = self.egress if egress else self.ingress
+        if watcher_id not in watchers:
+            return False
+        del(watchers[watcher_id])
+        return True
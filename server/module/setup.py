@@ -14,6 +14,9 @@ setup(
     long_description_content_type="text/markdown",
     url = "https://github.com/GrumpyOldTroll/mnat/server",
     packages = find_packages(),
+    # it also imports mnat.lazylog at runtime, from the common package,
+    # which isn't listed here: pip would pull in that package's client
+    # dependencies (twisted, libpcap) along with it
     install_requires = ["jetconf"],
     classifiers = [
         "Programming Language :: Python :: 3",
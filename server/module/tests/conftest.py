@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+
+import sys
+from os.path import abspath, dirname, join
+
+# jetconf_mnat uses mnat.lazylog, from the common package
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', '..', '..', 'common'))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import pytest
+from jetconf_mnat.allocators import FenwickSlots, SparseSlots
+
+@pytest.fixture(params=[FenwickSlots, SparseSlots])
+def slots_class(request):
+    return request.param
+
+def test_take_and_release(slots_class):
+    slots = slots_class(8)
+    for idx in (0, 3, 7):
+        slots.take(idx)
+    assert slots.free_count() == 5
+    assert slots.free_at_or_after(3) == 4
+    assert slots.free_at_or_after(7) == 1
+    slots.release(3)
+    assert slots.free_count() == 6
+    assert slots.free_at_or_after(3) == 3
+
+def test_random_free_picks_free_slots(slots_class):
+    slots = slots_class(16)
+    for idx in range(16):
+        if idx != 5:
+            slots.take(idx)
+    for i in range(20):
+        assert slots.random_free() == 5
+
+def test_exhausted(slots_class):
+    slots = slots_class(4)
+    for idx in range(4):
+        slots.take(idx)
+    assert slots.free_count() == 0
+    with pytest.raises(IndexError):
+        slots.random_free()
+    with pytest.raises(IndexError):
+        slots.free_at_or_after(0)
+    slots.release(2)
+    assert slots.free_at_or_after(3) == 2
+
+def test_fenwick_nth_free():
+    slots = FenwickSlots(10)
+    for idx in (1, 2, 6):
+        slots.take(idx)
+    free = [idx for idx in range(10) if idx not in (1, 2, 6)]
+    assert [slots.nth_free(k) for k in range(len(free))] == free
+    assert slots.free_before(6) == 4
+    with pytest.raises(IndexError):
+        slots.nth_free(len(free))
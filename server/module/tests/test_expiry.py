@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, timedelta
+from jetconf_mnat.expiry import ExpiryScheduler
+from jetconf_mnat.assignments import Watcher
+
+TIMEOUT = timedelta(seconds=60)
+
+def test_expires_past_deadline_only():
+    expiry = ExpiryScheduler(TIMEOUT)
+    old, new = Watcher('old'), Watcher('new')
+    old.last_refresh -= 2 * TIMEOUT
+    watchers = {'old': old, 'new': new}
+    for w in watchers.values():
+        expiry.schedule(w)
+    assert expiry.pop_expired(watchers, datetime.now()) == [old]
+    assert len(expiry) == 1
+
+def test_refreshed_watcher_is_rescheduled():
+    expiry = ExpiryScheduler(TIMEOUT)
+    w = Watcher('w')
+    watchers = {'w': w}
+    expiry.schedule(w)
+    later = datetime.now() + TIMEOUT - timedelta(seconds=1)
+    w.last_refresh = later
+    assert expiry.pop_expired(watchers, datetime.now() + TIMEOUT + timedelta(seconds=1)) == []
+    assert len(expiry) == 1
+    assert expiry.next_deadline() == later + TIMEOUT
+
+def test_recreated_id_drops_stale_entry():
+    expiry = ExpiryScheduler(TIMEOUT)
+    first = Watcher('w')
+    expiry.schedule(first)
+    # first goes away, and a new watcher takes its id
+    second = Watcher('w')
+    second.last_refresh = first.last_refresh + TIMEOUT
+    watchers = {'w': second}
+    expiry.schedule(second)
+    assert expiry.pop_expired(watchers, first.last_refresh + TIMEOUT) == []
+    assert len(expiry) == 1
+    assert expiry.pop_expired(watchers, second.last_refresh + TIMEOUT) == [second]
+    assert len(expiry) == 0
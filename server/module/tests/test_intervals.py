@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+from ipaddress import ip_network
+from jetconf_mnat.intervals import net_interval, find_overlaps, merge_intervals, subtract_intervals
+
+def test_net_interval():
+    assert net_interval(ip_network('10.0.0.0/30')) == (0x0a000000, 0x0a000004)
+
+def test_merge_joins_overlapping_and_touching():
+    assert merge_intervals([(10, 20), (0, 5), (5, 8), (15, 30), (40, 41)]) == [(0, 8), (10, 30), (40, 41)]
+    assert merge_intervals([]) == []
+
+def test_subtract():
+    excludes = merge_intervals([(2, 4), (6, 7), (20, 30)])
+    assert subtract_intervals((0, 10), excludes) == [(0, 2), (4, 6), (7, 10)]
+    assert subtract_intervals((2, 4), excludes) == []
+    assert subtract_intervals((10, 20), excludes) == [(10, 20)]
+
+def test_find_overlaps():
+    intervals = [(0, 10), (10, 20), (5, 12), (30, 40), (35, 36)]
+    assert sorted(find_overlaps(intervals)) == [(0, 2), (1, 2), (3, 4)]
+    assert find_overlaps([(0, 1), (1, 2)]) == []
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import json
+import pytest
+from ipaddress import ip_address
+from jetconf_mnat.assignments import Assignments
+
+def global_sg(n):
+    return (ip_address('10.1.0.1'), ip_address(0xe8010000 + n))
+
+def mappings(top):
+    return {key: top.local_sg_of(gsg) for key, gsg in top.subscribed_sgs.items()}
+
+def write_pool(fname, ranges):
+    with open(fname, 'w') as f:
+        json.dump({'group-pool':{'ranges':[
+            {'group-range': grp, 'source-range': '10.9.1.2/32'} for grp in ranges]}}, f)
+
+@pytest.fixture
+def pool_file(tmp_path, monkeypatch):
+    fname = tmp_path / 'pool.json'
+    write_pool(fname, ['239.1.1.0/29'])
+    monkeypatch.setenv('MNAT_POOL', str(fname))
+    return fname
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_replay_gives_identical_mappings(tmp_path, monkeypatch, pool_file, compact):
+    monkeypatch.setenv('MNAT_JOURNAL', str(tmp_path / 'journal'))
+    top = Assignments()
+    sg_count = top.local_pool.sg_count
+    # more than the pool holds, so some go pending
+    top.set_subscribed_sgs('w1', [global_sg(n) for n in range(sg_count)])
+    top.set_subscribed_sgs('w2', [global_sg(n) for n in range(sg_count//2, sg_count + 3)])
+    top.set_subscribed_sgs('w1', [global_sg(n) for n in range(2, sg_count)])
+    top.remove_watcher(top.watchers['w2'])
+    top.set_subscribed_sgs('w3', [global_sg(n) for n in range(sg_count + 1, sg_count + 5)])
+    before = mappings(top)
+    assert None in before.values()
+    if compact:
+        top.close_journal()
+    else:
+        top.journal.close()
+
+    restored = Assignments()
+    assert mappings(restored) == before
+    assert set(restored.watchers) == set(top.watchers)
+    assert restored.next_sg_id == top.next_sg_id
+
+def test_reload_pool_keeps_what_still_fits(pool_file):
+    top = Assignments()
+    sg_count = top.local_pool.sg_count
+    top.set_subscribed_sgs('w1', [global_sg(n) for n in range(sg_count)])
+    before = mappings(top)
+    kept = {key: local for key, local in before.items() if int(local[1]) & 4}
+
+    write_pool(pool_file, ['239.1.1.4/30', '239.1.2.0/29'])
+    report = top.reload_pool()
+    after = mappings(top)
+    assert report == {'kept': len(kept), 'moved': sg_count - len(kept), 'pending': 0}
+    for key, local in kept.items():
+        assert after[key] == local
+    assert None not in after.values()
+    assert len(set(after.values())) == sg_count
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+from ipaddress import ip_address
+from jetconf_mnat.assignments import LocalPool, GlobalSG, sg_key, sg_hash
+
+def make_pool(group_range='239.1.1.0/24', **group_pool):
+    group_pool['ranges'] = [{'group-range': group_range, 'source-range': '10.9.1.2/32'}]
+    return LocalPool('(test)', {'group-pool': group_pool})
+
+def global_sg(n):
+    sg = (ip_address('10.1.0.1'), ip_address(0xe8010000 + n))
+    return GlobalSG(sg_key(sg), n)
+
+def hash_probes(pool, gsg):
+    return [sg_hash(gsg.sg, probe) % pool.sg_count for probe in range(pool.hash_probes)]
+
+def distinct_probes(pool):
+    for n in range(1000):
+        gsg = global_sg(n)
+        probes = hash_probes(pool, gsg)
+        if len(set(probes)) == len(probes):
+            return gsg, probes
+
+def test_hashed_retry_goes_on_to_next_probe():
+    pool = make_pool(allocation='hashed')
+    gsg, probes = distinct_probes(pool)
+    other = global_sg(5000)
+    pool.take_idx(probes[0], other.key)
+    # probes[1] can't be used: its local (S,G) is already someone's
+    # (as with overlapping ranges)
+    pool.assigned_sgs[sg_key(pool.sg_at_index(probes[1], gsg.sg))] = probes[0]
+    assert pool.borrow_idx(gsg) == probes[2]
+
+def test_hashed_fallback_steps_past_failed_idx():
+    pool = make_pool(allocation='hashed')
+    gsg, probes = distinct_probes(pool)
+    for n, idx in enumerate(probes):
+        pool.take_idx(idx, global_sg(5000 + n).key)
+    first = pool.free_slots.free_at_or_after(probes[0])
+    pool.assigned_sgs[sg_key(pool.sg_at_index(first, gsg.sg))] = probes[0]
+    expected = pool.free_slots.free_at_or_after((first + 1) % pool.sg_count)
+    assert pool.borrow_idx(gsg) == expected
+
+def test_hashed_gives_up_when_every_free_idx_fails():
+    pool = make_pool('239.1.1.0/30', allocation='hashed')
+    gsg = global_sg(1)
+    for idx in range(pool.sg_count):
+        pool.assigned_sgs[sg_key(pool.sg_at_index(idx, gsg.sg))] = idx
+    assert pool.borrow_idx(gsg) is None
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import pytest
+from jetconf_mnat.assignments import PendingQueue, GlobalSG
+
+def gsg_with_subscribers(sg_id, count):
+    gsg = GlobalSG(sg_id, sg_id)
+    for i in range(count):
+        gsg.subscribed_watchers[f'w{i}'] = None
+    return gsg
+
+def drain(pending):
+    popped = []
+    while len(pending):
+        popped.append(pending.pop().sg_id)
+    assert pending.pop() is None
+    return popped
+
+def test_fifo():
+    pending = PendingQueue('fifo')
+    gsgs = [gsg_with_subscribers(n, 3 - n) for n in range(3)]
+    for gsg in gsgs:
+        pending.add(gsg)
+    pending.add(gsgs[0])
+    pending.discard(gsgs[1])
+    assert drain(pending) == [0, 2]
+
+def test_subscribers_order():
+    pending = PendingQueue('subscribers')
+    gsgs = [gsg_with_subscribers(n, count) for n, count in enumerate((1, 3, 1, 2))]
+    for gsg in gsgs:
+        pending.add(gsg)
+    # gsg 2 gains subscribers while it waits
+    gsgs[2].subscribed_watchers['w9'] = None
+    gsgs[2].subscribed_watchers['w10'] = None
+    pending.update(gsgs[2])
+    pending.discard(gsgs[3])
+    assert drain(pending) == [1, 2, 0]
+
+def test_unknown_order():
+    with pytest.raises(ValueError):
+        PendingQueue('lifo')
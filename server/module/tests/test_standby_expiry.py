@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import asyncio
+from datetime import datetime, timedelta
+from jetconf_mnat.assignments import Assignments
+
+def stale_watcher_record(watcher_id):
+    last_refresh = datetime.now() - timedelta(seconds=600)
+    return {'op':'watcher', 'id':watcher_id, 'last-refresh':last_refresh.isoformat()}
+
+def test_standby_does_not_rearm_expired_deadline():
+    top = Assignments()
+    loop = asyncio.new_event_loop()
+    arms = []
+    call_later = loop.call_later
+    def counting_call_later(delay, callback, *args):
+        arms.append(delay)
+        return call_later(delay, callback, *args)
+    loop.call_later = counting_call_later
+    try:
+        top.standby = True
+        top.replaying = True
+        top.start_expiry_task(loop)
+        top.apply_record(stale_watcher_record('w1'))
+        # an entry due right away: this is where a standby used to spin
+        top.expiry.heap[0] = (datetime.now() - timedelta(seconds=1),) + top.expiry.heap[0][1:]
+        top.arm_expiry()
+        for i in range(10):
+            loop.run_until_complete(asyncio.sleep(0))
+        assert arms == []
+        assert 'w1' in top.watchers
+    finally:
+        top.stop_expiry_task()
+        loop.close()
+
+def test_promote_expires_by_replicated_refresh():
+    top = Assignments()
+    loop = asyncio.new_event_loop()
+    try:
+        top.standby = True
+        top.replaying = True
+        top.start_expiry_task(loop)
+        top.apply_record(stale_watcher_record('w1'))
+        top.apply_record({'op':'watcher', 'id':'w2'})
+        top.promote()
+        for i in range(10):
+            loop.run_until_complete(asyncio.sleep(0))
+        assert 'w1' not in top.watchers
+        assert 'w2' in top.watchers
+    finally:
+        top.stop_expiry_task()
+        loop.close()